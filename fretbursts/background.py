@@ -12,6 +12,9 @@ The important functions are :func:`exp_fit` and :func:`exp_cdf_fit` that
 provide two (fast) algorithms to estimate the background without binning.
 These functions are not usually called directly but passed to
 :meth:`Data.calc_bg` to compute the background of a measurement.
+When using :func:`exp_fit`, :meth:`Data.calc_bg` fits all the background
+periods at once with :func:`exp_fit_periods`, or, with `mode='rolling'`,
+on sliding windows with :func:`exp_fit_rolling`.
 
 See also :func:`exp_hist_fit` for background estimation using an histogram fit.
 """
@@ -21,7 +24,7 @@ from builtins import zip, range
 
 import numpy as np
 from .ph_sel import Ph_sel
-from .utils.misc import pprint
+from .utils.misc import pprint, map_processes
 from .fit import exp_fitting
 from .fit.gaussian_fitting import gaussian_fit_hist
 
@@ -202,11 +205,299 @@ def exp_hist_fit(ph, tail_min_us, binw=50e-6, clk_p=12.5e-9,
     Lambda /= clk_p
     return Lambda, error
 
+def exp_fit_periods(ph, starts, stops, tail_min_us, clk_p=12.5e-9):
+    """Return the :func:`exp_fit` background rates for several periods.
+
+    This function computes the same rates as calling :func:`exp_fit`
+    (with `error_metrics=None`) on each period `ph[starts[i]:stops[i]]`,
+    but computes the waiting-times only once and reduces the tail sums
+    and counts for all the periods with `np.add.reduceat`.
+
+    Arguments:
+        ph (array): timestamps array from which to extract the background.
+        starts, stops (int arrays): index of the first and last+1 timestamp
+            in each period. Periods need to be consecutive, i.e.
+            `starts[1:] == stops[:-1]`.
+        tail_min_us (float or array): minimum waiting-time in micro-secs.
+            Either a scalar or an array with one value per period.
+        clk_p (float): clock period for timestamps in `ph`
+
+    Returns:
+        2-Tuple of arrays with one element per period: estimated background
+        rate in cps (0 for periods with no waiting-times above threshold)
+        and number of waiting-times above threshold used in the estimation.
+    """
+    starts, stops = np.asarray(starts), np.asarray(stops)
+    nperiods = starts.size
+    if nperiods == 0 or stops[-1] - starts[0] < 2:
+        return np.zeros(nperiods), np.zeros(nperiods, dtype=np.int64)
+    delays = _periods_delays(ph, starts, stops)
+    return _exp_fit_periods_delays(delays, starts, stops, tail_min_us, clk_p)
+
+
+def exp_fit_periods_auto(ph, starts, stops, tail_min_us0, F_bg,
+                         clk_p=12.5e-9, num_iter=1):
+    """Return the :func:`exp_fit` background rates for several periods
+    using an "auto" tail threshold.
+
+    For each period, an initial rate `rate0` is estimated with the
+    threshold `tail_min_us0`. The rate is then estimated again using the
+    threshold `F_bg / rate0`. This threshold update is repeated `num_iter`
+    times, so that with `num_iter > 1` the threshold converges toward
+    the self-consistent value `F_bg / rate`. The waiting-times are computed
+    only once for all the estimates. Arguments `ph`, `starts`, `stops` and
+    `clk_p` are the same as :func:`exp_fit_periods`.
+
+    Returns:
+        3-Tuple of arrays with one element per period: estimated background
+        rate in cps, number of waiting-times above threshold used in the
+        estimation and the threshold in micro-secs used for the estimation.
+    """
+    starts, stops = np.asarray(starts), np.asarray(stops)
+    nperiods = starts.size
+    if nperiods == 0 or stops[-1] - starts[0] < 2:
+        return (np.zeros(nperiods), np.zeros(nperiods, dtype=np.int64),
+                np.zeros(nperiods))
+    delays = _periods_delays(ph, starts, stops)
+    rates, num_tail = _exp_fit_periods_delays(delays, starts, stops,
+                                              tail_min_us0, clk_p)
+    for i in range(num_iter):
+        with np.errstate(divide='ignore'):
+            tail_min_us = 1e6 * F_bg / rates
+        rates, num_tail = _exp_fit_periods_delays(delays, starts, stops,
+                                                  tail_min_us, clk_p)
+    return rates, num_tail, tail_min_us
+
+
+def _periods_delays(ph, starts, stops):
+    """Return the waiting-times in consecutive periods of `ph`.
+
+    Returns the waiting-times of `ph[starts[0]:stops[-1]]` and a boolean
+    mask which is False for waiting-times between photons in different
+    periods (see :func:`exp_fit_periods`).
+    """
+    i0 = starts[0]
+    dph = np.diff(ph[i0:stops[-1]])
+    in_period = np.ones(dph.size, dtype=bool)
+    iboundary = stops[:-1] - i0 - 1
+    in_period[iboundary[(iboundary >= 0) * (iboundary < dph.size)]] = False
+    return dph, in_period
+
+
+def _exp_fit_periods_delays(delays, starts, stops, tail_min_us, clk_p):
+    """Return :func:`exp_fit_periods` rates and counts from the waiting-times
+    computed by :func:`_periods_delays`.
+    """
+    dph, in_period = delays
+    nperiods = starts.size
+    tail_min = np.broadcast_to(np.asarray(tail_min_us) * 1e-6 / clk_p,
+                               (nperiods,))
+    rates = np.zeros(nperiods)
+    if (tail_min == tail_min[0]).all():
+        tail_min_dph = tail_min[0]
+    else:
+        tail_min_dph = np.repeat(tail_min, stops - starts)[:-1]
+    # Exclude waiting-times between photons in different periods
+    tail = (dph >= tail_min_dph) * in_period
+
+    # reduceat returns x[i] instead of 0 for empty ranges, so the
+    # periods with less than 2 timestamps are reset to 0 afterwards.
+    # A trailing 0 is appended so that empty periods at the end map past
+    # the last waiting-time, instead of truncating the previous period.
+    index = np.clip(starts - starts[0], 0, dph.size)
+    num_tail = np.add.reduceat(np.append(tail, False), index, dtype=np.int64)
+    tail_sum = np.add.reduceat(
+        np.append(np.where(tail, dph - tail_min_dph, 0), 0), index)
+    valid = (stops - starts >= 2) * (num_tail > 0)
+    num_tail[~valid] = 0
+    rates[valid] = num_tail[valid] / tail_sum[valid] / clk_p
+    return rates, num_tail
+
+
+def exp_fit_periods_chunked(ph, bins, tail_min_us, masks=None,
+                            clk_p=12.5e-9, chunksize=2**22):
+    """Return the :func:`exp_fit` background rates in periods, reading `ph`
+    in chunks.
+
+    This function computes the same rates as :func:`exp_fit_periods` for
+    the periods defined by `bins`, for one or more photon streams, but
+    reads `ph` in chunks of `chunksize` timestamps. The full timestamps
+    array is never loaded in memory, so `ph` can be an on-disk array
+    (e.g. a PyTables array). In each chunk the period of each photon is
+    found with `searchsorted` on `bins` and the tail sums and counts are
+    accumulated for each period. Waiting-times between photons in
+    different periods (also across chunks) are excluded.
+
+    Arguments:
+        ph (array): timestamps array (in-memory or on-disk).
+        bins (array): edges of the periods in timestamps units. As in
+            `np.histogram`, periods are half-open, except the last one.
+            Photons outside the bins are ignored.
+        tail_min_us (dict): minimum waiting-time in micro-secs for each
+            stream. Each value is either a scalar or an array with one
+            value per period.
+        masks (dict or None): in-memory photon mask of each stream, with
+            the same keys of `tail_min_us`. A mask is either a boolean
+            array of the same size of `ph` or `slice(None)` (all photons).
+            If None, use all photons for all the keys in `tail_min_us`.
+        clk_p (float): clock period for timestamps in `ph`
+        chunksize (int): number of timestamps read for each chunk.
+
+    Returns:
+        3-Tuple of dicts (with the same keys of `tail_min_us`) of arrays
+        with one element per period: estimated background rate in cps
+        (0 for periods with less than 2 photons or no waiting-times above
+        threshold), number of waiting-times above threshold and number
+        of photons of the stream in each period.
+    """
+    if masks is None:
+        masks = {key: slice(None) for key in tail_min_us}
+    nperiods = len(bins) - 1
+    tail_min = {key: np.broadcast_to(np.asarray(th) * 1e-6 / clk_p,
+                                     (nperiods,))
+                for key, th in tail_min_us.items()}
+    num_tail = {key: np.zeros(nperiods, dtype=np.int64) for key in masks}
+    tail_sum = {key: np.zeros(nperiods) for key in masks}
+    counts = {key: np.zeros(nperiods, dtype=np.int64) for key in masks}
+    # Last timestamp and period of each stream in the previous chunk
+    last = {key: None for key in masks}
+
+    for i0 in range(0, ph.shape[0], chunksize):
+        ph_chunk = ph[i0:i0 + chunksize]
+        period = np.searchsorted(bins, ph_chunk, side='right') - 1
+        # The last period includes the right edge (like np.histogram)
+        period[ph_chunk == bins[-1]] = nperiods - 1
+        for key, mask in masks.items():
+            if isinstance(mask, slice):
+                t, p = ph_chunk, period
+            else:
+                mask_chunk = mask[i0:i0 + ph_chunk.shape[0]]
+                t, p = ph_chunk[mask_chunk], period[mask_chunk]
+            if t.size == 0:
+                continue
+            inside = (p >= 0) * (p < nperiods)
+            counts[key] += np.bincount(p[inside], minlength=nperiods)
+            if last[key] is not None:
+                t = np.concatenate(([last[key][0]], t))
+                p = np.concatenate(([last[key][1]], p))
+            last[key] = (t[-1], p[-1])
+            dph = np.diff(t)
+            p_dph = p[1:]
+            valid = (p_dph == p[:-1]) * (p_dph >= 0) * (p_dph < nperiods)
+            dph, p_dph = dph[valid], p_dph[valid]
+            th = tail_min[key][p_dph]
+            tail = dph >= th
+            num_tail[key] += np.bincount(p_dph[tail], minlength=nperiods)
+            tail_sum[key] += np.bincount(p_dph[tail],
+                                         weights=(dph - th)[tail],
+                                         minlength=nperiods)
+
+    rates = {}
+    for key in masks:
+        valid = (counts[key] >= 2) * (num_tail[key] > 0)
+        num_tail[key][~valid] = 0
+        rates[key] = np.zeros(nperiods)
+        rates[key][valid] = (num_tail[key][valid] / tail_sum[key][valid] /
+                             clk_p)
+    return rates, num_tail, counts
+
+
+def exp_fit_rolling(ph, t_start, t_stop, tail_min_us, clk_p=12.5e-9):
+    """Return the :func:`exp_fit` background rates in sliding time windows.
+
+    The rate in each time window `[t_start[i], t_stop[i])` is the same as
+    :func:`exp_fit` (with `error_metrics=None`) applied to the timestamps
+    in the window. The windows can overlap: the tail counts and sums
+    are computed from cumulative sums of the thresholded waiting-times,
+    in a single O(N) pass for any number and size of windows.
+
+    Arguments:
+        ph (array): timestamps array from which to extract the background.
+        t_start, t_stop (arrays): start and stop time of each window in
+            timestamps units.
+        tail_min_us (float): minimum waiting-time in micro-secs.
+        clk_p (float): clock period for timestamps in `ph`
+
+    Returns:
+        2-Tuple of arrays with one element per window: estimated background
+        rate in cps (0 for windows with no waiting-times above threshold)
+        and number of waiting-times above threshold used in the estimation.
+    """
+    tail_min = tail_min_us * 1e-6 / clk_p
+    dph = np.diff(ph)
+    tail = dph >= tail_min
+    # Integer cumulative sums are exact for any number of timestamps
+    cum_num = np.zeros(ph.size, dtype=np.int64)
+    cum_dph = np.zeros(ph.size, dtype=np.int64)
+    np.cumsum(tail, out=cum_num[1:])
+    np.cumsum(np.where(tail, dph, 0), out=cum_dph[1:])
+
+    # ph >= t is equivalent to ph >= ceil(t) for integer timestamps
+    i0 = np.searchsorted(ph, np.ceil(t_start).astype(ph.dtype), side='left')
+    i1 = np.searchsorted(ph, np.ceil(t_stop).astype(ph.dtype), side='left')
+    # delays between photons i0..i1-1 have index i0..i1-2
+    i1 = np.maximum(i1 - 1, i0)
+    num_tail = cum_num[i1] - cum_num[i0]
+    tail_sum = cum_dph[i1] - cum_dph[i0] - num_tail * tail_min
+    rates = np.zeros(num_tail.size)
+    valid = num_tail > 0
+    rates[valid] = num_tail[valid] / tail_sum[valid] / clk_p
+    return rates, num_tail
+
+
+def exp_fit_scan(ph, tail_min_us_list, clk_p=12.5e-9, error_metrics=None):
+    """Return the :func:`exp_fit` rates and errors for a list of thresholds.
+
+    The result is the same as calling :func:`exp_fit` for each threshold
+    in `tail_min_us_list`, but the waiting-times are computed and sorted
+    only once. The rates for all the thresholds are computed from the
+    suffix sums of the sorted waiting-times, and the 'KS' or 'CM' errors
+    reuse the same sorted array. Like in :func:`fit_varying_min_delta_ph`,
+    the scan stops at the first threshold leaving less than 11
+    waiting-times and the remaining values are NaN.
+
+    Arguments:
+        ph (array): timestamps array from which to extract the background
+        tail_min_us_list (array): minimum waiting-times in micro-secs.
+        clk_p (float): clock period for timestamps in `ph`
+        error_metrics (string or None): Valid values are 'KS' or 'CM'.
+            See :func:`exp_fit`.
+
+    Returns:
+        2-Tuple of arrays with one element per threshold: estimated
+        background rate in cps and "quality of fit" index (NaN if
+        `error_metrics` is None).
+    """
+    rates = np.full(np.size(tail_min_us_list), np.nan)
+    errors = np.full(np.size(tail_min_us_list), np.nan)
+    dph = np.sort(np.diff(ph))
+    # suffix_sum[i] is the sum of dph[i:]
+    suffix_sum = np.zeros(dph.size + 1)
+    suffix_sum[:-1] = np.cumsum(dph[::-1])[::-1]
+    for i, tail_min_us in enumerate(tail_min_us_list):
+        tail_min = max(tail_min_us * 1e-6 / clk_p, 0)
+        istart = np.searchsorted(dph, tail_min, side='left')
+        num_tail = dph.size - istart
+        if num_tail <= 10:
+            # Not enough delays with current threshold
+            break  # Skip remaining values in tail_min_us_list
+        if error_metrics is None:
+            tau = suffix_sum[istart] / num_tail - tail_min
+        else:
+            x = dph[istart:] - tail_min
+            tau = x.mean()
+            y = np.arange(0.5, num_tail + 0.5) / num_tail
+            residuals = y + np.expm1(-x / tau)  # y - expon CDF
+            errors[i] = _compute_error(residuals, x, error_metrics)
+        rates[i] = 1. / tau / clk_p
+    return rates, errors
+
+
 ##
 # Fit background as function of th
 #
 def fit_varying_min_delta_ph(d, min_delta_ph_list, bg_fit_fun=exp_fit,
-                             ph_sel=Ph_sel('all'), **kwargs):
+                             ph_sel=Ph_sel('all'), n_jobs=1, **kwargs):
     """
     Fit the background as a function of the min photon interval threshold.
 
@@ -222,27 +513,55 @@ def fit_varying_min_delta_ph(d, min_delta_ph_list, bg_fit_fun=exp_fit,
         bg_fit_fun (function): function used to fit the background.
         ph_sel (Ph_sel object): photon selection on which the background is
             computed. See :class:`fretbursts.ph_sel.Ph_sel` for details.
+        n_jobs (int or None): number of processes used to fit the channels
+            in parallel (see :meth:`Data.calc_bg`). Default 1 (serial).
 
     Returns
         Two arrays for background rate and fit-error of shape
         (nch, nperiods, len(min_delta_ph_list)).
     """
+    def iter_args():
+        for ich in range(d.nch):
+            yield (d.get_ph_times(ich=ich), d.get_ph_mask(ich, ph_sel=ph_sel),
+                   np.asarray(d.Lim[ich][:d.nperiods]))
+
+    res = map_processes(_fit_varying_min_delta_ph_ch, iter_args(),
+                        n_jobs=n_jobs, min_delta_ph_list=min_delta_ph_list,
+                        bg_fit_fun=bg_fit_fun, clk_p=d.clk_p,
+                        fit_kwargs=kwargs)
+    BG = np.array([bg_ch for bg_ch, _ in res])
+    BG_err = np.array([bg_err_ch for _, bg_err_ch in res])
+    return BG, BG_err
+
 
-    BG = np.zeros((d.nch, d.nperiods, np.size(min_delta_ph_list)))
+def _fit_varying_min_delta_ph_ch(ph, mask, lim, min_delta_ph_list,
+                                 bg_fit_fun, clk_p, fit_kwargs):
+    """Fit the background of one channel (see `fit_varying_min_delta_ph`).
+    """
+    BG = np.zeros((len(lim), np.size(min_delta_ph_list)))
     BG_err = np.zeros_like(BG)
     BG[:], BG_err[:] = None, None
+    # exp_fit is computed for all thresholds sorting the delays only once
+    scan = bg_fit_fun is exp_fit and set(fit_kwargs) <= {'error_metrics'}
 
-    for ich in range(d.nch):
-        for period, ph in enumerate(
-                d.iter_ph_times_period(ich=ich, ph_sel=ph_sel)):
-            for i_min, min_delta_ph in enumerate(min_delta_ph_list):
-                try:
-                    BG[ich, period, i_min], BG_err[ich, period, i_min] = \
-                            bg_fit_fun(ph, tail_min_us=min_delta_ph,
-                                       clk_p=d.clk_p, **kwargs)
-                except AssertionError:
-                    # There are not enough delays with current threshold
-                    break   # Skip remaining values in min_delta_ph_list
+    for period, (istart, iend) in enumerate(lim):
+        period_slice = slice(istart, iend + 1)
+        if isinstance(mask, slice) and mask == slice(None):
+            ph_period = ph[period_slice]
+        else:
+            ph_period = ph[period_slice][mask[period_slice]]
+        if scan:
+            BG[period], BG_err[period] = exp_fit_scan(
+                ph_period, min_delta_ph_list, clk_p=clk_p, **fit_kwargs)
+            continue
+        for i_min, min_delta_ph in enumerate(min_delta_ph_list):
+            try:
+                BG[period, i_min], BG_err[period, i_min] = \
+                        bg_fit_fun(ph_period, tail_min_us=min_delta_ph,
+                                   clk_p=clk_p, **fit_kwargs)
+            except AssertionError:
+                # There are not enough delays with current threshold
+                break   # Skip remaining values in min_delta_ph_list
     return BG, BG_err
 
 
@@ -10,31 +10,38 @@ to and from an HDF5 file.
 Background cache implementation
 -------------------------------
 
-Background caching only works when `bg_fun = bg.exp_fit` (MLE tail fit) and
-assumes that `bg_ph_sel == Ph_sel('all')`.
-
-Background estimation results are identified by the `Data.calc_bg` arguments::
-
-    time_s, tail_min_us, F_bg, error_metrics, fit_allph
-
-These are serialized and used as group name under `/background`.
-This group stores::
-
-    bg
-
-the arrays::
+Background caching supports all the fitting functions in the `background`
+module and all the `error_metrics`. The background is always computed
+with `bg_ph_sel == Ph_sel('all')`.
+
+Background estimation results are identified by the content of the
+timestamps (:meth:`Data.ph_times_hash`), by the name of the fitting
+function and by the `Data.calc_bg` arguments::
+
+    time_s, tail_min_us, F_bg, error_metrics, fit_allph, mode, window_s,
+    auto_num_iter
+
+For ALEX and PAX measurements the alternation parameters (`D_ON`, `A_ON`
+and `offset`) are also included. `n_jobs` is not included because it does
+not change the results. These parameters are serialized in a
+"signature" string whose hash is used as group name under `/background`.
+The signature is stored in the group attribute `signature`.
+Since the cache key does not depend on the file name, the same cache file
+can be shared by several datasets (see `default_cache_file`).
+Each group stores the arrays::
 
     Lim, Ph_p
 
-and optionally the field `bg_auto_th_us0` used when `tail_min_us == 'auto'`.
-The following `Data` attributes are computed (and not stored):
+the subgroups `bg`, `bg_err` and `bg_th_us` (each with one array for each
+stream in `Data.ph_streams`) and the attributes::
 
-- bg_th_us_user: is tail_min_us when `tail_min_us != 'auto'`
-- bg_auto_F_bg: is F_bg when `tail_min_us == 'auto'`
+    bg_fun_name, bg_time_s, bg_auto_th, bg_mode
 
-Finally the following `Data` attributes are fixed:
+plus (when present) the fields `bg_auto_th_us0`, `bg_auto_F_bg`,
+`bg_auto_num_iter`, `bg_th_us_user` and `bg_window_s`. The following `Data` attributes are
+computed (and not stored):
 
-- bg_fun: fixed to bg.exp_fit, not saved but implied
+- bg_fun: the function `bg_fun_name` in the `background` module
 - bg_ph_sel: fixed to Ph_sel('all'), not saved but implied
 
 The following properties are not stored since they are compute on-fly every time:
@@ -42,111 +49,102 @@ The following properties are not stored since they are compute on-fly every time
 - nperiods
 - bg_mean
 
-Attributes not saved nor restored (so far):
-
-- Th_us: actual threshold to select the tail of the interphoton delays
-  distribution. Dict of lists just like Data.bg.
-- bg_err: metric for fit error estimation. Dict of lists just like Data.bg.
-- bg_fun_name: equal to fun.__name__
-
 
 Burst search caching
 --------------------
 
-Data.burst_search()
-Input arguments: L, m, F, P, min_rate_cps, ph_sel, compact, index_allph, c
-
-Other arguments: computefret=True, max_rate=False, dither=False,
-                 pure_python=False, verbose=False, mute=False
-
-Problem: the background estimation and periods influence burst search.
-    In particular only Data.bg_from(ph_sel) is used. A viable approach is
-    hashing Data.bg_from(ph_sel) and comparing it with the hash stored in the
-    burst-search cache.
-
-Attributes saved:
-    m, L, ph_sel: scalar parameters
-
-    Sets also:
-        bg_corrected=False, leakage_corrected=False,
-        dir_ex_corrected=False, dithering=False
-
-Depending on input executes either:
-
-    1)  _burst_search_rate()
-    or
-    2) _calc_T()
-       _burst_search_TT()
-
-Data._burst_search_rate()
-Attributes saved:
-    T, rate_th: per-spot values
-    mburst: burst data
-
-Data._calc_T():
-Attributes saved:
-    bg_bs, F, P: scalar parameters
-    T, rate_th: per-spot means
-    TT, FF, PP: list of arrays, per-spot and per background period
-
-Data._burst_search_TT()
-Attributes saved:
-    mburst: burst data
-
-Data._calc_burst_period():
-Attributes saved:
-    bp: list of arrays, uses Data.mburst and Data.Lim to compute Data.bp
-
-Plan:
-    - make signature from input args anche check is a matching group exist
-    - if it exist and min_rate_cps is None, check if the background cache
-      matches. It is good to check it also for min_rate_cps because background
-      influences burst corrections.
-    - if background hash matched can load background from cache: mbursts,
-      T, rate_th
-    - If min_rate_cps is None, call Data._calc_T() to recompute attributes:
-      bg_bs, F, P, TT, FF, PP, T, rate_th. Assert that T and rate_th have not
-      changed from previous step.
-    - Call Data._calc_burst_period() to compute Data.bp.
-    - Add to Data m, L, ph_sel (input parameters) and set
-      bg_corrected=False, leakage_corrected=False,
-      dir_ex_corrected=False, dithering=False
-    - execute last part of burst-seach method that need to be refactored in a
-      separate method.
+Burst search results (`Data.burst_search_cache`) are identified by the
+`Data.burst_search` arguments::
+
+    L, m, F, P, min_rate_cps, ph_sel, compact, index_allph, c, split_periods
+
+by the content of the timestamps and by a hash of the background used for
+burst search (`Data.bg_from(ph_sel)` and `Data.Lim`). The background hash
+is included also when using `min_rate_cps` because the background
+influences the burst corrections. Other arguments (`computefret`,
+`max_rate`, `dither`, `pax`, ...) only affect the post-processing and
+are not included.
+
+The serialized signature is hashed and used as group name under
+`/burst_search`. This group stores the attribute `signature` and the
+subgroup `mburst` with one array of burst data (`Bursts.data`) per channel.
+When `computefret` is True, the subgroup `stream_counts` stores the number
+of photons of each stream in each burst (before corrections), one array
+per channel (see `Data._ph_num_to_stream_counts`).
+
+When loading bursts from the cache:
+
+    - if min_rate_cps is None, `Data._calc_T()` recomputes the attributes
+      bg_bs, F, P, TT, FF, PP, T, rate_th, otherwise T and rate_th are
+      computed from min_rate_cps.
+    - `Data._burst_search_finalize()` computes `Data.bp` and saves m, L,
+      ph_sel and the correction flags.
+    - `Data._burst_search_postprocess()` computes the burst counts (from
+      the cached stream counts when available) and the corrections.
 
 """
 
+
 from __future__ import absolute_import
 from builtins import range, zip
 
 from pathlib import Path
+import hashlib
 import json
 import numpy as np
 import tables
 
 from .utils.misc import pprint
 from .ph_sel import Ph_sel
-from .background import exp_fit
+from . import background
+from .phtools.burstsearch import Bursts
+
+
+#: Path of a cache file shared by all the datasets. If None, the cache
+#: file is `<stem>_cache.hdf5` in the folder of the data file.
+default_cache_file = None
 
+# Per-stream fields (dict of lists) and scalar fields saved in the cache
+_bg_stream_fields = ['bg', 'bg_err', 'bg_th_us']
+_bg_attr_fields = ['bg_fun_name', 'bg_time_s', 'bg_auto_th', 'bg_mode',
+                   'bg_auto_th_us0', 'bg_auto_F_bg', 'bg_auto_num_iter',
+                   'bg_th_us_user', 'bg_window_s']
 
-def bs_to_signature(L, m, F, P, min_rate_cps, ph_sel, compact, index_allph, c):
-    return json.dumps(dict(L=L, m=m, F=F, P=P, min_rate_cps=min_rate_cps,
-                           ph_sel=ph_sel, compact=compact,
-                           index_allph=index_allph, c=c), sort_keys=True)
+
+def _to_json(value):
+    """Convert numpy arrays and scalars to JSON-serializable objects."""
+    if isinstance(value, (np.ndarray, np.generic, tuple, list)):
+        return np.asarray(value).tolist()
+    return value
+
+
+def bs_to_signature(L, m, F, P, min_rate_cps, ph_sel, compact, index_allph, c,
+                    split_periods=True, ph_times_hash=None, bg_hash=None):
+    params = dict(L=L, m=m, F=F, P=P, min_rate_cps=min_rate_cps,
+                  ph_sel=ph_sel, compact=compact, index_allph=index_allph,
+                  c=c, split_periods=split_periods,
+                  ph_times_hash=ph_times_hash, bg_hash=bg_hash)
+    params = {k: _to_json(v) for k, v in params.items()}
+    return json.dumps(params, sort_keys=True)
 
 
 def bs_from_signature(string):
     return json.loads(string).items()
 
 
-def bg_to_signature(d, time_s, tail_min_us, F_bg, error_metrics, fit_allph):
-    params = dict(time_s=time_s, tail_min_us=tail_min_us, F_bg=F_bg,
-                  error_metrics=error_metrics, fit_allph=fit_allph)
+def bg_to_signature(d, fun, time_s, tail_min_us, F_bg, error_metrics,
+                    fit_allph, mode='periods', window_s=None,
+                    auto_num_iter=1):
+    params = dict(ph_times_hash=d.ph_times_hash(), fun=fun.__name__,
+                  time_s=time_s, tail_min_us=tail_min_us, F_bg=F_bg,
+                  error_metrics=error_metrics, fit_allph=fit_allph,
+                  mode=mode, window_s=window_s, auto_num_iter=auto_num_iter)
     if d.ALEX or 'PAX' in d.meas_type:
         params.update(d_on=d.D_ON, a_on=d.A_ON)
         if not d.lifetime:
             # offset is not present in ns-ALEX/PIE
             params.update(offset=d.offset)
+    params = {k: _to_json(v) for k, v in params.items()}
     return json.dumps(params, sort_keys=True)
 
 
@@ -155,6 +153,11 @@ def bg_from_signature(string):
             for k, v in json.loads(string).items()}
 
 
+def _signature_to_group_name(signature):
+    """Return the name of the group in /background storing `signature`."""
+    return 'bg_' + hashlib.md5(signature.encode()).hexdigest()
+
+
 def _remove_cache_grp(h5file, group):
     """Remove `group` from `h5file`."""
     if group in h5file.root:
@@ -166,93 +169,237 @@ def _remove_cache_bg(h5file):
     _remove_cache_grp(h5file, group='/background')
 
 
-def _save_bg_data(d, bg, Lim, Ph_p, bg_calc_kwargs, h5file,
-                  bg_auto_th_us0=None):
-    """Save background data to HDF5 file."""
-    # Save the bg data
-    group_name = bg_to_signature(d, **bg_calc_kwargs)
+def _save_bg_data(d, bg_calc_kwargs, h5file):
+    """Save the background data in `d` to HDF5 file."""
+    signature = bg_to_signature(d, **bg_calc_kwargs)
+    group_name = _signature_to_group_name(signature)
     if _bg_is_cached(d, h5file, bg_calc_kwargs):
         h5file.remove_node('/background', group_name, recursive=True)
 
     bg_group = h5file.create_group('/background', group_name,
                                    createparents=True)
-
-    for ph_sel in bg:
-        h5file.create_array(bg_group, 'BG_%s' % str(ph_sel), obj=bg[ph_sel])
-    h5file.create_array(bg_group, 'Lim', obj=Lim)
-    h5file.create_array(bg_group, 'Ph_p', obj=Ph_p)
-    if bg_calc_kwargs['tail_min_us'] == 'auto':
-        assert bg_auto_th_us0 is not None
-        h5file.create_array(bg_group, 'bg_auto_th_us0', obj=bg_auto_th_us0)
+    bg_group._v_attrs.signature = signature
+    for field in _bg_stream_fields:
+        field_group = h5file.create_group(bg_group, field)
+        for ph_sel, values in d[field].items():
+            h5file.create_array(field_group, str(ph_sel),
+                                obj=np.array(values, dtype=float))
+    h5file.create_array(bg_group, 'Lim', obj=np.array(d.Lim))
+    h5file.create_array(bg_group, 'Ph_p', obj=np.array(d.Ph_p))
+    for field in _bg_attr_fields:
+        if field in d:
+            bg_group._v_attrs[field] = d[field]
 
 
 def _load_bg_data(d, bg_calc_kwargs, h5file):
-    """Load background data from a HDF5 file."""
-    group_name = bg_to_signature(d, **bg_calc_kwargs)
-    if group_name not in h5file.root.background:
+    """Load background data from a HDF5 file.
+
+    Returns a dict of `Data` fields.
+    """
+    group_name = _signature_to_group_name(bg_to_signature(d, **bg_calc_kwargs))
+    if not _bg_is_cached(d, h5file, bg_calc_kwargs):
         msg = 'Group "%s" not found in the HDF5 file.' % group_name
         raise ValueError(msg)
-    bg_auto_th_us0 = None
     bg_group = h5file.get_node('/background/', group_name)
 
     pprint('\n - Loading bakground data: ')
-    bg = {}
-    for node in bg_group._f_iter_nodes():
-        if node._v_name.startswith('BG_'):
-            ph_sel = Ph_sel.from_str(node._v_name[len('BG_'):])
-            bg[ph_sel] = [np.asfarray(b) for b in node.read()]
-
-    Lim = bg_group.Lim.read()
-    Ph_p = bg_group.Ph_p.read()
-    if 'bg_auto_th_us0' in bg_group:
-        bg_auto_th_us0 = bg_group.bg_auto_th_us0.read()
-    return bg, Lim, Ph_p, bg_auto_th_us0
+    bg_dict = {}
+    for field in _bg_stream_fields:
+        bg_dict[field] = {}
+        for node in bg_group._f_get_child(field)._f_iter_nodes():
+            ph_sel = Ph_sel.from_str(node._v_name)
+            bg_dict[field][ph_sel] = [b for b in node.read()]
+
+    bg_dict.update(Lim=list(bg_group.Lim.read()),
+                   Ph_p=list(bg_group.Ph_p.read()))
+    attrs = bg_group._v_attrs
+    for field in _bg_attr_fields:
+        if field in attrs._v_attrnames:
+            value = attrs[field]
+            bg_dict[field] = value.item() if isinstance(value, np.generic) \
+                else value
+    bg_dict.update(bg_fun=getattr(background, bg_dict['bg_fun_name']),
+                   bg_ph_sel=Ph_sel('all'))
+    return bg_dict
 
 
 def _bg_is_cached(d, h5file, bg_calc_kwargs):
     """Returns signature matches a group in /backgroung.
     """
-    group_name = bg_to_signature(d, **bg_calc_kwargs)
+    group_name = _signature_to_group_name(bg_to_signature(d, **bg_calc_kwargs))
     return ('background' in h5file.root and
             group_name in h5file.root.background)
 
 
 def get_h5file(dx):
-    datafile = Path(dx.fname)
-    cachefile = datafile.with_name(datafile.stem + '_cache.hdf5')
+    if default_cache_file is not None:
+        cachefile = Path(default_cache_file)
+    elif dx.get('fname', None):
+        datafile = Path(dx.fname)
+        cachefile = datafile.with_name(datafile.stem + '_cache.hdf5')
+    else:
+        raise ValueError('Data has no `fname`, set `bg_cache.'
+                         'default_cache_file` to use the cache.')
     return tables.open_file(str(cachefile), mode='a')
 
 
+def remove_cache(dx):
+    """Remove all the cached background fits of the timestamps in `dx`."""
+    ph_times_hash = dx.ph_times_hash()
+    with get_h5file(dx) as h5file:
+        if 'background' not in h5file.root:
+            return
+        for group in list(h5file.root.background._f_iter_nodes()):
+            signature = bg_from_signature(group._v_attrs.signature)
+            if signature['ph_times_hash'] == ph_times_hash:
+                group._f_remove(recursive=True)
+
+
 def calc_bg_cache(dx, fun, time_s, tail_min_us, F_bg, error_metrics, fit_allph,
-                  recompute=False):
+                  recompute=False, mode='periods', window_s=None, n_jobs=1,
+                  auto_num_iter=1):
     """Cached version of `.calc_bg()` method."""
-    assert fun == exp_fit, 'Cache only supports the bg.exp_fit function.'
-    assert error_metrics is None, 'Cache only support `error_metrics=None`.'
-    bg_calc_kwargs = dict(time_s=time_s, tail_min_us=tail_min_us,
+    if getattr(background, fun.__name__, None) is not fun:
+        raise ValueError('Cache only supports functions in the '
+                         '`background` module.')
+    bg_calc_kwargs = dict(fun=fun, time_s=time_s, tail_min_us=tail_min_us,
                           F_bg=F_bg, error_metrics=error_metrics,
-                          fit_allph=fit_allph)
-    h5file = get_h5file(dx)
-    if _bg_is_cached(dx, h5file, bg_calc_kwargs) and not recompute:
-        # Background found in cache. Load it.
-        pprint(' * Loading BG rates from cache ... ')
-        bg, Lim, Ph_p, bg_auto_th_us0 = _load_bg_data(dx, bg_calc_kwargs, h5file)
-
-        bg_dict = dict(bg_fun=exp_fit, bg_ph_sel=Ph_sel('all'))     # fixed
-        bg_dict.update(bg=bg, Lim=Lim, Ph_p=Ph_p, bg_time_s=time_s)
-        if bg_calc_kwargs['tail_min_us'] == 'auto':
-            bg_dict['bg_auto_F_bg'] = bg_calc_kwargs['F_bg']
-            assert bg_auto_th_us0 is not None
-            bg_dict['bg_auto_th_us0'] = bg_auto_th_us0
+                          fit_allph=fit_allph, mode=mode, window_s=window_s,
+                          auto_num_iter=auto_num_iter)
+    with get_h5file(dx) as h5file:
+        if _bg_is_cached(dx, h5file, bg_calc_kwargs) and not recompute:
+            # Background found in cache. Load it.
+            pprint(' * Loading BG rates from cache ... ')
+            bg_dict = _load_bg_data(dx, bg_calc_kwargs, h5file)
+            dx._clean_bg_data()
+            dx.add(**bg_dict)
+            pprint(' [DONE]\n')
         else:
-            bg_dict['bg_th_us_user'] = tail_min_us
-        dx._clean_bg_data()
-        dx.add(**bg_dict)
-        pprint(' [DONE]\n')
-    else:
-        pprint(' * Computing BG rates:\n')
-        dx.calc_bg(fun=fun, **bg_calc_kwargs)
-        bg_auto_th_us0 = dx.get('bg_auto_th_us0', None)
-        _save_bg_data(dx, dx.bg, dx.Lim, dx.Ph_p, bg_calc_kwargs, h5file,
-                      bg_auto_th_us0=bg_auto_th_us0)
-        pprint(' [DONE]\n')
-    h5file.close()
+            pprint(' * Computing BG rates:\n')
+            dx.calc_bg(n_jobs=n_jobs, **bg_calc_kwargs)
+            _save_bg_data(dx, bg_calc_kwargs, h5file)
+            pprint(' [DONE]\n')
+
+
+def _bg_hash(d, ph_sel):
+    """Return an hash of the background used for burst search on `ph_sel`.
+
+    Returns None when the background has not been computed.
+    """
+    if 'bg' not in d:
+        return None
+    try:
+        bg_bs = d.bg_from(ph_sel)
+    except NotImplementedError:
+        return None
+    m = hashlib.md5()
+    for bg_ch, lim in zip(bg_bs, d.Lim):
+        m.update(np.ascontiguousarray(bg_ch, dtype=float).data)
+        m.update(np.ascontiguousarray(lim, dtype=np.int64).data)
+    return m.hexdigest()
+
+
+def _bs_group_name(d, bs_kwargs):
+    """Return the name of the group in /burst_search for `bs_kwargs`."""
+    signature = bs_to_signature(ph_times_hash=d.ph_times_hash(),
+                                bg_hash=_bg_hash(d, bs_kwargs['ph_sel']),
+                                **bs_kwargs)
+    return _signature_to_group_name(signature), signature
+
+
+def _save_bs_data(d, bs_kwargs, stream_counts, h5file):
+    """Save bursts (and optionally stream counts) in `d` to HDF5 file."""
+    group_name, signature = _bs_group_name(d, bs_kwargs)
+    _remove_cache_grp(h5file, group='/burst_search/' + group_name)
+    bs_group = h5file.create_group('/burst_search', group_name,
+                                   createparents=True)
+    bs_group._v_attrs.signature = signature
+    mburst_group = h5file.create_group(bs_group, 'mburst')
+    for ich, bursts in enumerate(d.mburst):
+        h5file.create_earray(mburst_group, 'ch%d' % ich, obj=bursts.data)
+    if stream_counts is not None:
+        _save_bs_stream_counts(stream_counts, bs_group, h5file)
+
+
+def _save_bs_stream_counts(stream_counts, bs_group, h5file):
+    """Save the per-channel `stream_counts` arrays in `bs_group`."""
+    counts_group = h5file.create_group(bs_group, 'stream_counts')
+    for ich, counts in enumerate(stream_counts):
+        h5file.create_earray(counts_group, 'ch%d' % ich, obj=counts)
+
+
+def _load_bs_data(d, bs_kwargs, h5file):
+    """Load bursts from a HDF5 file.
+
+    Returns a list of `Bursts` (one per channel) and the list of stream
+    counts arrays (None if not saved).
+    """
+    group_name, _ = _bs_group_name(d, bs_kwargs)
+    bs_group = h5file.get_node('/burst_search', group_name)
+
+    def read_channels(group):
+        return [group._f_get_child('ch%d' % ich).read()
+                for ich in range(d.nch)]
+
+    mburst = [Bursts(data) for data in read_channels(bs_group.mburst)]
+    stream_counts = None
+    if 'stream_counts' in bs_group:
+        stream_counts = read_channels(bs_group.stream_counts)
+    return mburst, stream_counts
+
+
+def _bs_is_cached(d, h5file, bs_kwargs):
+    """Returns True if the signature matches a group in /burst_search.
+    """
+    group_name, _ = _bs_group_name(d, bs_kwargs)
+    return ('burst_search' in h5file.root and
+            group_name in h5file.root.burst_search)
+
+
+def burst_search_cache(dx, L, m, F, P, min_rate_cps, ph_sel, compact,
+                       index_allph, c, computefret, max_rate, dither,
+                       pure_python, verbose, mute, pax, n_jobs=1,
+                       split_periods=True, recompute=False):
+    """Cached version of `.burst_search()` method."""
+    ph_sel = dx._fix_ph_sel(ph_sel)
+    if L is None:
+        L = m
+    bs_kwargs = dict(L=L, m=m, F=F, P=P, min_rate_cps=min_rate_cps,
+                     ph_sel=ph_sel, compact=compact, index_allph=index_allph,
+                     c=c, split_periods=split_periods)
+    with get_h5file(dx) as h5file:
+        if _bs_is_cached(dx, h5file, bs_kwargs) and not recompute:
+            # Bursts found in cache. Load them.
+            pprint(' * Loading bursts from cache ... ', mute)
+            mburst, stream_counts = _load_bs_data(dx, bs_kwargs, h5file)
+            dx.delete_burst_data()
+            if min_rate_cps is None:
+                dx._calc_T(m=m, P=P, F=F, ph_sel=ph_sel, c=c)
+            else:
+                rate_th = dx._param_as_mch_array(min_rate_cps)
+                dx.add(rate_th=rate_th, T=(m - 1 - c) / rate_th)
+            dx.add(mburst=mburst)
+            pprint(' [DONE]\n', mute)
+            dx._burst_search_finalize(m=m, L=L, ph_sel=ph_sel, mute=mute)
+            if computefret and stream_counts is None:
+                # Bursts were cached without counts: add them to the cache
+                dx.calc_ph_num(alex_all=True, pure_python=pure_python)
+                stream_counts = dx._ph_num_to_stream_counts()
+                group_name, _ = _bs_group_name(dx, bs_kwargs)
+                _save_bs_stream_counts(
+                    stream_counts, h5file.get_node('/burst_search', group_name),
+                    h5file)
+        else:
+            pprint(' * Computing bursts:\n', mute)
+            dx.burst_search(computefret=False, pure_python=pure_python,
+                            verbose=verbose, mute=mute, n_jobs=n_jobs,
+                            **bs_kwargs)
+            stream_counts = None
+            if computefret:
+                dx.calc_ph_num(alex_all=True, pure_python=pure_python)
+                stream_counts = dx._ph_num_to_stream_counts()
+            _save_bs_data(dx, bs_kwargs, stream_counts, h5file)
+    dx._burst_search_postprocess(
+        computefret=computefret, max_rate=max_rate, dither=dither,
+        pure_python=pure_python, mute=mute, pax=pax,
+        stream_counts=stream_counts)
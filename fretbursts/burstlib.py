@@ -23,12 +23,15 @@ from builtins import range, zip
 import os
 import hashlib
 import numbers
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import copy
 from numpy import zeros, size, r_
 import scipy.stats as SS
 
-from .utils.misc import pprint, clk_to_s, deprecate
+from .utils.misc import (pprint, clk_to_s, deprecate, LRUCache,
+                         map_processes)
 from .poisson_threshold import find_optimal_T_bga
 from . import fret_fit
 from . import bg_cache
@@ -36,9 +39,11 @@ from .ph_sel import Ph_sel
 from .fretmath import gamma_correct_E, gamma_uncorrect_E
 
 from .phtools import burstsearch as bslib
+from .phtools.ondisk import LazyArray, new_chunk_cache
 from .phtools.burstsearch import (
     # Burst search function
     bsearch,
+    bsearch_periods,
     # Photon counting function,
     mch_count_ph_in_bursts
 )
@@ -62,7 +67,94 @@ bg_calc_exp = deprecate(bg.exp_fit, 'bg_calc_exp', 'bg.exp_fit')
 bg_calc_exp_cdf = deprecate(bg.exp_cdf_fit, 'bg_calc_exp_cdf', 'bg.exp_cdf_fit')
 
 
-def _get_bsearch_func(pure_python=False):
+# Per-photon stream codes used to count the photons of all the streams in a
+# single pass (bit 0: acceptor emission, bit 1: acceptor excitation).
+# Photons not belonging to any stream have code STREAM_NONE.
+STREAM_CODES = {Ph_sel(Dex='Dem'): 0, Ph_sel(Dex='Aem'): 1,
+                Ph_sel(Aex='Dem'): 2, Ph_sel(Aex='Aem'): 3}
+STREAM_NONE = 255
+
+# Default memory budget (bytes) of the per-Data cache of photon masks and
+# selected timestamps (see `Data.set_ph_cache_size`)
+PH_CACHE_MAX_BYTES = 256 * 2**20
+
+# Photon selections of the boolean mask fields that can be stored as
+# stream codes (see `StreamMaskList`)
+STREAM_MASK_FIELDS = {'A_em': Ph_sel(Dex='Aem', Aex='Aem'),
+                      'D_em': Ph_sel(Dex='Dem', Aex='Dem'),
+                      'A_ex': Ph_sel(Aex='DAem'),
+                      'D_ex': Ph_sel(Dex='DAem')}
+
+
+def stream_lut(ph_sel):
+    """Return a lookup table to convert stream codes in a `ph_sel` mask.
+
+    The table is a boolean array of 256 elements whose element `code` is
+    True when photons with stream `code` (see `STREAM_CODES`) are
+    included in the photon selection `ph_sel`. Indexing the table with
+    an array of stream codes returns the photon mask for `ph_sel`.
+    """
+    lut = np.zeros(256, dtype=bool)
+    for stream, code in STREAM_CODES.items():
+        exc = 'Dex' if stream.Dex is not None else 'Aex'
+        lut[code] = getattr(ph_sel, exc) in (getattr(stream, exc), 'DAem')
+    return lut
+
+
+class StreamMaskList(object):
+    """List of per-channel photon masks computed from the stream codes.
+
+    This object replaces a list of boolean arrays (such as `Data.A_em`)
+    without storing them: the mask of channel `ich` is computed on access
+    as `stream_lut(ph_sel)[stream_codes[ich]]`.
+
+    Arguments:
+        stream_codes (list of arrays): per-photon stream codes (uint8),
+            one array per channel.
+        ph_sel (Ph_sel object): photon selection of the masks.
+    """
+    def __init__(self, stream_codes, ph_sel):
+        self.stream_codes = stream_codes
+        self.ph_sel = ph_sel
+        self._lut = stream_lut(ph_sel)
+
+    def __len__(self):
+        return len(self.stream_codes)
+
+    def __getitem__(self, ich):
+        if isinstance(ich, slice):
+            return [self[i] for i in range(len(self))[ich]]
+        return self._lut[self.stream_codes[ich]]
+
+    def __iter__(self):
+        for ich in range(len(self)):
+            yield self[ich]
+
+    def __repr__(self):
+        return 'StreamMaskList(ph_sel=%s, nch=%d)' % (self.ph_sel, len(self))
+
+
+def _get_bsearch_func(pure_python=False, engine=None):
+    """Return the low-level burst search function.
+
+    Arguments:
+        pure_python (bool): if True, return the pure python (loop) version.
+        engine (string or None): if not None, explicitly select the burst
+            search implementation. Valid values are 'python' (loop-based
+            :func:`bsearch_py`), 'numpy' (vectorized :func:`bsearch_np`)
+            and 'cython' (compiled `bsearch_c`, if available).
+            Overrides `pure_python`.
+    """
+    if engine is not None:
+        bsearch_engines = {'python': bslib.bsearch_py,
+                           'numpy': bslib.bsearch_np,
+                           'cython': getattr(bslib, 'bsearch_c', None)}
+        if engine not in bsearch_engines:
+            raise ValueError('Unknown burst search engine "%s".' % engine)
+        if bsearch_engines[engine] is None:
+            raise ValueError('Burst search engine "%s" is not available.'
+                             % engine)
+        return bsearch_engines[engine]
     if pure_python:
         # return the python version
         return bslib.bsearch_py
@@ -70,6 +162,15 @@ def _get_bsearch_func(pure_python=False):
         # or what is available
         return bsearch
 
+def _get_bsearch_periods_func(pure_python=False):
+    """Return the burst search function with per-period thresholds."""
+    if pure_python:
+        # return the python version
+        return bslib.bsearch_periods_py
+    else:
+        # or what is available
+        return bsearch_periods
+
 def _get_mch_count_ph_in_bursts_func(pure_python=False):
     if pure_python:
         # return the python version
@@ -78,6 +179,326 @@ def _get_mch_count_ph_in_bursts_func(pure_python=False):
         # or what is available
         return mch_count_ph_in_bursts
 
+def _map_channels(func, nch, n_jobs=1):
+    """Return the list `[func(ich) for ich in range(nch)]`.
+
+    When `n_jobs` is not 1, the calls are executed by a pool of `n_jobs`
+    threads (if `n_jobs` is None or < 1 use one thread per CPU).
+    The output order is always the channel order.
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1 or nch == 1:
+        return [func(ich) for ich in range(nch)]
+    with ThreadPoolExecutor(max_workers=min(n_jobs, nch)) as executor:
+        return list(executor.map(func, range(nch)))
+
+def _calc_bg_ch(ph_ch, masks, bins, fun, th_us, fit_allph, F_bg,
+                tail_min_us0, clk_p, error_metrics, auto_num_iter=1):
+    """Compute the background of one channel (see :meth:`Data.calc_bg`).
+
+    Arguments:
+        ph_ch (array): timestamps of the channel.
+        masks (dict): photon masks (bool arrays or slices) of the channel
+            for each stream in `Data.ph_streams` (in the same order).
+        bins (array): edges of the background periods in timestamps units.
+        th_us (dict): arrays of tail thresholds (one value per period) for
+            each stream. Not modified (a copy is returned).
+        tail_min_us0 (float or None): when not None, the threshold of the
+            initial fit used to compute 'auto' thresholds.
+        auto_num_iter (int): number of updates of the 'auto' thresholds.
+
+    Returns:
+        A tuple `(lim, ph_p, bg, bg_err, th_us)` for the channel, where
+        the last three are dicts with one array per stream.
+    """
+    # exp_fit without error metrics is computed for all the periods
+    # at once, other fitting functions are called for each period
+    batch_fit = fun is bg.exp_fit and error_metrics is None
+    kwargs = dict(clk_p=clk_p, error_metrics=error_metrics)
+    auto_th_kwargs = dict(clk_p=clk_p, tail_min_us=tail_min_us0)
+    bg_auto_th = tail_min_us0 is not None
+
+    def fit_auto_th(ph):
+        """Return the 'auto' threshold for the timestamps `ph`."""
+        _bg, _ = fun(ph, **auto_th_kwargs)
+        for i in range(auto_num_iter - 1):
+            _bg, _ = fun(ph, tail_min_us=1e6 * F_bg / _bg, clk_p=clk_p)
+        return 1e6 * F_bg / _bg
+    nperiods = bins.size - 1
+    streams_noall = [s for s in masks if s != Ph_sel('all')]
+    th_us = {sel: th.copy() for sel, th in th_us.items()}
+
+    lim, ph_p = [], []
+    bg_ch = {sel: np.zeros(nperiods) for sel in masks}
+    bg_err_ch = {sel: np.zeros(nperiods) for sel in masks}
+    if ph_ch.size == 0:
+        return lim, ph_p, bg_ch, bg_err_ch, th_us
+
+    counts, _ = np.histogram(ph_ch, bins=bins)
+    if batch_fit:
+        i1 = np.cumsum(counts)
+        i0 = i1 - counts
+        lim = list(zip(i0, i1 - 1))
+        ph_p = list(zip(ph_ch[i0], ph_ch[i1 - 1]))
+        _calc_bg_exp_fit_periods(ph_ch, masks, np.array(lim), bg_ch,
+                                 bg_err_ch, th_us, fit_allph, F_bg, clk_p,
+                                 tail_min_us0, auto_num_iter)
+        nperiods_loop = 0
+    else:
+        nperiods_loop = nperiods
+    i1 = 0
+    for ip in range(nperiods_loop):
+        i0 = i1
+        i1 += counts[ip]
+        lim.append((i0, i1 - 1))
+        ph_p.append((ph_ch[i0], ph_ch[i1 - 1]))
+        ph_i = ph_ch[i0:i1]
+
+        if fit_allph:
+            sel = Ph_sel('all')
+            if bg_auto_th:
+                th_us[sel][ip] = fit_auto_th(ph_i)
+            bg_ch[sel][ip], bg_err_ch[sel][ip] = \
+                fun(ph_i, tail_min_us=th_us[sel][ip], **kwargs)
+
+        for sel in streams_noall:
+            # This supports cases of D-only or A-only timestamps
+            # where self.A_em[ich] is a bool and not a bool-array
+            # In this case, the mask of either DexDem or DexAem is
+            # slice(None) (all-elements selection).
+            if isinstance(masks[sel], slice):
+                if masks[sel] == slice(None):
+                    bg_ch[sel][ip] = bg_ch[Ph_sel('all')][ip]
+                    bg_err_ch[sel][ip] = bg_err_ch[Ph_sel('all')][ip]
+                continue
+            else:
+                ph_i_sel = ph_i[masks[sel][i0:i1]]
+
+            if ph_i_sel.size > 10:
+                if bg_auto_th:
+                    th_us[sel][ip] = fit_auto_th(ph_i_sel)
+                bg_ch[sel][ip], bg_err_ch[sel][ip] = \
+                    fun(ph_i_sel, tail_min_us=th_us[sel][ip], **kwargs)
+
+    if not fit_allph:
+        bg_ch[Ph_sel('all')] += sum(bg_ch[s] for s in streams_noall)
+        bg_err_ch[Ph_sel('all')] += sum(bg_err_ch[s] for s in streams_noall)
+    return lim, ph_p, bg_ch, bg_err_ch, th_us
+
+
+def _calc_bg_exp_fit_periods(ph_ch, masks, lim, bg_ch, bg_err_ch, th_us,
+                             fit_allph, F_bg, clk_p, tail_min_us0=None,
+                             auto_num_iter=1):
+    """Fit with `bg.exp_fit` the background of all periods in one channel.
+
+    The results are written in the dicts `bg_ch`, `bg_err_ch` and (when
+    `tail_min_us0` is not None, i.e. for the 'auto' threshold) `th_us`,
+    with the same values computed by the period-by-period loop
+    in :func:`_calc_bg_ch`.
+    `lim` is a 2-D array of the (first, last) photon index for each
+    background period in `ph_ch`.
+    """
+    def fit_stream(sel, ph, starts, stops, fit_mask):
+        if tail_min_us0 is not None:
+            # Waiting-times are computed once for all the threshold updates
+            rates, num_tail, tail_min_auto = bg.exp_fit_periods_auto(
+                ph, starts, stops, tail_min_us0, F_bg, clk_p=clk_p,
+                num_iter=auto_num_iter)
+            th_us[sel][fit_mask] = tail_min_auto[fit_mask]
+        else:
+            rates, num_tail = bg.exp_fit_periods(ph, starts, stops,
+                                                 th_us[sel], clk_p=clk_p)
+        for ip in np.flatnonzero(fit_mask * (num_tail <= 10)):
+            # Not enough delays: let exp_fit raise the usual error
+            bg.exp_fit(ph[starts[ip]:stops[ip]], tail_min_us=th_us[sel][ip],
+                       clk_p=clk_p)
+        bg_ch[sel][fit_mask] = rates[fit_mask]
+        bg_err_ch[sel][fit_mask] = np.nan
+
+    starts, stops = lim[:, 0], lim[:, 1] + 1
+    all_ph = Ph_sel('all')
+    if fit_allph:
+        fit_mask = np.ones(starts.size, dtype=bool)
+        fit_stream(all_ph, ph_ch, starts, stops, fit_mask)
+
+    for sel, mask in masks.items():
+        if sel == all_ph:
+            continue
+        if isinstance(mask, slice):
+            # D-only or A-only timestamps (see _calc_bg_ch)
+            if mask == slice(None):
+                bg_ch[sel][:] = bg_ch[all_ph]
+                bg_err_ch[sel][:] = bg_err_ch[all_ph]
+            continue
+        index = np.flatnonzero(mask)
+        starts_sel = np.searchsorted(index, starts, side='left')
+        stops_sel = np.searchsorted(index, stops, side='left')
+        fit_mask = stops_sel - starts_sel > 10
+        fit_stream(sel, ph_ch[mask], starts_sel, stops_sel, fit_mask)
+
+
+def _calc_bg_ondisk_ch(ph_ch, masks, bins, th_us, fit_allph, F_bg,
+                       tail_min_us0, clk_p, chunksize, auto_num_iter=1):
+    """Compute the `bg.exp_fit` background of one channel reading the
+    on-disk timestamps in chunks (see :meth:`Data.calc_bg`).
+
+    The timestamps `ph_ch` (e.g. a PyTables array) are read in chunks of
+    `chunksize` photons with :func:`bg.exp_fit_periods_chunked`, one pass
+    for the fit (plus one for each update of the 'auto' threshold).
+    The results are the same
+    as :func:`_calc_bg_ch`. Arguments and returned values are also the
+    same as :func:`_calc_bg_ch`, with `fun = bg.exp_fit` and
+    `error_metrics = None`.
+    """
+    nperiods = bins.size - 1
+    all_ph = Ph_sel('all')
+    th_us = {sel: th.copy() for sel, th in th_us.items()}
+
+    lim, ph_p = [], []
+    bg_ch = {sel: np.zeros(nperiods) for sel in masks}
+    bg_err_ch = {sel: np.zeros(nperiods) for sel in masks}
+    if ph_ch.shape[0] == 0:
+        return lim, ph_p, bg_ch, bg_err_ch, th_us
+
+    # Streams with an empty selection (D-only or A-only timestamps)
+    # are not fitted, streams selecting all photons are copied from 'all'
+    fit_masks = {sel: mask for sel, mask in masks.items()
+                 if sel == all_ph or not isinstance(mask, slice)}
+    kwargs = dict(masks=fit_masks, clk_p=clk_p, chunksize=chunksize)
+    if tail_min_us0 is not None:
+        th_fit = {sel: tail_min_us0 for sel in fit_masks}
+        for i in range(auto_num_iter):
+            rates, _, counts = bg.exp_fit_periods_chunked(ph_ch, bins, th_fit,
+                                                          **kwargs)
+            with np.errstate(divide='ignore'):
+                th_fit = {sel: 1e6 * F_bg / rates[sel] for sel in fit_masks}
+        for sel in fit_masks:
+            if sel == all_ph and not fit_allph:
+                continue
+            fit_mask = counts[sel] > 10 if sel != all_ph else \
+                np.ones(nperiods, dtype=bool)
+            th_us[sel][fit_mask] = th_fit[sel][fit_mask]
+    rates, num_tail, counts = bg.exp_fit_periods_chunked(
+        ph_ch, bins, {sel: th_us[sel] for sel in fit_masks}, **kwargs)
+
+    i1 = np.cumsum(counts[all_ph])
+    i0 = i1 - counts[all_ph]
+    lim = list(zip(i0, i1 - 1))
+    ph_p = [(ph_ch[start], ph_ch[stop]) for start, stop in lim]
+    for sel, mask in masks.items():
+        if sel == all_ph and not fit_allph:
+            continue
+        if sel not in fit_masks:
+            if mask == slice(None):
+                bg_ch[sel][:] = bg_ch[all_ph]
+                bg_err_ch[sel][:] = bg_err_ch[all_ph]
+            continue
+        fit_mask = np.ones(nperiods, dtype=bool) if sel == all_ph else \
+            counts[sel] > 10
+        for ip in np.flatnonzero(fit_mask * (num_tail[sel] <= 10)):
+            # Not enough delays: let exp_fit raise the usual error
+            ph_ip = ph_ch[i0[ip]:i1[ip]]
+            if sel != all_ph:
+                ph_ip = ph_ip[mask[i0[ip]:i1[ip]]]
+            bg.exp_fit(ph_ip, tail_min_us=th_us[sel][ip], clk_p=clk_p)
+        bg_ch[sel][fit_mask] = rates[sel][fit_mask]
+        bg_err_ch[sel][fit_mask] = np.nan
+
+    if not fit_allph:
+        streams_noall = [s for s in masks if s != all_ph]
+        bg_ch[all_ph] += sum(bg_ch[s] for s in streams_noall)
+        bg_err_ch[all_ph] += sum(bg_err_ch[s] for s in streams_noall)
+    return lim, ph_p, bg_ch, bg_err_ch, th_us
+
+
+def _calc_bg_rolling_ch(ph_ch, masks, bins, window_clk, th_us, fit_allph,
+                        F_bg, tail_min_us0, clk_p, auto_num_iter=1):
+    """Compute the rolling background of one channel (see :meth:`Data.calc_bg`).
+
+    The rate of each period is fitted on a window of duration `window_clk`
+    centered on the period, using `bg.exp_fit_rolling`. The tail threshold
+    is constant for each stream: when `tail_min_us0` is not None ('auto'
+    threshold) it is `F_bg` times the mean waiting-time fitted on the whole
+    channel with threshold `tail_min_us0` (updated `auto_num_iter` times,
+    see :func:`bg.exp_fit_periods_auto`). Arguments and returned values are
+    the same as :func:`_calc_bg_ch`.
+    """
+    nperiods = bins.size - 1
+    streams_noall = [s for s in masks if s != Ph_sel('all')]
+    th_us = {sel: th.copy() for sel, th in th_us.items()}
+
+    lim, ph_p = [], []
+    bg_ch = {sel: np.zeros(nperiods) for sel in masks}
+    bg_err_ch = {sel: np.zeros(nperiods) for sel in masks}
+    if ph_ch.size == 0:
+        return lim, ph_p, bg_ch, bg_err_ch, th_us
+
+    counts, _ = np.histogram(ph_ch, bins=bins)
+    i1 = np.cumsum(counts)
+    i0 = i1 - counts
+    lim = list(zip(i0, i1 - 1))
+    ph_p = list(zip(ph_ch[i0], ph_ch[i1 - 1]))
+
+    # Window edges computed from the period edges (not from the period
+    # center) so that a window equal to the period gives exactly the bins
+    half = 0.5 * (np.diff(bins) - window_clk)
+    t_start, t_stop = bins[:-1] + half, bins[1:] - half
+    all_ph = Ph_sel('all')
+    for sel, mask in masks.items():
+        if sel == all_ph and not fit_allph:
+            continue
+        if sel != all_ph and isinstance(mask, slice):
+            # D-only or A-only timestamps (see _calc_bg_ch)
+            if mask == slice(None):
+                bg_ch[sel][:] = bg_ch[all_ph]
+                bg_err_ch[sel][:] = bg_err_ch[all_ph]
+            continue
+        ph = ph_ch[mask]
+        if ph.size <= 10:
+            continue
+        if tail_min_us0 is not None:
+            _, _, tail_min_auto = bg.exp_fit_periods_auto(
+                ph, [0], [ph.size], tail_min_us0, F_bg, clk_p=clk_p,
+                num_iter=auto_num_iter)
+            th_us[sel][:] = tail_min_auto[0]
+        rates, num_tail = bg.exp_fit_rolling(ph, t_start, t_stop,
+                                             th_us[sel][0], clk_p=clk_p)
+        fitted = num_tail > 10
+        if sel == all_ph and not fitted.all():
+            msg = ('Not enough photons to estimate the background in '
+                   '%d windows. Try a larger `window_s`.')
+            raise ValueError(msg % (~fitted).sum())
+        bg_ch[sel][fitted] = rates[fitted]
+        bg_err_ch[sel][fitted] = np.nan
+
+    if not fit_allph:
+        bg_ch[all_ph] += sum(bg_ch[s] for s in streams_noall)
+        bg_err_ch[all_ph] += sum(bg_err_ch[s] for s in streams_noall)
+    return lim, ph_p, bg_ch, bg_err_ch, th_us
+
+
+def _burst_period(istart, lim):
+    """Return the background period (int32 array) of each burst.
+
+    Arguments:
+        istart (array): index of the first photon of each burst.
+        lim (list or array): (first, last) photon index of each background
+            period (as in `Data.Lim`).
+
+    The period of each burst is found with a binary search of `istart` in
+    the index of the first photon of each period. Empty periods are
+    skipped. Bursts starting outside all the periods are assigned
+    to period 0.
+    """
+    lim = np.asarray(lim, dtype=np.int64).reshape(-1, 2)
+    period = np.searchsorted(lim[:, 0], istart, side='right') - 1
+    inside = period >= 0
+    inside[inside] = istart[inside] <= lim[period[inside], 1]
+    period[~inside] = 0
+    return period.astype(np.int32)
+
+
 def isarray(obj):
     """Test if the object support the array interface.
 
@@ -241,7 +662,7 @@ def fuse_bursts_direct(bursts, ms=0, clk_p=12.5e-9, verbose=True):
     """Fuse bursts separated by less than `ms` (milli-seconds).
 
     This function is a direct implementation using a single loop.
-    For a faster implementation see :func:`fuse_bursts_iter`.
+    For a faster implementation see :func:`fuse_bursts`.
 
     Parameters:
         bursts (BurstsGap object): bursts to be fused.
@@ -306,7 +727,8 @@ def fuse_bursts_iter(bursts, ms=0, clk_p=12.5e-9, verbose=True):
 
     This function calls iteratively :func:`b_fuse` until there are no more
     bursts to fuse. For a slower but more readable version see
-    :func:`fuse_bursts_direct`.
+    :func:`fuse_bursts_direct`, for a faster single-pass version see
+    :func:`fuse_bursts`.
 
     Parameters:
         bursts (BurstsGap object): bursts to be fused.
@@ -393,6 +815,64 @@ def b_fuse(bursts, ms=0, clk_p=12.5e-9):
     return new_burst
 
 
+def fuse_bursts(bursts, ms=0, clk_p=12.5e-9, verbose=True):
+    """Fuse bursts separated by less than `ms` (milli-secs).
+
+    This function fuses all the bursts in a single vectorized pass.
+    Groups of consecutive bursts to be fused are labeled with a cumulative
+    sum over the "new group" condition (`separation > max_delay`). Each
+    group gets start/istart of the first burst and stop/istop of the last
+    one, while gap and gap_counts (of the bursts and between them) are
+    summed with `np.add.reduceat`. The result is identical to
+    :func:`fuse_bursts_iter` and :func:`fuse_bursts_direct`.
+
+    Parameters:
+        bursts (BurstsGap object): bursts to be fused.
+            See `phtools.burstsearch` for details.
+        ms (float): minimum waiting time between bursts (in millisec).
+            Bursts closer than that will be fused in a single burst.
+        clk_p (float): clock period or timestamp units in seconds.
+        verbose (bool): if True print a summary of fused bursts.
+
+    Returns:
+        A BurstsGap object containing the new fused bursts.
+    """
+    bursts = bslib.BurstsGap(bursts.data)
+    init_nburst = bursts.num_bursts
+    if init_nburst < 2:
+        return bursts.copy()
+    max_delay_clk = (ms * 1e-3) / clk_p
+    new_group = bursts.separation > max_delay_clk
+    # Index of the first and last burst in each group of fused bursts
+    ifirst = np.hstack([(0,), np.flatnonzero(new_group) + 1])
+    ilast = np.hstack([ifirst[1:] - 1, (init_nburst - 1,)])
+
+    # gap and gap_counts between consecutive bursts (0 if overlapping)
+    gap = bursts.start[1:] - bursts.stop[:-1]
+    gap_counts = bursts.istart[1:] - bursts.istop[:-1] - 1  # yes it's -1
+    overlapping = bursts.istop[:-1] >= bursts.istart[1:]
+    gap[overlapping | new_group] = 0
+    gap_counts[overlapping | new_group] = 0
+    # the gap between burst i and i+1 is assigned to burst i + 1
+    gap = bursts.gap + np.hstack([(0,), gap])
+    gap_counts = bursts.gap_counts + np.hstack([(0,), gap_counts])
+
+    fused = np.zeros((ifirst.size, 6), dtype=np.int64)
+    fused[:, bslib.BurstsGap._i_istart] = bursts.istart[ifirst]
+    fused[:, bslib.BurstsGap._i_start] = bursts.start[ifirst]
+    fused[:, bslib.BurstsGap._i_istop] = bursts.istop[ilast]
+    fused[:, bslib.BurstsGap._i_stop] = bursts.stop[ilast]
+    fused[:, bslib.BurstsGap._i_gap] = np.add.reduceat(gap, ifirst)
+    fused[:, bslib.BurstsGap._i_gap_counts] = np.add.reduceat(gap_counts,
+                                                              ifirst)
+    fused_bursts = bslib.BurstsGap(fused)
+
+    delta_b = init_nburst - fused_bursts.num_bursts
+    pprint(" --> END Fused %d bursts (%.1f%%)\n\n" %
+           (delta_b, 100 * delta_b / init_nburst), mute=not verbose)
+    return fused_bursts
+
+
 def mch_fuse_bursts(MBurst, ms=0, clk_p=12.5e-9, verbose=True):
     """Multi-ch version of `fuse_bursts`. `MBurst` is a list of Bursts objects.
     """
@@ -405,8 +885,8 @@ def mch_fuse_bursts(MBurst, ms=0, clk_p=12.5e-9, verbose=True):
         if mb.num_bursts == 0:
             new_bursts = bslib.Bursts.empty()
         else:
-            new_bursts = fuse_bursts_iter(mb, ms=ms, clk_p=clk_p,
-                                          verbose=verbose)
+            new_bursts = fuse_bursts(mb, ms=ms, clk_p=clk_p,
+                                     verbose=verbose)
         new_mburst.append(new_bursts)
     return new_mburst
 
@@ -466,6 +946,11 @@ def delta(x):
     return x.max() - x.min()
 
 
+# Lock protecting the single-channel cache of on-disk timestamps
+# (see `Data.get_ph_times`) when channels are processed by multiple threads
+_ph_cache_lock = threading.Lock()
+
+
 def mask_empty(mask):
     """Returns True if `mask` is empty, otherwise False.
 
@@ -553,6 +1038,12 @@ class Data(DataContainer):
         D_ex, A_ex (list of boolean arrays):  **[ALEX-only]**
             boolean mask for `.ph_times_m[i]` during donor or acceptor
             excitation
+        stream_codes (list of arrays): optional list of uint8 arrays with
+            the photon stream of each timestamp (see `STREAM_CODES`).
+            When present, photon masks are computed from the stream codes
+            through lookup tables, and `A_em`, `D_em`, `A_ex`, `D_ex` can
+            be :class:`StreamMaskList` objects computing the boolean
+            masks on access (1 byte per photon instead of 4).
         D_ON, A_ON (2-element tuples of int ): **[ALEX-only]**
             start-end values for donor and acceptor excitation selection.
         alex_period (int): **[ALEX-only]**
@@ -651,7 +1142,7 @@ class Data(DataContainer):
     # Attribute names containing per-photon data.
     # Each attribute is a list (1 element per ch) of arrays (1 element
     # per photon).
-    ph_fields = ['ph_times_m', 'nanotimes', 'particles',
+    ph_fields = ['ph_times_m', 'nanotimes', 'particles', 'stream_codes',
                  'A_em', 'D_em', 'A_ex', 'D_ex']
 
     # Attribute names containing background data.
@@ -695,6 +1186,22 @@ class Data(DataContainer):
         init_kw.update(**kwargs)
         DataContainer.__init__(self, **init_kw)
 
+    def add(self, **kwargs):
+        """Adds or updates elements (attributes and/or dict entries). """
+        # Stream codes are not valid anymore when a mask field is replaced
+        if 'stream_codes' in self and 'stream_codes' not in kwargs:
+            if any(name in kwargs for name in STREAM_MASK_FIELDS):
+                self.delete('stream_codes')
+        if any(name in kwargs for name in self.ph_fields):
+            self.ph_cache_clear()
+        DataContainer.add(self, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        """Delete an element (attribute and/or dict entry). """
+        if any(name in args for name in self.ph_fields):
+            self.ph_cache_clear()
+        DataContainer.delete(self, *args, **kwargs)
+
     # def __getattr__(self, name):
     #     """Single-channel shortcuts for per-channel fields.
     #
@@ -741,15 +1248,27 @@ class Data(DataContainer):
     #
     def ph_times_hash(self, hash_name='md5', hexdigest=True):
         """Return an hash for the timestamps arrays.
+
+        In-memory and on-disk (PyTables) arrays with the same content have
+        the same hash. On-disk arrays are read in chunks of
+        `phtools.burstsearch.default_chunksize` timestamps.
+        The hexdigest is cached until the timestamps are changed
+        (see :meth:`ph_cache_clear`).
         """
+        if not hasattr(self, '_ph_times_hexdigest'):
+            self._ph_times_hexdigest = {}
+        if hexdigest and hash_name in self._ph_times_hexdigest:
+            return self._ph_times_hexdigest[hash_name]
         m = hashlib.new(hash_name)
-        for ph in self.iter_ph_times():
+        for ph in self.ph_times_m:
             if isinstance(ph, np.ndarray):
-                m.update(ph.data)
+                m.update(np.ascontiguousarray(ph).data)
             else:
-                # TODO Handle ph_times in PyTables files
-                raise NotImplementedError
+                chunksize = bslib.default_chunksize
+                for i in range(0, ph.shape[0], chunksize):
+                    m.update(np.ascontiguousarray(ph[i:i + chunksize]).data)
         if hexdigest:
+            self._ph_times_hexdigest[hash_name] = m.hexdigest()
             return m.hexdigest()
         else:
             return m
@@ -780,6 +1299,77 @@ class Data(DataContainer):
         else:
             return ph_sel.Dex == 'DAem'
 
+    ##
+    # Methods for the cache of photon masks and selected timestamps
+    #
+    def _get_ph_cache(self):
+        """Return the LRU cache of masks and timestamps (create it if needed).
+        """
+        with _ph_cache_lock:
+            if not hasattr(self, '_ph_sel_cache'):
+                self._ph_sel_cache = LRUCache(max_bytes=PH_CACHE_MAX_BYTES)
+            return self._ph_sel_cache
+
+    def ph_cache_info(self):
+        """Return a dict with statistics of the photon masks/timestamps cache.
+
+        The cache stores the arrays returned by :meth:`get_ph_mask` and
+        :meth:`get_ph_times` for photon selections other than all photons,
+        keyed by `(ich, ph_sel, compact)`. The dict keys are `hits`,
+        `misses`, `num_items`, `nbytes` (memory used by the cached arrays)
+        and `max_bytes` (memory budget).
+        """
+        return self._get_ph_cache().info()
+
+    def ph_cache_clear(self):
+        """Empty the cache of photon masks and selected timestamps.
+
+        The cache is automatically cleared when a per-photon field
+        (see `Data.ph_fields`) is changed with `.add()` or `.delete()`.
+        Call this method after modifying these arrays in-place.
+        This also resets the cached :meth:`ph_times_hash`.
+        """
+        if hasattr(self, '_ph_sel_cache'):
+            self._ph_sel_cache.clear()
+        if hasattr(self, '_ph_times_hexdigest'):
+            self._ph_times_hexdigest.clear()
+
+    def _get_chunk_cache(self):
+        """Return the LRU cache of the chunks of on-disk arrays.
+
+        The cache is shared by all the on-disk per-photon arrays
+        (see :class:`fretbursts.phtools.ondisk.LazyArray`).
+        """
+        with _ph_cache_lock:
+            if not hasattr(self, '_chunk_cache'):
+                self._chunk_cache = new_chunk_cache()
+            return self._chunk_cache
+
+    def chunk_cache_info(self):
+        """Return a dict with statistics of the on-disk chunks cache.
+
+        The dict keys are the same as :meth:`ph_cache_info`.
+        """
+        return self._get_chunk_cache().info()
+
+    def set_chunk_cache_size(self, max_bytes):
+        """Set the memory budget (in bytes) of the on-disk chunks cache.
+
+        The cache stores the decoded chunks of on-disk per-photon arrays
+        of all the channels. The default budget is
+        `phtools.ondisk.CHUNK_CACHE_MAX_BYTES`.
+        """
+        self._get_chunk_cache().set_max_bytes(max_bytes)
+
+    def set_ph_cache_size(self, max_bytes):
+        """Set the memory budget (in bytes) of the photon selection cache.
+
+        When the cached arrays exceed `max_bytes`, the least recently used
+        ones are discarded. Use 0 to disable the cache. The default budget
+        is `PH_CACHE_MAX_BYTES`.
+        """
+        self._get_ph_cache().set_max_bytes(max_bytes)
+
     def get_ph_mask(self, ich=0, ph_sel=Ph_sel('all')):
         """Returns a mask for `ph_sel` photons in channel `ich`.
 
@@ -787,6 +1377,9 @@ class Data(DataContainer):
         both cases they can be used to index the timestamps of the
         corresponding channel.
 
+        Boolean masks are cached (see :meth:`ph_cache_info`),
+        so they are returned as read-only arrays.
+
         Arguments:
             ph_sel (Ph_sel object): object defining the photon selection.
                 See :mod:`fretbursts.ph_sel` for details.
@@ -801,6 +1394,56 @@ class Data(DataContainer):
             #       (where a normal boolean array would)
             return slice(None)
 
+        cache = self._get_ph_cache()
+        key = ('ph_mask', ich, ph_sel)
+        mask = cache.get(key)
+        if mask is None:
+            mask = self._get_ph_mask(ich, ph_sel)
+            if not isinstance(mask, slice):
+                # Cached masks are shared by all the callers. A read-only
+                # view is used since the mask can be a per-photon field.
+                mask = mask.view()
+                mask.flags.writeable = False
+                cache.put(key, mask)
+        return mask
+
+    def get_ph_index(self, ich=0, ph_sel=Ph_sel('all')):
+        """Returns the index of `ph_sel` photons in channel `ich`.
+
+        The index is an int64 array equal to
+        `np.flatnonzero(self.get_ph_mask(ich, ph_sel))`, i.e. the position
+        of the selected photons in the full timestamps array. It is cached
+        together with the masks (see :meth:`ph_cache_info`) so it can be
+        reused, for example, to convert burst indexes with
+        :meth:`Bursts.recompute_index_expand`. It should not be modified
+        in-place.
+
+        Arguments:
+            ph_sel (Ph_sel object): object defining the photon selection.
+                See :mod:`fretbursts.ph_sel` for details.
+        """
+        cache = self._get_ph_cache()
+        key = ('ph_index', ich, ph_sel)
+        index = cache.get(key)
+        if index is None:
+            mask = self.get_ph_mask(ich, ph_sel=ph_sel)
+            if isinstance(mask, slice):
+                size = self.get_ph_times(ich).size
+                index = np.arange(size, dtype=np.int64)[mask]
+            else:
+                index = np.flatnonzero(mask).astype(np.int64, copy=False)
+            index.setflags(write=False)
+            cache.put(key, index)
+        return index
+
+    def _get_ph_mask(self, ich, ph_sel):
+        """Compute the mask for `ph_sel` photons in channel `ich` (no cache).
+        """
+
+        if self.alternated and self._has_stream_codes():
+            # A single table lookup instead of combining the boolean masks
+            return stream_lut(ph_sel)[self.stream_codes[ich]]
+
         # Handle the case when A_em contains slice objects
         if isinstance(self.A_em[ich], slice):
             if self.A_em[ich] == slice(None):
@@ -856,12 +1499,51 @@ class Data(DataContainer):
         for ich in range(self.nch):
             yield self.get_ph_mask(ich, ph_sel=ph_sel)
 
+    def _has_stream_codes(self):
+        """Return True if `stream_codes` are available for all channels."""
+        return 'stream_codes' in self and len(self.stream_codes) == self.nch
+
+    def _get_ph_stream_codes(self, ich=0):
+        """Return the array of per-photon stream codes (uint8) for `ich`.
+
+        The stream of each photon is encoded as in `STREAM_CODES`.
+        Photons not belonging to any stream have code `STREAM_NONE`.
+        Returns None when the photon masks are not arrays (e.g. for
+        D-only or A-only data). If the `stream_codes` field is present,
+        returns the stored array.
+        """
+        if self._has_stream_codes():
+            return self.stream_codes[ich]
+        a_em = self.get_A_em(ich)
+        if isinstance(a_em, slice):
+            return None
+        codes = a_em.astype(np.uint8)
+        if self.alternated:
+            d_em = self._get_ph_mask_single(ich, 'D_em')
+            a_ex, d_ex = self.get_A_ex(ich), self.get_D_ex(ich)
+            if any(isinstance(mask, slice) for mask in (d_em, a_ex, d_ex)):
+                return None
+            np.bitwise_or(codes, a_ex.view(np.uint8) << 1, out=codes)
+            valid = (d_em | a_em) & (d_ex | a_ex)
+            codes[~valid] = STREAM_NONE
+        return codes
+
+    def _is_ph_times_ondisk(self, ich=0):
+        """Return True if the timestamps of channel `ich` are on-disk."""
+        return not isinstance(self.ph_times_m[ich], np.ndarray)
+
     def get_ph_times(self, ich=0, ph_sel=Ph_sel('all'), compact=False):
         """Returns the timestamps array for channel `ich`.
 
         This method always returns in-memory arrays, even when ph_times_m
         is a disk-backed list of arrays.
 
+        Timestamps of photon selections other than all photons are
+        cached (see :meth:`ph_cache_info`) and returned as read-only arrays.
+        On-disk timestamps of all photons are loaded and cached in the
+        same LRU cache, for any number of channels within the memory budget
+        (see :meth:`set_ph_cache_size`).
+
         Arguments:
             ph_sel (Ph_sel object): object defining the photon selection.
                 See :mod:`fretbursts.ph_sel` for details.
@@ -869,20 +1551,35 @@ class Data(DataContainer):
                 period is required and the timestamps are "compacted" by
                 removing the "gaps" between each excitation period.
         """
+        mask = self.get_ph_mask(ich, ph_sel=ph_sel)
+        cached = compact or not isinstance(mask, slice)
+        if cached:
+            cache = self._get_ph_cache()
+            key = ('ph_times', ich, ph_sel, compact)
+            ph = cache.get(key)
+            if ph is not None:
+                return ph
+
         ph = self.ph_times_m[ich]
 
-        # If not a list is an on-disk array, we need to load it
+        # If not a list is an on-disk array, we need to load it.
+        # Loaded channels are kept in the (multi-channel) LRU cache.
         if not isinstance(ph, np.ndarray):
-            if hasattr(self, '_ph_cache') and self._ph_cache_ich == ich:
-                ph = self._ph_cache
-            else:
-                ph = ph.read()
-                self._ph_cache = ph
-                self._ph_cache_ich = ich
-
-        ph = ph[self.get_ph_mask(ich, ph_sel=ph_sel)]
+            cache = self._get_ph_cache()
+            key_all = ('ph_times', ich, Ph_sel('all'), False)
+            ph_all = cache.get(key_all)
+            if ph_all is None:
+                ph_all = np.asarray(ph[:])
+                ph_all.flags.writeable = False
+                cache.put(key_all, ph_all)
+            ph = ph_all
+
+        ph = ph[mask]
         if compact:
             ph = self._ph_times_compact(ph, ph_sel)
+        if cached:
+            ph.flags.writeable = False
+            cache.put(key, ph)
         return ph
 
     def iter_ph_times(self, ph_sel=Ph_sel('all'), compact=False):
@@ -1330,19 +2027,37 @@ class Data(DataContainer):
         assert time_s1 < self.time_max
 
         t1_clk, t2_clk = int(time_s1 / self.clk_p), int(time_s2 / self.clk_p)
-        masks = [(ph >= t1_clk) * (ph < t2_clk) for ph in self.iter_ph_times()]
+        # Timestamps are sorted: the photons in [t1, t2) are a range of
+        # indexes (found without loading on-disk timestamps)
+        ranges = [(ph.searchsorted(t1_clk), ph.searchsorted(t2_clk))
+                  for ph in self.ph_times_m]
+
+        def slice_array(a, i1, i2, shift=0):
+            if isinstance(a, slice):
+                return a
+            if isinstance(a, LazyArray):
+                # On-disk arrays are sliced without reading the data
+                return a.lazy_slice(i1, i2, shift=shift)
+            a = np.array(a[i1:i2])
+            if shift != 0:
+                a += shift
+            return a
 
         new_d = Data(**self)
         for name in self.ph_fields:
             if name in self:
-                new_d[name] = [a[mask] for a, mask in zip(self[name], masks)]
+                if isinstance(self[name], StreamMaskList):
+                    # `stream_codes` precedes the masks in `ph_fields`
+                    new_d[name] = StreamMaskList(new_d.stream_codes,
+                                                 self[name].ph_sel)
+                else:
+                    # Shift timestamps to start from 0 to avoid problems
+                    # with BG calc
+                    shift = -t1_clk if name == 'ph_times_m' else 0
+                    new_d[name] = [slice_array(a, i1, i2, shift)
+                                   for a, (i1, i2) in zip(self[name], ranges)]
                 setattr(new_d, name, new_d[name])
         new_d.delete_burst_data()
-
-        # Shift timestamps to start from 0 to avoid problems with BG calc
-        for ich in range(self.nch):
-            ph_i = new_d.get_ph_times(ich)
-            ph_i -= t1_clk
         new_d.s.append(s)
 
         # Delete eventual cached properties
@@ -1615,13 +2330,18 @@ class Data(DataContainer):
 
     def calc_bg_cache(self, fun, time_s=60, tail_min_us=500, F_bg=2,
                       error_metrics=None, fit_allph=True,
-                      recompute=False):
+                      recompute=False, mode='periods', window_s=None,
+                      n_jobs=1, auto_num_iter=1):
         """Compute time-dependent background rates for all the channels.
 
         This version is the cached version of :meth:`calc_bg`.
         This method tries to load the background data from a cache file.
         If a saved background data is not found, it computes
         the background and stores it to disk.
+        Cached results are identified by the timestamps content
+        (:meth:`ph_times_hash`) and by all the arguments of
+        :meth:`calc_bg`. Any function in the `background` module and
+        any `error_metrics` are supported.
 
         The arguments are the same as :meth:`calc_bg` with the only addition
         of `recompute` (bool) to force a background recomputation even if
@@ -1632,7 +2352,9 @@ class Data(DataContainer):
         bg_cache.calc_bg_cache(self, fun, time_s=time_s,
                                tail_min_us=tail_min_us, F_bg=F_bg,
                                error_metrics=error_metrics, fit_allph=fit_allph,
-                               recompute=recompute)
+                               recompute=recompute, mode=mode,
+                               window_s=window_s, n_jobs=n_jobs,
+                               auto_num_iter=auto_num_iter)
 
     def _get_auto_bg_th_arrays(self, F_bg=2, tail_min_us0=250):
         """Return a dict of threshold values for background estimation.
@@ -1683,7 +2405,8 @@ class Data(DataContainer):
         to avoid having old stale attributes of a previous background fit.
         """
         # Attributes specific of manual or 'auto' bg fit
-        field_list = ['bg_auto_th_us0', 'bg_auto_F_bg', 'bg_th_us_user']
+        field_list = ['bg_auto_th_us0', 'bg_auto_F_bg', 'bg_auto_num_iter',
+                      'bg_th_us_user', 'bg_window_s']
         for field in field_list:
             if field in self:
                 self.delete(field)
@@ -1706,7 +2429,8 @@ class Data(DataContainer):
         return int(nperiods)
 
     def calc_bg(self, fun, time_s=60, tail_min_us=500, F_bg=2,
-                error_metrics=None, fit_allph=True):
+                error_metrics=None, fit_allph=True, n_jobs=1,
+                mode='periods', window_s=None, auto_num_iter=1):
         """Compute time-dependent background rates for all the channels.
 
         Compute background rates for donor, acceptor and both detectors.
@@ -1735,6 +2459,36 @@ class Data(DataContainer):
             fit_allph (bool): if True (default) the background for the
                 all-photon is fitted. If False it is computed as the sum of
                 backgrounds in all the other streams.
+            n_jobs (int or None): number of processes used to fit the
+                channels in parallel. Timestamps and masks are passed to
+                the processes through shared memory and `fun` needs to be
+                picklable (e.g. a module-level function). If None or < 1
+                use one process per CPU. Default 1 (serial). The results
+                do not depend on `n_jobs`.
+            mode (string): if 'periods' (default) the background of each
+                period is fitted on the photons in the period. If 'rolling'
+                the background is fitted on a sliding window of duration
+                `window_s` centered on each period, so that `time_s` can be
+                small to obtain a finely sampled background (used as usual
+                by burst search and corrections). The 'rolling' mode
+                requires `fun = bg.exp_fit` and `error_metrics=None` and
+                uses one tail threshold per channel and stream (with 'auto',
+                fitted on the whole channel).
+            window_s (float, seconds): duration of the sliding window
+                when `mode='rolling'`.
+            auto_num_iter (int): when `tail_min_us` is 'auto', number of
+                times the threshold is updated as `F_bg / rate`, starting
+                from the initial estimation. Default 1. Values > 1 iterate
+                toward a self-consistent threshold. With `bg.exp_fit`
+                (and no `error_metrics`) the waiting-times are computed
+                only once for all the updates.
+
+        When the timestamps are on-disk (see `ondisk` in
+        :func:`fretbursts.loader.photon_hdf5`) and `fun = bg.exp_fit` with
+        `error_metrics=None` and `mode='periods'`, the timestamps are read
+        in chunks of `phtools.burstsearch.default_chunksize` photons
+        (see :func:`bg.exp_fit_periods_chunked`), so that the full arrays
+        are never loaded in memory. In this case `n_jobs` is ignored.
 
         The background estimation functions are defined in the module
         `background` (conventionally imported as `bg`).
@@ -1748,17 +2502,25 @@ class Data(DataContainer):
         Returns:
             None, all the results are saved in the object itself.
         """
+        if mode not in ('periods', 'rolling'):
+            raise ValueError("`mode` must be 'periods' or 'rolling'.")
+        if mode == 'rolling':
+            if fun is not bg.exp_fit or error_metrics is not None:
+                raise ValueError("mode='rolling' requires fun=bg.exp_fit "
+                                 "and error_metrics=None.")
+            if window_s is None or window_s <= 0:
+                raise ValueError("mode='rolling' requires `window_s` > 0.")
+        if auto_num_iter < 1:
+            raise ValueError("`auto_num_iter` must be >= 1.")
         pprint(" - Calculating BG rates ... ")
         self._clean_bg_data()
-        kwargs = dict(clk_p=self.clk_p, error_metrics=error_metrics)
         nperiods = self._get_num_periods(time_s)
-        streams_noall = [s for s in self.ph_streams if s != Ph_sel('all')]
 
         bg_auto_th = tail_min_us == 'auto'
         if bg_auto_th:
             tail_min_us0 = 250
-            self.add(bg_auto_th_us0=tail_min_us0, bg_auto_F_bg=F_bg)
-            auto_th_kwargs = dict(clk_p=self.clk_p, tail_min_us=tail_min_us0)
+            self.add(bg_auto_th_us0=tail_min_us0, bg_auto_F_bg=F_bg,
+                     bg_auto_num_iter=auto_num_iter)
             th_us = {}
             for key in self.ph_streams:
                 th_us[key] = np.zeros(nperiods)
@@ -1769,68 +2531,32 @@ class Data(DataContainer):
         bins = ((np.arange(nperiods + 1) * time_s + self.time_min) /
                 self.clk_p)
 
-        Lim, Ph_p = [], []
-        BG, BG_err = [], []
-        Th_us = []
-        for ich, ph_ch in enumerate(self.iter_ph_times()):
-            masks = {sel: self.get_ph_mask(ich, ph_sel=sel)
-                     for sel in self.ph_streams}
-
-            counts, _ = np.histogram(ph_ch, bins=bins)
-            lim, ph_p = [], []
-            bg = {sel: np.zeros(nperiods) for sel in self.ph_streams}
-            bg_err = {sel: np.zeros(nperiods) for sel in self.ph_streams}
-            if ph_ch.size == 0:
-                Lim.append(lim)
-                Ph_p.append(ph_p)
-                BG.append(bg)
-                BG_err.append(bg_err)
-                Th_us.append(th_us)
-                continue
-            i1 = 0
-            for ip in range(nperiods):
-                i0 = i1
-                i1 += counts[ip]
-                lim.append((i0, i1 - 1))
-                ph_p.append((ph_ch[i0], ph_ch[i1 - 1]))
-                ph_i = ph_ch[i0:i1]
-
-                if fit_allph:
-                    sel = Ph_sel('all')
-                    if bg_auto_th:
-                        _bg, _ = fun(ph_i, **auto_th_kwargs)
-                        th_us[sel][ip] = 1e6 * F_bg / _bg
-                    bg[sel][ip], bg_err[sel][ip] = \
-                        fun(ph_i, tail_min_us=th_us[sel][ip], **kwargs)
-
-                for sel in streams_noall:
-                    # This supports cases of D-only or A-only timestamps
-                    # where self.A_em[ich] is a bool and not a bool-array
-                    # In this case, the mask of either DexDem or DexAem is
-                    # slice(None) (all-elements selection).
-                    if isinstance(masks[sel], slice):
-                        if masks[sel] == slice(None):
-                            bg[sel][ip] = bg[Ph_sel('all')][ip]
-                            bg_err[sel][ip] = bg_err[Ph_sel('all')][ip]
-                        continue
-                    else:
-                        ph_i_sel = ph_i[masks[sel][i0:i1]]
-
-                    if ph_i_sel.size > 10:
-                        if bg_auto_th:
-                            _bg, _ = fun(ph_i_sel, **auto_th_kwargs)
-                            th_us[sel][ip] = 1e6 * F_bg / _bg
-                        bg[sel][ip], bg_err[sel][ip] = \
-                            fun(ph_i_sel, tail_min_us=th_us[sel][ip], **kwargs)
-
-            if not fit_allph:
-                bg[Ph_sel('all')] += sum(bg[s] for s in streams_noall)
-                bg_err[Ph_sel('all')] += sum(bg_err[s] for s in streams_noall)
-            Lim.append(lim)
-            Ph_p.append(ph_p)
-            BG.append(bg)
-            BG_err.append(bg_err)
-            Th_us.append(th_us)
+        # On-disk timestamps are read in chunks when fitting with exp_fit
+        ondisk = (self._is_ph_times_ondisk() and mode == 'periods' and
+                  fun is bg.exp_fit and error_metrics is None)
+
+        def iter_args():
+            for ich in range(self.nch):
+                masks = {sel: self.get_ph_mask(ich, ph_sel=sel)
+                         for sel in self.ph_streams}
+                ph = self.ph_times_m[ich] if ondisk else self.get_ph_times(ich)
+                yield ph, masks
+
+        kwargs = dict(bins=bins, th_us=th_us, fit_allph=fit_allph, F_bg=F_bg,
+                      tail_min_us0=tail_min_us0 if bg_auto_th else None,
+                      clk_p=self.clk_p, auto_num_iter=auto_num_iter)
+        if ondisk:
+            calc_bg_ch = _calc_bg_ondisk_ch
+            kwargs.update(chunksize=bslib.default_chunksize)
+            n_jobs = 1  # on-disk arrays cannot be passed to other processes
+        elif mode == 'rolling':
+            calc_bg_ch = _calc_bg_rolling_ch
+            kwargs.update(window_clk=window_s / self.clk_p)
+        else:
+            calc_bg_ch = _calc_bg_ch
+            kwargs.update(fun=fun, error_metrics=error_metrics)
+        res = map_processes(calc_bg_ch, iter_args(), n_jobs=n_jobs, **kwargs)
+        Lim, Ph_p, BG, BG_err, Th_us = (list(x) for x in zip(*res))
 
         # Make Dict Of Lists (DOL) from Lists of Dicts
         BG_dol, BG_err_dol, Th_us_dol = {}, {}, {}
@@ -1852,7 +2578,10 @@ class Data(DataContainer):
                  bg_fun=fun, bg_fun_name=fun.__name__,
                  bg_time_s=time_s, bg_ph_sel=Ph_sel('all'),
                  bg_auto_th=bg_auto_th,  # bool, True if the using auto-threshold
+                 bg_mode=mode,
                  )
+        if mode == 'rolling':
+            self.add(bg_window_s=window_s)
         pprint("[DONE]\n")
 
     @property
@@ -1904,14 +2633,8 @@ class Data(DataContainer):
         """Compute for each burst the "background period" `bp`.
         Background periods are the time intervals on which the BG is computed.
         """
-        P = []
-        for b, lim in zip(self.mburst, self.Lim):
-            p = zeros(b.num_bursts, dtype=np.int16)
-            if b.num_bursts > 0:
-                istart = b.istart
-                for i, (l0, l1) in enumerate(lim):
-                    p[(istart >= l0) * (istart <= l1)] = i
-            P.append(p)
+        P = [_burst_period(b.istart, lim)
+             for b, lim in zip(self.mburst, self.Lim)]
         self.add(bp=P)
 
     def _param_as_mch_array(self, par):
@@ -1982,7 +2705,7 @@ class Data(DataContainer):
 
     def _burst_search_rate(self, m, L, min_rate_cps, c=-1, ph_sel=Ph_sel('all'),
                            compact=False, index_allph=True, verbose=True,
-                           pure_python=False):
+                           pure_python=False, n_jobs=1, fused_count=False):
         """Compute burst search using a fixed minimum photon rate.
 
         The burst starts when, for `m` consecutive photons::
@@ -1992,66 +2715,127 @@ class Data(DataContainer):
         Arguments:
             min_rate_cps (float or array): minimum photon rate for burst start.
                 If array is one value per channel.
+            n_jobs (int): number of threads used to search the channels.
+            fused_count (bool): if True, count the photons of each stream
+                during the burst search (when possible).
+
+        Returns:
+            The list of per-stream photon counts in each burst (one array
+            per channel) when `fused_count` is True and the fused search
+            is possible, otherwise None.
         """
         bsearch = _get_bsearch_func(pure_python=pure_python)
+        bsearch_periods = _get_bsearch_periods_func(pure_python=pure_python)
+        fused_count = fused_count and self._is_fused_count(ph_sel, compact)
 
         Min_rate_cps = self._param_as_mch_array(min_rate_cps)
-        mburst = []
         T_clk = (m - 1 - c) / Min_rate_cps / self.clk_p
-        for ich, t_clk in enumerate(T_clk):
+
+        def _burst_search_ich(ich):
+            label = '%s CH%d' % (ph_sel, ich + 1) if verbose else None
+            if self._ondisk_burst_search(ich, ph_sel, compact, pure_python):
+                ph = self.ph_times_m[ich]
+                codes = self._get_ph_stream_codes(ich) if fused_count else None
+                burstarray = bslib.bsearch_periods_np(
+                    ph, L, m, [T_clk[ich]], [(0, ph.shape[0] - 1)],
+                    chunksize=bslib.default_chunksize, codes=codes,
+                    label=label, verbose=verbose)
+                if fused_count:
+                    burstarray, counts = burstarray
+                    return bslib.Bursts(burstarray), counts
+                return bslib.Bursts(burstarray)
+            if fused_count:
+                ph = self.get_ph_times(ich=ich)
+                burstarray, counts = bsearch_periods(
+                    ph, L, m, [T_clk[ich]], [(0, ph.size - 1)],
+                    codes=self._get_ph_stream_codes(ich), label=label,
+                    verbose=verbose)
+                return bslib.Bursts(burstarray), counts
             ph_bs = ph = self.get_ph_times(ich=ich, ph_sel=ph_sel)
             if compact:
                 ph_bs = self._ph_times_compact(ph, ph_sel)
-            label = '%s CH%d' % (ph_sel, ich + 1) if verbose else None
-            burstarray = bsearch(ph_bs, L, m, t_clk, label=label, verbose=verbose)
+            burstarray = bsearch(ph_bs, L, m, T_clk[ich], label=label,
+                                 verbose=verbose)
             if burstarray.size > 1:
                 bursts = bslib.Bursts(burstarray)
                 if compact:
                     bursts.recompute_times(ph, out=bursts)
             else:
                 bursts = bslib.Bursts.empty()
-            mburst.append(bursts)
+            return bursts
+
+        if self._is_ph_times_ondisk():
+            n_jobs = 1  # on-disk arrays cannot be read by multiple threads
+        mburst = _map_channels(_burst_search_ich, self.nch, n_jobs=n_jobs)
+        stream_counts = None
+        if fused_count:
+            mburst, stream_counts = zip(*mburst)
+            mburst, stream_counts = list(mburst), list(stream_counts)
         self.add(mburst=mburst, rate_th=Min_rate_cps, T=T_clk * self.clk_p)
         if ph_sel != Ph_sel('all') and index_allph:
             self._fix_mburst_from(ph_sel=ph_sel)
+        return stream_counts
 
     def _burst_search_TT(self, m, L, ph_sel=Ph_sel('all'), verbose=True,
                          compact=False, index_allph=True, pure_python=False,
-                         mute=False):
+                         mute=False, n_jobs=1, split_periods=True,
+                         fused_count=False):
         """Compute burst search with params `m`, `L` on ph selection `ph_sel`
 
         Requires the list of arrays `self.TT` with the max time-thresholds in
         the different burst periods for each channel (use `._calc_T()`).
+        Each channel is searched in a single pass switching the threshold
+        at the period boundaries (see `split_periods` in
+        :meth:`burst_search`). The channels are searched by `n_jobs` threads.
+
+        Returns:
+            The list of per-stream photon counts in each burst (one array
+            per channel) when `fused_count` is True and the fused search
+            is possible, otherwise None.
         """
-        bsearch = _get_bsearch_func(pure_python=pure_python)
+        if not split_periods and pure_python:
+            raise ValueError('Option split_periods=False requires '
+                             'pure_python=False.')
+        bsearch = _get_bsearch_periods_func(pure_python=pure_python)
+        fused_count = fused_count and self._is_fused_count(ph_sel, compact)
 
         self.recompute_bg_lim_ph_p(ph_sel=ph_sel, mute=mute)
-        MBurst = []
-        label = ''
-        for ich, T in enumerate(self.TT):
-            ph_bs = ph = self.get_ph_times(ich=ich, ph_sel=ph_sel)
-            if compact:
-                ph_bs = self._ph_times_compact(ph, ph_sel)
-            burstarray_ch_list = []
-            Tck = T / self.clk_p
-
-            for ip, (l0, l1) in enumerate(self.Lim[ich]):
-                if verbose:
-                    label = '%s CH%d-%d' % (ph_sel, ich + 1, ip)
-                burstarray = bsearch(ph_bs, L, m, Tck[ip], slice_=(l0, l1 + 1),
-                                     label=label, verbose=verbose)
-                if burstarray.size > 1:
-                    burstarray_ch_list.append(burstarray)
-
-            if len(burstarray_ch_list) > 0:
-                data = np.vstack(burstarray_ch_list)
-                bursts = bslib.Bursts(data)
+
+        def _burst_search_ich(ich):
+            label = '%s CH%d' % (ph_sel, ich + 1) if verbose else ''
+            codes = self._get_ph_stream_codes(ich) if fused_count else None
+            if self._ondisk_burst_search(ich, ph_sel, compact, pure_python):
+                burstarray = bslib.bsearch_periods_np(
+                    self.ph_times_m[ich], L, m, self.TT[ich] / self.clk_p,
+                    self.Lim[ich], split=split_periods,
+                    chunksize=bslib.default_chunksize, codes=codes,
+                    label=label, verbose=verbose)
+            else:
+                ph_bs = ph = self.get_ph_times(ich=ich, ph_sel=ph_sel)
+                if compact:
+                    ph_bs = self._ph_times_compact(ph, ph_sel)
+                burstarray = bsearch(ph_bs, L, m, self.TT[ich] / self.clk_p,
+                                     self.Lim[ich], split=split_periods,
+                                     codes=codes, label=label,
+                                     verbose=verbose)
+            if fused_count:
+                burstarray, counts = burstarray
+                return bslib.Bursts(burstarray), counts
+            if burstarray.size > 1:
+                bursts = bslib.Bursts(burstarray)
                 if compact:
                     bursts.recompute_times(ph, out=bursts)
             else:
                 bursts = bslib.Bursts.empty()
-            MBurst.append(bursts)
+            return bursts
 
+        if self._is_ph_times_ondisk():
+            n_jobs = 1  # on-disk arrays cannot be read by multiple threads
+        MBurst = _map_channels(_burst_search_ich, len(self.TT), n_jobs=n_jobs)
+        stream_counts = None
+        if fused_count:
+            MBurst, stream_counts = zip(*MBurst)
+            MBurst, stream_counts = list(MBurst), list(stream_counts)
         self.add(mburst=MBurst)
         if ph_sel != Ph_sel('all') and index_allph:
             # Convert the burst data to be relative to ph_times_m.
@@ -2059,6 +2843,34 @@ class Data(DataContainer):
             # to compute `.bp`.
             self.recompute_bg_lim_ph_p(ph_sel=Ph_sel('all'), mute=mute)
             self._fix_mburst_from(ph_sel=ph_sel, mute=mute)
+        return stream_counts
+
+    def _is_fused_count(self, ph_sel, compact):
+        """Return True if the photons of each stream can be counted during
+        the burst search on `ph_sel` (see `fused_count` in
+        :meth:`burst_search`).
+        """
+        if self._has_stream_codes():
+            return self._is_allph(ph_sel) and not compact
+        mask_names = ['A_em']
+        if self.alternated:
+            mask_names += ['D_em', 'A_ex', 'D_ex']
+        # Scalar masks (D-only or A-only data) have no shape
+        masks_are_arrays = all(len(getattr(mask, 'shape', ())) > 0
+                               for name in mask_names for mask in self[name])
+        return self._is_allph(ph_sel) and not compact and masks_are_arrays
+
+    def _ondisk_burst_search(self, ich, ph_sel, compact, pure_python):
+        """Return True when bursts in `ich` are searched streaming from disk.
+
+        Timestamps on-disk (see `ondisk` in
+        :func:`fretbursts.loader.photon_hdf5`) are read in chunks of
+        `phtools.burstsearch.default_chunksize` photons, without loading
+        the full array in memory. This is supported only for burst
+        search on all photons and without `compact`.
+        """
+        return (self._is_ph_times_ondisk(ich) and self._is_allph(ph_sel) and
+                not compact and not pure_python)
 
     def _fix_mburst_from(self, ph_sel, mute=False):
         """Convert burst data from any ph_sel to 'all' timestamps selection.
@@ -2066,16 +2878,17 @@ class Data(DataContainer):
         assert isinstance(ph_sel, Ph_sel) and not self._is_allph(ph_sel)
         pprint(' - Fixing  burst data to refer to ph_times_m ... ', mute)
 
-        for bursts, mask in zip(self.mburst,
-                                self.iter_ph_masks(ph_sel=ph_sel)):
-            bursts.recompute_index_expand(mask, out=bursts)
+        for ich, bursts in enumerate(self.mburst):
+            index = self.get_ph_index(ich, ph_sel=ph_sel)
+            bursts.recompute_index_expand(None, out=bursts, index=index)
 
         pprint('[DONE]\n', mute)
 
     def burst_search(self, L=None, m=10, F=6., P=None, min_rate_cps=None,
                      ph_sel=Ph_sel('all'), compact=False, index_allph=True,
                      c=-1, computefret=True, max_rate=False, dither=False,
-                     pure_python=False, verbose=False, mute=False, pax=False):
+                     pure_python=False, verbose=False, mute=False, pax=False,
+                     n_jobs=1, split_periods=True, fused_count=False):
         """Performs a burst search with specified parameters.
 
         This method performs a sliding-window burst search without
@@ -2143,6 +2956,22 @@ class Data(DataContainer):
                 Otherwise use the usual usALEX formula: ``na / na + nd``.
                 Quantities `nd`/`na` are D/A burst counts during D excitation
                 period, while `nda` is D emission during A excitation period.
+            n_jobs (int): number of threads used to search the channels
+                in parallel (multispot data). If None or -1 use one thread
+                per CPU. Default 1 (serial search). The result does not
+                depend on `n_jobs`.
+            split_periods (bool): if True (default), bursts are interrupted
+                at the boundaries of the background periods. If False, bursts
+                can span more than one background period (the burst search
+                threshold changes at the period boundaries but the burst
+                continues). Ignored when using `min_rate_cps`.
+            fused_count (bool): if True, the number of photons in each
+                stream (`nd`, `na`, `naa`, `nda`) is counted for each burst
+                during the burst search, in the same pass on the timestamps,
+                instead of scanning the bursts again for each stream
+                after the search. The result is the same. It has effect only
+                when `computefret` is True and the burst search is performed
+                on all photons without `compact`. Default False.
 
         Note:
             when using `P` or `F` the background rates are needed, so
@@ -2162,21 +2991,68 @@ class Data(DataContainer):
         self.delete_burst_data()
         if L is None:
             L = m
+        fused_count = fused_count and computefret
         if min_rate_cps is not None:
             # Saves rate_th in self
-            self._burst_search_rate(m=m, L=L, min_rate_cps=min_rate_cps, c=c,
-                                    ph_sel=ph_sel, compact=compact,
-                                    index_allph=index_allph,
-                                    verbose=verbose, pure_python=pure_python)
+            stream_counts = self._burst_search_rate(
+                m=m, L=L, min_rate_cps=min_rate_cps, c=c, ph_sel=ph_sel,
+                compact=compact, index_allph=index_allph, verbose=verbose,
+                pure_python=pure_python, n_jobs=n_jobs,
+                fused_count=fused_count)
         else:
             # Compute TT, saves P and F in self
             self._calc_T(m=m, P=P, F=F, ph_sel=ph_sel, c=c)
             # Use TT and compute mburst
-            self._burst_search_TT(L=L, m=m, ph_sel=ph_sel, compact=compact,
-                                  index_allph=index_allph, verbose=verbose,
-                                  pure_python=pure_python, mute=mute)
+            stream_counts = self._burst_search_TT(
+                L=L, m=m, ph_sel=ph_sel, compact=compact,
+                index_allph=index_allph, verbose=verbose,
+                pure_python=pure_python, mute=mute, n_jobs=n_jobs,
+                split_periods=split_periods, fused_count=fused_count)
         pprint("[DONE]\n", mute)
+        self._burst_search_finalize(m=m, L=L, ph_sel=ph_sel, mute=mute)
+        self._burst_search_postprocess(
+            computefret=computefret, max_rate=max_rate, dither=dither,
+            pure_python=pure_python, mute=mute, pax=pax,
+            stream_counts=stream_counts)
+
+    def burst_search_cache(self, L=None, m=10, F=6., P=None,
+                           min_rate_cps=None, ph_sel=Ph_sel('all'),
+                           compact=False, index_allph=True, c=-1,
+                           computefret=True, max_rate=False, dither=False,
+                           pure_python=False, verbose=False, mute=False,
+                           pax=False, n_jobs=1, split_periods=True,
+                           recompute=False):
+        """Performs a burst search, caching the bursts on disk.
+
+        This version is the cached version of :meth:`burst_search`.
+        This method tries to load the bursts from the cache file
+        (see :mod:`fretbursts.bg_cache`). If saved bursts are not found,
+        it performs the burst search and stores the bursts (and the
+        number of photons of each stream in each burst, when
+        `computefret` is True) to disk.
+        Cached results are identified by the timestamps content
+        (:meth:`ph_times_hash`), by the background used for burst search
+        (:meth:`bg_from`) and by the burst search arguments.
+
+        The arguments are the same as :meth:`burst_search` (except for
+        `fused_count`) with the only addition of `recompute` (bool) to
+        force a new burst search even if a cached version is found.
+
+        Returns:
+            None, all the results are saved in the `Data` object.
+        """
+        bg_cache.burst_search_cache(
+            self, L=L, m=m, F=F, P=P, min_rate_cps=min_rate_cps,
+            ph_sel=ph_sel, compact=compact, index_allph=index_allph, c=c,
+            computefret=computefret, max_rate=max_rate, dither=dither,
+            pure_python=pure_python, verbose=verbose, mute=mute, pax=pax,
+            n_jobs=n_jobs, split_periods=split_periods, recompute=recompute)
 
+    def _burst_search_finalize(self, m, L, ph_sel, mute):
+        """Compute the burst periods and save the burst search parameters.
+
+        Called after `mburst` has been computed (or loaded from the cache).
+        """
         pprint(" - Calculating burst periods ...", mute)
         self._calc_burst_period()                       # writes bp
         pprint("[DONE]\n", mute)
@@ -2190,15 +3066,17 @@ class Data(DataContainer):
         # without doing a new burst search
         self.add(bg_corrected=False, leakage_corrected=False,
                  dir_ex_corrected=False, dithering=False)
-        self._burst_search_postprocess(
-            computefret=computefret, max_rate=max_rate, dither=dither,
-            pure_python=pure_python, mute=mute, pax=pax)
 
     def _burst_search_postprocess(self, computefret, max_rate, dither,
-                                  pure_python, mute, pax):
+                                  pure_python, mute, pax, stream_counts=None):
         if computefret:
             pprint(" - Counting D and A ph and calculating FRET ... \n", mute)
-            self.calc_fret(count_ph=True, corrections=True, dither=dither,
+            count_ph = True
+            if stream_counts is not None:
+                # Photons in each stream already counted during burst search
+                self.calc_ph_num(alex_all=True, stream_counts=stream_counts)
+                count_ph = False
+            self.calc_fret(count_ph=count_ph, corrections=True, dither=dither,
                            mute=mute, pure_python=pure_python, pax=pax)
             pprint("   [DONE Counting D/A]\n", mute)
         if max_rate:
@@ -2206,7 +3084,28 @@ class Data(DataContainer):
             self.calc_max_rate(m=self.m)
             pprint("[DONE]\n", mute)
 
-    def calc_ph_num(self, alex_all=False, pure_python=False):
+    def _ph_num_to_stream_counts(self):
+        """Return the burst counts `nd`, `na`, `nda` and `naa` as stream
+        counts, i.e. one 2D array per channel with the number of photons
+        of each stream code (see `STREAM_CODES`) in each burst.
+
+        Counts not present in `self` are set to 0. Call this method
+        before applying any correction to the burst counts.
+        """
+        fields = {Ph_sel(Dex='Dem'): 'nd', Ph_sel(Dex='Aem'): 'na',
+                  Ph_sel(Aex='Dem'): 'nda', Ph_sel(Aex='Aem'): 'naa'}
+        stream_counts = []
+        for ich, bursts in enumerate(self.mburst):
+            counts = np.zeros((bursts.num_bursts, len(STREAM_CODES)),
+                              dtype=np.int64)
+            for ph_sel, field in fields.items():
+                if field in self:
+                    counts[:, STREAM_CODES[ph_sel]] = self[field][ich]
+            stream_counts.append(counts)
+        return stream_counts
+
+    def calc_ph_num(self, alex_all=False, pure_python=False,
+                    stream_counts=None):
         """Computes number of D, A (and AA) photons in each burst.
 
         Arguments:
@@ -2214,6 +3113,11 @@ class Data(DataContainer):
                 donor channel photons during acceptor excitation (`nda`)
             pure_python (bool): if True, uses the pure python functions even
                 when the optimized Cython functions are available.
+            stream_counts (list of arrays or None): if not None, the number
+                of photons of each stream code (see `STREAM_CODES`) in each
+                burst, one 2D array per channel, as computed by the fused
+                burst search (see `fused_count` in :meth:`burst_search`).
+                In this case the photons are not counted again.
 
         Returns:
             Saves `nd`, `na`, `nt` (and eventually `naa`, `nda`) in self.
@@ -2221,6 +3125,20 @@ class Data(DataContainer):
         """
         mch_count_ph_in_bursts = _get_mch_count_ph_in_bursts_func(pure_python)
 
+        def count_ph(ph_sel, em_masks, ex_masks=None):
+            """Number of photons in `ph_sel` (with the given masks)."""
+            if stream_counts is not None:
+                code = STREAM_CODES[ph_sel]
+                return [counts[:, code].astype(float)
+                        for counts in stream_counts]
+            if self.alternated and self._has_stream_codes():
+                Mask = self.iter_ph_masks(ph_sel=ph_sel)
+            elif ex_masks is not None:
+                Mask = [em * ex for em, ex in zip(em_masks, ex_masks)]
+            else:
+                Mask = em_masks
+            return mch_count_ph_in_bursts(self.mburst, Mask)
+
         if not self.alternated:
             nt = [b.counts.astype(float) if b.num_bursts > 0 else np.array([])
                   for b in self.mburst]
@@ -2234,25 +3152,19 @@ class Data(DataContainer):
                     nd, na = nt, n0    # D-only case
             else:
                 # This is the usual case with photons in both D and A channels
-                na = mch_count_ph_in_bursts(self.mburst, A_em)
+                na = count_ph(Ph_sel(Dex='Aem'), A_em)
                 nd = [t - a for t, a in zip(nt, na)]
             assert (nt[0] == na[0] + nd[0]).all()
         else:
             # The "new style" would be:
             #Mask = [m for m in self.iter_ph_masks(Ph_sel(Dex='Dem'))]
-            Mask = [d_em * d_ex for d_em, d_ex in zip(self.D_em, self.D_ex)]
-            nd = mch_count_ph_in_bursts(self.mburst, Mask)
-
-            Mask = [a_em * d_ex for a_em, d_ex in zip(self.A_em, self.D_ex)]
-            na = mch_count_ph_in_bursts(self.mburst, Mask)
-
-            Mask = [a_em * a_ex for a_em, a_ex in zip(self.A_em, self.A_ex)]
-            naa = mch_count_ph_in_bursts(self.mburst, Mask)
+            nd = count_ph(Ph_sel(Dex='Dem'), self.D_em, self.D_ex)
+            na = count_ph(Ph_sel(Dex='Aem'), self.A_em, self.D_ex)
+            naa = count_ph(Ph_sel(Aex='Aem'), self.A_em, self.A_ex)
             self.add(naa=naa)
 
             if alex_all or 'PAX' in self.meas_type:
-                Mask = [d_em * a_ex for d_em, a_ex in zip(self.D_em, self.A_ex)]
-                nda = mch_count_ph_in_bursts(self.mburst, Mask)
+                nda = count_ph(Ph_sel(Aex='Dem'), self.D_em, self.A_ex)
                 self.add(nda=nda)
 
             if self.ALEX:
@@ -219,7 +219,7 @@ def _load_bg_data(store, base_name, ph_streams):
 
 
 def calc_bg_brute_cache(dx, min_ph_delay_list=None, return_all=False,
-                        error_metrics='KS', force_recompute=False):
+                        error_metrics='KS', force_recompute=False, n_jobs=1):
     """Compute background for all the ch, ph_sel and periods caching results.
 
     This function performs a brute-force search of the min ph delay
@@ -240,6 +240,8 @@ def calc_bg_brute_cache(dx, min_ph_delay_list=None, return_all=False,
             See :func:`fretbursts.background.exp_fit` for more details.
         force_recompute (bool): if True, recompute results even if a cache
             is found.
+        n_jobs (int or None): number of processes used to fit the channels
+            in parallel (see :meth:`Data.calc_bg`). Default 1 (serial).
 
     Returns:
         Two arrays with best threshold (us) and best background. If
@@ -265,7 +267,8 @@ def calc_bg_brute_cache(dx, min_ph_delay_list=None, return_all=False,
     if not loaded:
         print(' - Computing BG')
         res = calc_bg_brute(dx, min_ph_delay_list=min_ph_delay_list,
-                            return_all=True, error_metrics=error_metrics)
+                            return_all=True, error_metrics=error_metrics,
+                            n_jobs=n_jobs)
         best_th, best_bg, BG_data, BG_data_e, min_ph_delays = res
         _store_bg_data(store, base_name, min_ph_delays, best_bg, best_th,
                        BG_data, BG_data_e)
@@ -277,7 +280,7 @@ def calc_bg_brute_cache(dx, min_ph_delay_list=None, return_all=False,
 
 
 def calc_bg_brute(dx, min_ph_delay_list=None, return_all=False,
-                  error_metrics='KS'):
+                  error_metrics='KS', n_jobs=1):
     """Compute background for all the ch, ph_sel and periods.
 
     This function performs a brute-force search of the min ph delay
@@ -293,6 +296,8 @@ def calc_bg_brute(dx, min_ph_delay_list=None, return_all=False,
             error functions. Default False.
         error_metrics (string): Specifies the error metric to use.
             See :func:`fretbursts.background.exp_fit` for more details.
+        n_jobs (int or None): number of processes used to fit the channels
+            in parallel (see :meth:`Data.calc_bg`). Default 1 (serial).
 
     Returns:
         Two arrays with best threshold (us) and best background. If
@@ -320,7 +325,7 @@ def calc_bg_brute(dx, min_ph_delay_list=None, return_all=False,
         # Shape: (nch, nperiods, len(thresholds))
         BG_data[ph_sel], BG_data_e[ph_sel] = bg.fit_varying_min_delta_ph(
             dx, min_ph_delay_list, bg_fit_fun=bg.exp_fit, ph_sel=ph_sel,
-            error_metrics=error_metrics)
+            error_metrics=error_metrics, n_jobs=n_jobs)
 
         # Compute the best Th and BG estimate for all ch and periods
         for ich in range(dx.nch):
@@ -430,10 +435,7 @@ def burst_photons(dx, skip_ch=None):
     ich = 0
     stream_map = {0: 'DexDem', 1: 'DexAem', 2: 'AexDem', 3: 'AexAem'}
     stream_dtype = CategoricalDtype(categories=stream_map.values())
-    if dx.alternated:
-        stream = (dx.A_ex[ich].view('int8') << 1) + dx.A_em[ich].view('int8')
-    else:
-        stream = dx.A_em[ich].view('int8')
+    stream = dx._get_ph_stream_codes(ich)
     times_arr = np.hstack(
         burstlib.iter_bursts_ph(dx.ph_times_m[ich], dx.mburst[ich]))
     stream_arr = np.hstack(
@@ -23,8 +23,11 @@ import tables
 
 from phconvert.smreader import load_sm
 from .dataload.spcreader import load_spc
-from .burstlib import Data
-from .utils.misc import selection_mask
+from .burstlib import (Data, StreamMaskList, STREAM_MASK_FIELDS,
+                       STREAM_CODES, STREAM_NONE)
+from .ph_sel import Ph_sel
+from .utils.misc import selection_mask, map_processes
+from .phtools.ondisk import LazyArray, new_chunk_cache, default_chunksize
 from . import loader_legacy
 import phconvert as phc
 
@@ -50,13 +53,20 @@ def _append_data_ch(d, name, value):
 
 
 def _load_from_group(d, group, name, dest_name, multich_field=False,
-                     ondisk=False, allow_missing=True):
+                     ondisk=False, allow_missing=True, index_range=None):
     if allow_missing and name not in group:
         return
 
     node_value = group._f_get_child(name)
+    if index_range is None:
+        index_range = (None, None)
     if not ondisk:
-        node_value = node_value.read()
+        node_value = node_value.read(*index_range)
+    elif node_value.ndim == 1:
+        # Per-photon arrays are read lazily in chunks
+        node_value = LazyArray(node_value, cache=d._get_chunk_cache())
+        if index_range != (None, None):
+            node_value = node_value.lazy_slice(*index_range)
     if multich_field:
         _append_data_ch(d, dest_name, node_value)
     else:
@@ -70,6 +80,7 @@ def _append_empy_ch(data):
 
     a_em = np.array([], dtype=bool)
     _append_data_ch(data, 'A_em', a_em)
+    _append_data_ch(data, 'stream_codes', a_em.view(np.uint8))
 
 
 def _get_measurement_specs(ph_data, setup):
@@ -147,8 +158,44 @@ def _get_measurement_specs(ph_data, setup):
     return meas_type, meas_specs
 
 
-def _load_photon_data_arrays(data, ph_data, ondisk=False):
+def _time_index_range(ph_data, time_s):
+    """Return the index range of the timestamps in the time window `time_s`.
+
+    `time_s` is a 2-tuple `(t1, t2)` in seconds (either can be None).
+    The range is found with a binary search of the on-disk timestamps
+    reading only one chunk and one timestamp per chunk.
+    """
+    timestamps = LazyArray(ph_data.timestamps, cache=new_chunk_cache())
+    clk_p = ph_data.timestamps_specs.timestamps_unit.read()
+    t1, t2 = time_s
+    i1 = 0 if t1 is None else timestamps.searchsorted(int(t1 / clk_p))
+    i2 = (timestamps.shape[0] if t2 is None else
+          timestamps.searchsorted(int(t2 / clk_p)))
+    return int(i1), int(i2)
+
+
+def _read_photon_data_arrays(filename, ph_data_name, time_s=None):
+    """Read the per-photon arrays of the group `ph_data_name` of a file.
+
+    Returns a dict of in-memory arrays with the Photon-HDF5 names.
+    This function opens its own file handle, so that it can be executed
+    in a worker process (see :func:`_photon_hdf5_multich`).
+    """
+    with tables.open_file(filename) as h5file:
+        ph_data = h5file.get_node(ph_data_name)
+        index_range = (None, None)
+        if time_s is not None:
+            index_range = _time_index_range(ph_data, time_s)
+        return {name: ph_data._f_get_child(name).read(*index_range)
+                for name in ph_data._v_leaves}
+
+
+def _load_photon_data_arrays(data, ph_data, ondisk=False, time_s=None,
+                             arrays=None):
     assert 'timestamps' in ph_data
+    index_range = None
+    if time_s is not None and arrays is None:
+        index_range = _time_index_range(ph_data, time_s)
 
     # Build mapping to convert Photon-HDF5 to FRETBursts names
     # fields not mapped use the same name on both Photon-HDF5 and FRETBursts
@@ -161,8 +208,13 @@ def _load_photon_data_arrays(data, ph_data, ondisk=False):
     # Load all photon-data arrays
     for name in ph_data._v_leaves:
         dest_name = mapping.get(name, name)
+        if arrays is not None:
+            # Arrays already read (see `_read_photon_data_arrays`)
+            _append_data_ch(data, dest_name, arrays[name])
+            continue
         _load_from_group(data, ph_data, name, dest_name=dest_name,
-                         multich_field=True, ondisk=ondisk)
+                         multich_field=True, ondisk=ondisk,
+                         index_range=index_range)
 
     # Timestamps are always present, and their units are always present too
     data.add(clk_p=ph_data.timestamps_specs.timestamps_unit.read())
@@ -224,10 +276,20 @@ def _compute_acceptor_emission_mask(data, ich, ondisk):
         raise NotImplementedError('Detectors dtype must be 1-byte.')
     donor, accept = data._det_donor_accept_multich[ich]
 
+    if ondisk:
+        # Compute the mask reading the detectors in chunks
+        detectors = data.detectors[ich]
+        a_em = [selection_mask(det, accept)
+                for _, det in detectors.iter_chunks()]
+        a_em = np.concatenate(a_em) if a_em else np.array([], dtype=bool)
+        _append_data_ch(data, 'A_em', a_em)
+        _append_data_ch(data, 'stream_codes', a_em.view(np.uint8))
+        return
+
     # Remove counts not associated with D or A channels
-    det_ich = data.detectors[ich][:]  # load the data in case ondisk = True
+    det_ich = data.detectors[ich][:]
     num_detectors = len(np.unique(det_ich))
-    if not ondisk and num_detectors > donor.size + accept.size:
+    if num_detectors > donor.size + accept.size:
         mask = (selection_mask(det_ich, donor) +
                 selection_mask(det_ich, accept))
         data.detectors[ich] = det_ich[mask]
@@ -236,7 +298,7 @@ def _compute_acceptor_emission_mask(data, ich, ondisk):
             data.nanotimes[ich] = data.nanotimes[ich][:][mask]
 
     # From `detectors` compute boolean mask `A_em`
-    if not ondisk and donor.size == 1 and 0 in (accept, donor):
+    if donor.size == 1 and 0 in (accept, donor):
         # In this case we create the boolean mask in-place
         # using the detectors array
         _append_data_ch(data, 'A_em', data.detectors[ich].view(dtype=bool))
@@ -247,8 +309,13 @@ def _compute_acceptor_emission_mask(data, ich, ondisk):
         _append_data_ch(data, 'A_em',
                         selection_mask(det_ich, accept))
 
+    # Without alternation the stream code (0: DexDem, 1: DexAem) is a
+    # view of the `A_em` mask
+    _append_data_ch(data, 'stream_codes', data.A_em[ich].view(np.uint8))
+
 
-def _photon_hdf5_1ch(h5data, data, ondisk=False, nch=1, ich=0, loadspecs=True):
+def _photon_hdf5_1ch(h5data, data, ondisk=False, nch=1, ich=0, loadspecs=True,
+                     time_s=None, arrays=None):
     data.add(nch=nch)
     ph_data_name = '/photon_data' if nch == 1 else '/photon_data%d' % ich
 
@@ -269,7 +336,8 @@ def _photon_hdf5_1ch(h5data, data, ondisk=False, nch=1, ich=0, loadspecs=True):
     data.add(spectral='smFRET-1color' not in meas_type)
 
     # Load photon_data arrays
-    _load_photon_data_arrays(data, ph_data, ondisk=ondisk)
+    _load_photon_data_arrays(data, ph_data, ondisk=ondisk, time_s=time_s,
+                             arrays=arrays)
 
     # If nanotimes are present load their specs
     if data.lifetime:
@@ -310,16 +378,31 @@ def _photon_hdf5_1ch(h5data, data, ondisk=False, nch=1, ich=0, loadspecs=True):
             _load_alex_periods_donor_acceptor(data, meas_specs)
 
 
-def _photon_hdf5_multich(h5data, data, ondisk=True):
+def _photon_hdf5_multich(h5data, data, ondisk=True, time_s=None, n_jobs=1):
     ph_times_dict = phc.hdf5.photon_data_mapping(h5data._v_file)
     nch = np.max(list(ph_times_dict.keys())) + 1
-    _photon_hdf5_1ch(h5data, data, ondisk=ondisk, nch=nch, ich=0)
-    for ich in range(1, nch):
+    arrays_list = [None] * nch
+    if not ondisk and n_jobs != 1:
+        # Read (and decompress) the per-photon arrays of the channels in
+        # parallel. Each worker process opens the file on its own, because
+        # the HDF5 library cannot be used concurrently by multiple threads.
+        filename = h5data._v_file.filename
+        channels = [ich for ich in range(nch)
+                    if '/photon_data%d' % ich in h5data]
+        args_list = [(filename, '/photon_data%d' % ich, time_s)
+                     for ich in channels]
+        res = map_processes(_read_photon_data_arrays, args_list,
+                            n_jobs=n_jobs)
+        for ich, arrays in zip(channels, res):
+            arrays_list[ich] = arrays
+    for ich in range(nch):
         _photon_hdf5_1ch(h5data, data, ondisk=ondisk, nch=nch, ich=ich,
-                         loadspecs=False)
+                         loadspecs=(ich == 0), time_s=time_s,
+                         arrays=arrays_list[ich])
 
 
-def photon_hdf5(filename, ondisk=False, require_setup=True, validate=False):
+def photon_hdf5(filename, ondisk=False, require_setup=True, validate=False,
+                time_s=None, n_jobs=1):
     """Load a data file saved in Photon-HDF5 format version 0.3 or higher.
 
     Photon-HDF5 is a format for a wide range of timestamp-based
@@ -331,12 +414,31 @@ def photon_hdf5(filename, ondisk=False, require_setup=True, validate=False):
         filename (str or pathlib.Path): path of the data file to be loaded.
         ondisk (bool): if True, do not load the timestamps in memory
             using instead references to the HDF5 arrays. Default False.
+            The per-photon arrays (`ph_times_m`, `nanotimes`, `detectors`,
+            ...) are :class:`fretbursts.phtools.ondisk.LazyArray` objects
+            reading the file in chunks, with a LRU cache of the decoded
+            chunks shared by all the channels
+            (see :meth:`Data.set_chunk_cache_size`). The per-photon
+            masks (1 byte per photon) are computed in memory reading the
+            detectors in chunks.
         require_setup (bool): if True (default) the input file need to
             have a setup group or won't be loaded. If False, accept files
             with missing setup group. Use False only for testing or
             DCR files.
         validate (bool): if True validate the Photon-HDF5 file on loading.
             If False skip any validation.
+        time_s (tuple or None): if not None, a 2-tuple `(t1, t2)` of times
+            in seconds (either can be None). Only the photons with
+            timestamps in [t1, t2) are loaded. The index range of each
+            channel is found with a binary search of the on-disk timestamps
+            and only this range of the per-photon arrays (timestamps,
+            detectors, nanotimes, particles) is read. Unlike
+            :meth:`Data.slice_ph`, timestamps are not shifted, so that
+            alternation periods can be applied as usual.
+        n_jobs (int or None): number of processes used to read and
+            decompress the channels of multi-spot files (if None or < 1
+            use one process per CPU). The loaded data does not depend on
+            `n_jobs`. Ignored when `ondisk` is True.
 
     Returns:
         :class:`fretbursts.burstlib.Data` object containing the data.
@@ -345,6 +447,8 @@ def photon_hdf5(filename, ondisk=False, require_setup=True, validate=False):
     assert os.path.isfile(filename), 'File not found.'
     version = phc.hdf5._check_version(filename)
     if version == u'0.2':
+        if time_s is not None:
+            raise NotImplementedError('`time_s` requires Photon-HDF5 0.3+.')
         return loader_legacy.hdf5(filename)
 
     h5file = tables.open_file(filename)
@@ -370,9 +474,10 @@ def photon_hdf5(filename, ondisk=False, require_setup=True, validate=False):
             d.add(**{field_name: h5data._f_get_child(field_name).read()})
 
     if _is_multich(h5data):
-        _photon_hdf5_multich(h5data, d, ondisk=ondisk)
+        _photon_hdf5_multich(h5data, d, ondisk=ondisk, time_s=time_s,
+                             n_jobs=n_jobs)
     else:
-        _photon_hdf5_1ch(h5data, d, ondisk=ondisk)
+        _photon_hdf5_1ch(h5data, d, ondisk=ondisk, time_s=time_s)
 
     return d
 
@@ -443,76 +548,116 @@ def usalex(fname, leakage=0, gamma=1., header=None, BT=None):
     return dx
 
 
+def _alex_period_lut(alex_period, D_ON, A_ON):
+    """Return the stream-code lookup table of the excitation period.
+
+    The table has `alex_period` elements (uint8), one for each value of the
+    phase `timestamp % alex_period`: the excitation bit of the stream code
+    (see :data:`fretbursts.burstlib.STREAM_CODES`) for phases in the donor
+    or acceptor excitation period and `STREAM_NONE` otherwise.
+    """
+    phase = np.arange(alex_period)
+    d_ex = _select_range(phase, alex_period, D_ON)
+    a_ex = _select_range(phase, alex_period, A_ON)
+    # Safety check: each ph is either D or A ex (not both)
+    assert not (d_ex * a_ex).any()
+    lut = np.full(alex_period, STREAM_NONE, dtype=np.uint8)
+    lut[d_ex] = STREAM_CODES[Ph_sel(Dex='Dem')]
+    lut[a_ex] = STREAM_CODES[Ph_sel(Aex='Dem')]
+    return lut
+
+
 def _usalex_apply_period_1ch(d, delete_ph_t=True, remove_d_em_a_ex=False,
-                             ich=0):
+                             ich=0, check=False, chunksize=None):
     """Applies to the Data object `d` the alternation period previously set.
 
     This function operates on a single-channel.
     See :func:`usalex_apply_period` for details.
+
+    The photons are classified and compacted in a single pass over the
+    input arrays, reading `chunksize` photons at a time: the excitation
+    period is found through a lookup table indexed by the phase
+    `(timestamp - offset) % alex_period` and the selected photons are
+    stored as timestamps and stream codes. The masks `D_em`, `A_em`,
+    `D_ex` and `A_ex` are :class:`fretbursts.burstlib.StreamMaskList`
+    objects. If `check` is True, run additional (full-array) consistency
+    checks on the result.
     """
+    if chunksize is None:
+        chunksize = default_chunksize
     donor_ch, accept_ch = d._det_donor_accept_multich[ich]
-    D_ON, A_ON = d._D_ON_multich[ich], d._A_ON_multich[ich]
-    # Remove eventual ch different from donor or acceptor
-    det_t = d.det_t[ich][:]
-    ph_times_t = d.ph_times_t[ich][:]
-    d_ch_mask_t = selection_mask(det_t, donor_ch)
-    a_ch_mask_t = selection_mask(det_t, accept_ch)
-    valid_det = d_ch_mask_t + a_ch_mask_t
-
-    # Build masks for excitation windows
-    if 'offset' in d:
-        ph_times_t -= d.offset
-    d_ex_mask_t = _select_range(ph_times_t, d.alex_period, D_ON)
-    a_ex_mask_t = _select_range(ph_times_t, d.alex_period, A_ON)
-    # Safety check: each ph is either D or A ex (not both)
-    assert not (d_ex_mask_t * a_ex_mask_t).any()
-
-    # Select alternation periods, removing transients and invalid detectors
-    DexAex_mask = (d_ex_mask_t + a_ex_mask_t) * valid_det
-
-    # Reduce photons to the DexAex_mask selection
-    ph_times = ph_times_t[DexAex_mask]
-    d_em = d_ch_mask_t[DexAex_mask]
-    a_em = a_ch_mask_t[DexAex_mask]
-    d_ex = d_ex_mask_t[DexAex_mask]
-    a_ex = a_ex_mask_t[DexAex_mask]
-    assert d_ex.sum() == d_ex_mask_t.sum()
-    assert a_ex.sum() == a_ex_mask_t.sum()
-
-    if remove_d_em_a_ex:
-        # Removes donor-ch photons during acceptor excitation
-        mask = a_em + d_em * d_ex
-        assert (mask == -(a_ex * d_em)).all()
-        ph_times = ph_times[mask]
-        d_em = d_em[mask]
-        a_em = a_em[mask]
-        d_ex = d_ex[mask]
-        a_ex = a_ex[mask]
-
-    assert d_em.sum() + a_em.sum() == ph_times.size
-    assert (d_em + a_em).all()       # masks fill the total array
-    assert not (d_em * a_em).any()   # no photon is both D and A
-    assert a_ex.size == a_em.size == d_ex.size == d_em.size == ph_times.size
-    _append_data_ch(d, 'ph_times_m', ph_times)
-    _append_data_ch(d, 'D_em', d_em)
-    _append_data_ch(d, 'A_em', a_em)
-    _append_data_ch(d, 'D_ex', d_ex)
-    _append_data_ch(d, 'A_ex', a_ex)
-    assert (len(d.ph_times_m) == len(d.D_em) == len(d.A_em) ==
-            len(d.D_ex) == len(d.A_ex) == ich + 1)
-
+    # No photon is both D and A
+    assert np.intersect1d(donor_ch, accept_ch).size == 0
+    alex_period = int(d.alex_period)
+    offset = d.offset if 'offset' in d else 0
+    ex_lut = _alex_period_lut(alex_period, d._D_ON_multich[ich],
+                              d._A_ON_multich[ich])
+    AexDem = STREAM_CODES[Ph_sel(Aex='Dem')]
+
+    ph_times_t, det_t = d.ph_times_t[ich], d.det_t[ich]
+    size = ph_times_t.shape[0]
+    # Output arrays are allocated once and shrunk at the end
+    ph_times = np.zeros(size, dtype=ph_times_t.dtype)
+    codes = np.zeros(size, dtype=np.uint8)
+    particles = None
     if 'particles_t' in d:
-        particles_t = d.particles_t[ich][:]
-        particles = particles_t[DexAex_mask]
-        _append_data_ch(d, 'particles', particles)
-
-    assert d.ph_times_m[ich].size == d.A_em[ich].size
-
+        particles_t = d.particles_t[ich]
+        particles = np.zeros(size, dtype=particles_t.dtype)
     if d.polarization:
-        # We also have polarization data
         p_pol_ch, s_pol_ch = d._det_p_s_pol_multich[ich]
-        p_em, s_em = _get_det_masks(det_t, p_pol_ch, s_pol_ch, DexAex_mask,
-                                    mask_ref=valid_det, ich=ich)
+        p_em, s_em = np.zeros(size, dtype=bool), np.zeros(size, dtype=bool)
+
+    n = 0
+    for start in range(0, size, chunksize):
+        stop = start + chunksize
+        ph = np.asarray(ph_times_t[start:stop])
+        det = np.asarray(det_t[start:stop])
+        if offset != 0:
+            ph = ph - offset
+        code = ex_lut[ph % alex_period]
+        a_em = selection_mask(det, accept_ch)
+        # Select alternation periods, removing transients and invalid det.
+        valid = (code != STREAM_NONE) * (a_em + selection_mask(det, donor_ch))
+        code |= a_em.view(np.uint8)
+        if remove_d_em_a_ex:
+            # Removes donor-ch photons during acceptor excitation
+            valid *= code != AexDem
+        num = np.count_nonzero(valid)
+        ph_times[n:n + num] = ph[valid]
+        codes[n:n + num] = code[valid]
+        if particles is not None:
+            particles[n:n + num] = np.asarray(particles_t[start:stop])[valid]
+        if d.polarization:
+            p_em[n:n + num] = selection_mask(det, p_pol_ch)[valid]
+            s_em[n:n + num] = selection_mask(det, s_pol_ch)[valid]
+        n += num
+
+    out_arrays = [ph_times, codes]
+    if particles is not None:
+        out_arrays.append(particles)
+    if d.polarization:
+        out_arrays += [p_em, s_em]
+    for array in out_arrays:
+        array.resize(n, refcheck=False)
+
+    if check:
+        assert (codes <= max(STREAM_CODES.values())).all()
+        # Excitation periods recomputed from the selected timestamps
+        assert np.array_equal(ex_lut[ph_times % alex_period],
+                              codes & AexDem)
+        if d.polarization:
+            assert (p_em + s_em).all()       # masks fill the total array
+            assert not (p_em * s_em).any()   # no photon is both channels
+
+    _append_data_ch(d, 'ph_times_m', ph_times)
+    _append_data_ch(d, 'stream_codes', codes)
+    # Boolean masks are computed from the stream codes on access
+    masks = {name: StreamMaskList(d.stream_codes, ph_sel)
+             for name, ph_sel in STREAM_MASK_FIELDS.items()}
+    d.add(stream_codes=d.stream_codes, **masks)
+    if particles is not None:
+        _append_data_ch(d, 'particles', particles)
+    if d.polarization:
         _append_data_ch(d, 'P_em', p_em)
         _append_data_ch(d, 'S_em', s_em)
 
@@ -522,7 +667,8 @@ def _usalex_apply_period_1ch(d, delete_ph_t=True, remove_d_em_a_ex=False,
     return d
 
 
-def usalex_apply_period(d, delete_ph_t=True, remove_d_em_a_ex=False):
+def usalex_apply_period(d, delete_ph_t=True, remove_d_em_a_ex=False,
+                        check=False):
     """Applies to the Data object `d` the alternation period previously set.
 
     Note that you first need to load the data in a variable `d` and then
@@ -541,11 +687,15 @@ def usalex_apply_period(d, delete_ph_t=True, remove_d_em_a_ex=False):
     Now `d` is ready for further processing such as background estimation,
     burst search, etc...
 
+    The alternation is applied in a single pass over the timestamps,
+    storing the photon streams as stream codes. If `check` is True, run
+    additional (full-array) consistency checks.
+
     *See also:* :func:`alex_apply_period`.
     """
     for ich in range(d.nch):
         _usalex_apply_period_1ch(d, remove_d_em_a_ex=remove_d_em_a_ex, ich=ich,
-                                 delete_ph_t=False)
+                                 delete_ph_t=False, check=check)
     if delete_ph_t:
         d.delete('ph_times_t')
         d.delete('det_t')
@@ -591,7 +741,7 @@ def nsalex(fname):
     return dx
 
 
-def nsalex_apply_period(d, delete_ph_t=True):
+def nsalex_apply_period(d, delete_ph_t=True, chunksize=None):
     """Applies to the Data object `d` the alternation period previously set.
 
     Note that you first need to load the data in a variable `d` and then
@@ -610,66 +760,122 @@ def nsalex_apply_period(d, delete_ph_t=True):
     Now `d` is ready for further processing such as background estimation,
     burst search, etc...
 
+    The excitation period of each photon is found with a lookup table
+    over the `tcspc_num_bins` nanotime bins, reading the input arrays in
+    chunks (so that on-disk arrays are never fully loaded) and storing the
+    photon streams as stream codes. Multi-spot data is supported.
+
     *See also:* :func:`alex_apply_period`.
     """
-    ich = 0   # we only support single-spot here
-    donor_ch, accept_ch = d._det_donor_accept_multich[ich]
-    D_ON_multi, A_ON_multi = d._D_ON_multich[ich], d._A_ON_multich[ich]
-    D_ON = [(D_ON_multi[i], D_ON_multi[i + 1])
-            for i in range(0, len(D_ON_multi), 2)]
-    A_ON = [(A_ON_multi[i], A_ON_multi[i + 1])
-            for i in range(0, len(A_ON_multi), 2)]
-    # Mask for donor + acceptor detectors (discard other detectors)
-    det_t = d.det_t[ich][:]
-    d_ch_mask_t = selection_mask(det_t, donor_ch)
-    a_ch_mask_t = selection_mask(det_t, accept_ch)
-    da_ch_mask_t = d_ch_mask_t + a_ch_mask_t
-
-    # Masks for excitation periods
-    d_ex_mask_t = np.zeros(d.nanotimes_t[ich].size, dtype='bool')
-    for d_on in D_ON:
-        d_ex_mask_t += (d.nanotimes_t[ich] > d_on[0]) * (d.nanotimes_t[ich] < d_on[1])
-
-    a_ex_mask_t = np.zeros(d.nanotimes_t[ich].size, dtype='bool')
-    for a_on in A_ON:
-        a_ex_mask_t += (d.nanotimes_t[ich] > a_on[0]) * (d.nanotimes_t[ich] < a_on[1])
-
-    ex_mask_t = d_ex_mask_t + a_ex_mask_t  # Select only ph during Dex or Aex
+    fields = ['ph_times_m', 'nanotimes', 'stream_codes']
+    if d.polarization:
+        fields += ['P_em', 'S_em']
+    data_ch = [_nsalex_apply_period_1ch(d, ich=ich, chunksize=chunksize)
+               for ich in range(d.nch)]
+    new_fields = {name: [res[name] for res in data_ch] for name in fields}
+    # Boolean masks are computed from the stream codes on access
+    for name, ph_sel in STREAM_MASK_FIELDS.items():
+        new_fields[name] = StreamMaskList(new_fields['stream_codes'], ph_sel)
+    d.add(alternation_applied=True, **new_fields)
 
-    # Total mask: D+A photons, and only during the excitation periods
-    valid = da_ch_mask_t * ex_mask_t  # logical AND
+    if delete_ph_t:
+        d.delete('ph_times_t')
+        d.delete('det_t')
+        d.delete('nanotimes_t')
 
-    # Apply selection to timestamps and nanotimes
-    ph_times = d.ph_times_t[ich][:][valid]
-    nanotimes = d.nanotimes_t[ich][:][valid]
 
-    # Apply selection to the emission masks
-    d_em = d_ch_mask_t[valid]
-    a_em = a_ch_mask_t[valid]
-    assert (d_em + a_em).all()       # masks fill the total array
-    assert not (d_em * a_em).any()   # no photon is both D and A
+def _nanotimes_lut(num_bins, D_ON, A_ON):
+    """Return the stream-code lookup table of the nanotime bins.
 
-    # Apply selection to the excitation masks
-    d_ex = d_ex_mask_t[valid]
-    a_ex = a_ex_mask_t[valid]
-    assert (d_ex + a_ex).all()
+    `D_ON` and `A_ON` are sequences of (start, stop) nanotime windows
+    (boundaries excluded). The table has `num_bins` elements (uint8):
+    the excitation bit of the stream code for bins in the donor or
+    acceptor excitation windows and `STREAM_NONE` otherwise.
+    """
+    nanot = np.arange(num_bins)
+    d_ex = np.zeros(num_bins, dtype=bool)
+    for d_on in D_ON:
+        d_ex += (nanot > d_on[0]) * (nanot < d_on[1])
+    a_ex = np.zeros(num_bins, dtype=bool)
+    for a_on in A_ON:
+        a_ex += (nanot > a_on[0]) * (nanot < a_on[1])
+    # Safety check: each ph is either D or A ex (not both)
     assert not (d_ex * a_ex).any()
+    lut = np.full(num_bins, STREAM_NONE, dtype=np.uint8)
+    lut[d_ex] = STREAM_CODES[Ph_sel(Dex='Dem')]
+    lut[a_ex] = STREAM_CODES[Ph_sel(Aex='Dem')]
+    return lut
 
-    d.add(ph_times_m=[ph_times], nanotimes=[nanotimes],
-          D_em=[d_em], A_em=[a_em], D_ex=[d_ex], A_ex=[a_ex],
-          alternation_applied=True)
 
-    if d.polarization:
-        # We also have polarization data
-        p_polariz_ch, s_polariz_ch = d._det_p_s_pol_multich[ich]
-        p_em, s_em = _get_det_masks(det_t, p_polariz_ch, s_polariz_ch, valid,
-                                    ich=ich)
-        d.add(P_em=[p_em], S_em=[s_em])
+def _nsalex_apply_period_1ch(d, ich=0, chunksize=None):
+    """Select the nsALEX photons of channel `ich` (see `nsalex_apply_period`).
 
-    if delete_ph_t:
-        d.delete('ph_times_t')
-        d.delete('det_t')
-        d.delete('nanotimes_t')
+    Returns a dict with the selected `ph_times_m`, `nanotimes` and
+    `stream_codes` arrays (and `P_em`, `S_em` for polarization data).
+    """
+    if chunksize is None:
+        chunksize = default_chunksize
+    donor_ch, accept_ch = d._det_donor_accept_multich[ich]
+    # No photon is both D and A
+    assert np.intersect1d(donor_ch, accept_ch).size == 0
+    D_ON_multi, A_ON_multi = d._D_ON_multich[ich], d._A_ON_multich[ich]
+    D_ON = [(D_ON_multi[i], D_ON_multi[i + 1])
+            for i in range(0, len(D_ON_multi), 2)]
+    A_ON = [(A_ON_multi[i], A_ON_multi[i + 1])
+            for i in range(0, len(A_ON_multi), 2)]
+    ph_times_t, det_t = d.ph_times_t[ich], d.det_t[ich]
+    nanotimes_t = d.nanotimes_t[ich]
+    size = ph_times_t.shape[0]
+    # `nanotimes_params` is a dict in files loaded by `loader_legacy`
+    nanotimes_params = d.nanotimes_params if 'nanotimes_params' in d else {}
+    if isinstance(nanotimes_params, list):
+        nanotimes_params = nanotimes_params[ich]
+    if 'tcspc_num_bins' in nanotimes_params:
+        num_bins = int(nanotimes_params['tcspc_num_bins'])
+    else:
+        # Max nanotime read in chunks (the array can be on disk)
+        num_bins = 1 + max([int(np.max(nanotimes_t[i:i + chunksize]))
+                            for i in range(0, size, chunksize)] or [0])
+    ex_lut = _nanotimes_lut(num_bins, D_ON, A_ON)
+
+    # Output arrays are allocated once and shrunk at the end
+    res = dict(ph_times_m=np.zeros(size, dtype=ph_times_t.dtype),
+               nanotimes=np.zeros(size, dtype=nanotimes_t.dtype),
+               stream_codes=np.zeros(size, dtype=np.uint8))
+    if d.polarization:
+        p_pol_ch, s_pol_ch = d._det_p_s_pol_multich[ich]
+        res.update(P_em=np.zeros(size, dtype=bool),
+                   S_em=np.zeros(size, dtype=bool))
+
+    n = 0
+    for start in range(0, size, chunksize):
+        stop = start + chunksize
+        det = np.asarray(det_t[start:stop])
+        nanot = np.asarray(nanotimes_t[start:stop])
+        # Nanotimes outside the table (>= tcspc_num_bins) are discarded
+        code = np.full(nanot.shape, STREAM_NONE, dtype=np.uint8)
+        in_range = (nanot >= 0) * (nanot < ex_lut.size)
+        code[in_range] = ex_lut[nanot[in_range]]
+        a_em = selection_mask(det, accept_ch)
+        # Total mask: D+A photons, and only during the excitation periods
+        valid = (code != STREAM_NONE) * (a_em + selection_mask(det, donor_ch))
+        code |= a_em.view(np.uint8)
+        num = np.count_nonzero(valid)
+        sel = slice(n, n + num)
+        res['ph_times_m'][sel] = np.asarray(ph_times_t[start:stop])[valid]
+        res['nanotimes'][sel] = nanot[valid]
+        res['stream_codes'][sel] = code[valid]
+        if d.polarization:
+            res['P_em'][sel] = selection_mask(det, p_pol_ch)[valid]
+            res['S_em'][sel] = selection_mask(det, s_pol_ch)[valid]
+        n += num
+
+    for array in res.values():
+        array.resize(n, refcheck=False)
+    if d.polarization:
+        assert (res['P_em'] + res['S_em']).all()  # masks fill the array
+        assert not (res['P_em'] * res['S_em']).any()
+    return res
 
 
 def _get_det_masks(det_t, det_ch1, det_ch2, valid, mask_ref=None, ich=0):
@@ -726,6 +932,7 @@ def alex_apply_period(d, delete_ph_t=True):
     else:
         apply_period_func = usalex_apply_period
     apply_period_func(d, delete_ph_t=delete_ph_t)
+    _add_stream_codes(d)
     msg = ('# Total photons (after ALEX selection):  {:12,}\n'
            '#  D  photons in D+A excitation periods: {:12,}\n'
            '#  A  photons in D+A excitation periods: {:12,}\n'
@@ -739,6 +946,31 @@ def alex_apply_period(d, delete_ph_t=True):
     print(msg.format(ph_data_size, D_em_sum, A_em_sum, D_ex_sum, A_ex_sum))
 
 
+def _add_stream_codes(d):
+    """Store the photon streams of alternated data as uint8 stream codes.
+
+    Adds the field `stream_codes` (one uint8 array per channel, see
+    :data:`fretbursts.burstlib.STREAM_CODES`) and replaces the boolean
+    masks `A_em`, `D_em`, `A_ex` and `D_ex` with
+    :class:`fretbursts.burstlib.StreamMaskList` objects computing the
+    masks from the stream codes on access.
+    Nothing is done if the boolean masks cannot be exactly represented
+    by the stream codes (e.g. photons in both excitation periods).
+    """
+    if d._has_stream_codes():
+        return
+    stream_codes = [d._get_ph_stream_codes(ich) for ich in range(d.nch)]
+    if any(codes is None for codes in stream_codes):
+        return
+    masks = {name: StreamMaskList(stream_codes, ph_sel)
+             for name, ph_sel in STREAM_MASK_FIELDS.items()}
+    for name, mask_list in masks.items():
+        for mask, mask_orig in zip(mask_list, d[name]):
+            if not np.array_equal(mask, mask_orig):
+                return
+    d.add(stream_codes=stream_codes, **masks)
+
+
 def sm_single_laser(fname):
     """Load SM files acquired using single-laser and 2 detectors.
     """
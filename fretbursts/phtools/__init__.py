@@ -8,5 +8,7 @@ Burst search and photon counting functions (to count number of donor and accepto
 photons in each burts) are provided both as a pure python implementation and as
 an optimized Cython (compiled) version. The cython version is usually 10 or 20
 times faster. `burstlib.py` will load the Cython functions, falling back to the
-pure python version if the compiled version is not found.
+pure python version if the compiled version is not found. For burst search,
+the fallback is a vectorized numpy implementation (`bsearch_np`) with a speed
+comparable to the Cython version.
 """
@@ -69,6 +69,9 @@ pd.set_option('display.max_rows', 10)
 #  LOW-LEVEL BURST SEARCH FUNCTIONS
 #
 
+# Number of timestamps read at once when searching bursts on on-disk arrays
+default_chunksize = 2**22
+
 def bsearch_py(times, L, m, T, slice_=None,
                label='Burst search', verbose=True):
     """Sliding window burst search. Pure python implementation.
@@ -102,8 +105,9 @@ def bsearch_py(times, L, m, T, slice_=None,
         i_time0 = slice_[0]
 
     bursts = []
-    above_min_rate = (times[m-1:] - times[:times.size-m+1]) <= T
+    above_min_rate = (times[m-1:] - times[:max(times.size-m+1, 0)]) <= T
 
+    above_min_rate_ = False
     it = enumerate(above_min_rate)
     for i, above_min_rate_ in it:
         if not above_min_rate_:
@@ -121,7 +125,9 @@ def bsearch_py(times, L, m, T, slice_=None,
         # Correct burst-stop off by 1 when last burst does not finish
         i_stop += 1
         if i_stop - i_start + 1 >= L:
-            bursts.pop()
+            if i_stop - i_start >= L:
+                # Last burst was already appended with the wrong i_stop
+                bursts.pop()
             bursts.append((i_start, i_stop, times[i_start], times[i_stop]))
 
     bursts = np.array(bursts, dtype='int64')
@@ -131,6 +137,219 @@ def bsearch_py(times, L, m, T, slice_=None,
     return bursts
 
 
+def bsearch_np(times, L, m, T, slice_=None,
+               label='Burst search', verbose=True):
+    """Sliding window burst search. Vectorized (numpy) implementation.
+
+    Same algorithm and output of :func:`bsearch_py` (and of the Cython
+    version `bsearch_c`) but without any python loop over the photons.
+    Burst starts and stops are the edges of the runs of consecutive
+    `True` values in the "rate above threshold" boolean array.
+    This function is used as fallback when the Cython extension is not
+    available.
+
+    Arguments:
+        times (array, int64): array of timestamps on which to perform the search
+        L (int): minimum number of photons in a bursts. Bursts with size
+            (or counts) < L are discarded.
+        m (int): number of consecutive photons used to compute the rate.
+        T (float): max time separation of `m` photons to be inside a burst
+        slice_ (tuple): 2-element tuple used to slice times
+        label (string): a label printed when the function is called
+        verbose (bool): if False, the function does not print anything.
+
+    Returns:
+        Array of burst data Nx4, type int64.
+        Column order is: istart, istop, start, stop.
+    """
+    if verbose:
+        pprint('Numpy search (v): %s\n' % label)
+
+    i_time0 = 0
+    if slice_ is not None:
+        times = times[slice_[0]:slice_[1]]
+        i_time0 = slice_[0]
+
+    num_mdelays = max(times.size - m + 1, 0)
+    above_min_rate = np.zeros(num_mdelays + 2, dtype=bool)
+    above_min_rate[1:-1] = (times[m-1:] - times[:num_mdelays]) <= T
+    return _bursts_from_above_min_rate(times, above_min_rate, L, m,
+                                       i_time0=i_time0)
+
+
+def _bursts_from_above_min_rate(times, above_min_rate, L, m, i_time0=0):
+    """Return the Nx4 burst array from the "rate above threshold" array.
+
+    Arguments:
+        times (array, int64): timestamps on which the search is performed.
+        above_min_rate (bool array): array of size `times.size - m + 3`
+            (one element per m-delay plus one `False` on each side)
+            marking the m-photon windows with rate above the threshold.
+        L, m (int): burst search parameters (see :func:`bsearch_py`).
+        i_time0 (int): offset added to `istart` and `istop`.
+    """
+    # Edges of the runs of True values: even edges are the burst starts
+    # and odd edges are the first index after each run. The padding with
+    # False on both sides guarantees that every run is closed.
+    edges = np.flatnonzero(above_min_rate[1:] != above_min_rate[:-1])
+    i_start = edges[::2]
+    # For a run ending with the last m-delay, `i_start + m - 2` is the
+    # last timestamp, which is the end-of-array correction of `bsearch_py`
+    i_stop = edges[1::2] + (m - 2)
+    valid = (i_stop - i_start + 1) >= L
+    i_start, i_stop = i_start[valid], i_stop[valid]
+
+    bursts = np.zeros((i_start.size, 4), dtype='int64')
+    bursts[:, 0] = i_start + i_time0
+    bursts[:, 1] = i_stop + i_time0
+    bursts[:, 2] = times[i_start]
+    bursts[:, 3] = times[i_stop]
+    return bursts
+
+
+def _lim_as_arrays(lim):
+    """Return arrays of first and last photon index from a list of pairs."""
+    lim = np.asarray(lim, dtype='int64').reshape(-1, 2)
+    return lim[:, 0].copy(), lim[:, 1].copy()
+
+
+def bsearch_periods_py(times, L, m, TT, lim, split=True, codes=None,
+                       num_codes=4, label='Burst search', verbose=True):
+    """Sliding window burst search with a different threshold in each period.
+
+    This is the reference implementation calling :func:`bsearch_py` on
+    the timestamps of each period (it supports only `split=True`).
+    See :func:`bsearch_periods_np` for the description of the arguments.
+    """
+    assert split, 'The python version supports only split=True.'
+    burstarray_list = []
+    for ip, (l0, l1) in enumerate(lim):
+        burstarray = bsearch_py(times, L, m, TT[ip], slice_=(l0, l1 + 1),
+                                label='%s-%d' % (label, ip), verbose=verbose)
+        if burstarray.size > 1:
+            burstarray_list.append(burstarray)
+    if len(burstarray_list) == 0:
+        bursts = np.zeros((0, 4), dtype='int64')
+    else:
+        bursts = np.vstack(burstarray_list)
+    if codes is None:
+        return bursts
+    return bursts, count_codes_in_bursts(bursts, codes, num_codes)
+
+
+def bsearch_periods_np(times, L, m, TT, lim, split=True, chunksize=None,
+                       codes=None, num_codes=4, label='Burst search',
+                       verbose=True):
+    """Sliding window burst search with a different threshold in each period.
+
+    Single-pass version of calling the burst search on each background
+    period, using for each period the corresponding threshold `TT[ip]`.
+    The threshold of an m-photons window is the one of the period
+    containing the first photon of the window.
+    Vectorized (numpy) implementation.
+
+    When `chunksize` is not None, the timestamps are read and processed
+    in chunks of `chunksize` elements, carrying any open burst across
+    chunk boundaries. In this case `times` can be any array supporting
+    slicing (e.g. an on-disk PyTables array) and the memory used is
+    proportional to `chunksize`. The result does not depend on `chunksize`.
+
+    Arguments:
+        times (array, int64): array of timestamps on which to perform the search
+        L (int): minimum number of photons in a bursts. Bursts with size
+            (or counts) < L are discarded.
+        m (int): number of consecutive photons used to compute the rate.
+        TT (array of floats): max time separation of `m` photons to be
+            inside a burst, one value per period (in timestamps units).
+        lim (list of tuples): index of first and last timestamp in each
+            period (same format as `Data.Lim[ich]`).
+        split (bool): if True, bursts are interrupted at the period
+            boundaries (the result is identical to a separate search in
+            each period). If False, bursts can span different periods.
+        chunksize (int or None): number of m-photons windows processed
+            at once. If None, process the full array at once.
+        codes (array of uint8 or None): if not None, a per-photon stream
+            code (same size as `times`). The photons of each code are
+            counted in each burst (see :func:`count_codes_in_bursts`).
+        num_codes (int): number of stream codes to be counted. Photons with
+            `codes >= num_codes` are not counted.
+        label (string): a label printed when the function is called
+        verbose (bool): if False, the function does not print anything.
+
+    Returns:
+        Array of burst data Nx4, type int64.
+        Column order is: istart, istop, start, stop.
+        If `codes` is not None, returns a tuple with the burst data and
+        an array of shape (N, num_codes) (int64) with the photon counts
+        for each code.
+    """
+    if verbose:
+        pprint('Numpy search (v): %s\n' % label)
+    lim_start, lim_stop = _lim_as_arrays(lim)
+    # Windows (index of the first photon) are in [w_first, w_end)
+    w_first = lim_start[0]
+    w_end = max(min(lim_stop[-1] + 1, times.shape[0]) - m + 1, w_first)
+    if chunksize is None:
+        chunksize = max(w_end - w_first, 1)
+
+    bursts_list = []
+    open_start, open_start_time = None, None
+    for w0 in range(w_first, w_end, chunksize):
+        w1 = min(w0 + chunksize, w_end)
+        buf = np.asarray(times[w0:w1 + m - 1])
+
+        # Element k + 1 is for window w0 + k, element 0 is the last
+        # window of the previous chunk (True when a burst is open)
+        above_min_rate = np.zeros(w1 - w0 + 2, dtype=bool)
+        above_min_rate[0] = open_start is not None
+        ip0, ip1 = np.searchsorted(lim_stop, [w0, w1 - 1])
+        for ip in range(ip0, min(ip1 + 1, lim_stop.size)):
+            # Windows using the threshold of period `ip`. When splitting
+            # the search only windows fully contained in the period are
+            # considered, the others are below threshold.
+            l0 = max(lim_start[ip], w0) - w0
+            l1 = min(lim_stop[ip] + (2 - m if split else 1), w1) - w0
+            if l1 <= l0:
+                continue
+            mdelays = buf[l0 + m - 1:l1 + m - 1] - buf[l0:l1]
+            above_min_rate[l0 + 1:l1 + 1] = mdelays <= TT[ip]
+
+        edges = np.flatnonzero(above_min_rate[1:] != above_min_rate[:-1]) + w0
+        if open_start is not None:
+            i_start = np.concatenate([[open_start], edges[1::2]])
+            i_end = edges[::2]
+        else:
+            i_start, i_end = edges[::2], edges[1::2]
+        start = buf[np.clip(i_start - w0, 0, None)]
+        if open_start is not None:
+            start[0] = open_start_time
+
+        open_start = None
+        if w1 < w_end and above_min_rate[-2]:
+            # Last burst continues in the next chunk
+            open_start, open_start_time = i_start[-1], start[-1]
+            i_start, i_end, start = i_start[:-1], i_end[:-1], start[:-1]
+
+        # For a burst ending with the last window, `i_end + m - 2` is the
+        # last timestamp, which is the end-of-array correction of `bsearch_py`
+        i_stop = i_end + (m - 2)
+        valid = (i_stop - i_start + 1) >= L
+        bursts = np.zeros((valid.sum(), 4), dtype='int64')
+        bursts[:, 0] = i_start[valid]
+        bursts[:, 1] = i_stop[valid]
+        bursts[:, 2] = start[valid]
+        bursts[:, 3] = buf[i_stop[valid] - w0]
+        bursts_list.append(bursts)
+
+    if len(bursts_list) == 0:
+        bursts = np.zeros((0, 4), dtype='int64')
+    else:
+        bursts = np.vstack(bursts_list)
+    if codes is None:
+        return bursts
+    return bursts, count_codes_in_bursts(bursts, codes, num_codes)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 #  Functions to count D and A photons in bursts
 #
@@ -161,6 +380,58 @@ def count_ph_in_bursts(bursts, mask):
     return num_ph
 
 
+def count_codes_in_bursts(burstarray, codes, num_codes=4,
+                          chunksize=None):
+    """Counts the number of photons of each stream code in each burst.
+
+    Single-pass alternative to calling :func:`count_ph_in_bursts` once
+    for each photon selection mask. Photons are identified by a per-photon
+    stream code (e.g. 0: DexDem, 1: DexAem, 2: AexDem, 3: AexAem),
+    so that the counts of all the streams are computed by reading each
+    photon in a burst only once.
+
+    Arguments:
+        burstarray (2D array, int64): the burst data (Nx4), as returned by
+            the burst search functions.
+        codes (1D array of uint8): the per-photon stream code. Must be of the
+            same size of the timestamp array used for burst search.
+            Can be any array supporting slicing (e.g. a PyTables array).
+        num_codes (int): number of stream codes to be counted. Photons with
+            `codes >= num_codes` are not counted.
+        chunksize (int or None): bursts are processed in groups spanning
+            about `chunksize` photons. If None use `default_chunksize`.
+
+    Returns:
+        A 2D array (int64) of shape (N, num_codes) containing the number
+        of photons of each code in each burst.
+
+    The counts are computed as differences of the cumulative sum of the
+    photons of each code at the burst start and stop, so that the
+    computation is vectorized over the bursts. Bursts need to be sorted
+    and not overlapping (as returned by the burst search).
+    """
+    if chunksize is None:
+        chunksize = default_chunksize
+    num_bursts = burstarray.shape[0]
+    counts = np.zeros((num_bursts, num_codes), dtype='int64')
+    istart = burstarray[:, 0].astype('int64')
+    istop = burstarray[:, 1].astype('int64') + 1
+    i = 0
+    while i < num_bursts:
+        # Group of bursts [i, j) whose photons are read at once
+        j = max(i + 1, np.searchsorted(istop, istart[i] + chunksize,
+                                       side='right'))
+        offset = istart[i]
+        chunk = np.asarray(codes[offset:istop[j - 1]])
+        cumsum = np.zeros(chunk.size + 1, dtype='int64')
+        for code in range(num_codes):
+            np.cumsum(chunk == code, dtype='int64', out=cumsum[1:])
+            counts[i:j, code] = (cumsum[istop[i:j] - offset] -
+                                 cumsum[istart[i:j] - offset])
+        i = j
+    return counts
+
+
 def mch_count_ph_in_bursts_py(Mburst, Mask):
     """Counts number of photons in each burst counting only photons in `Mask`.
 
@@ -187,6 +458,40 @@ def mch_count_ph_in_bursts_py(Mburst, Mask):
             for bursts, mask in zip(Mburst, Mask)]
 
 
+def mch_count_ph_in_bursts_cs(Mburst, Mask):
+    """Counts number of photons in each burst counting only photons in `Mask`.
+
+    Prefix-sum version of :func:`mch_count_ph_in_bursts_py`. The masks of
+    all the channels are concatenated and a single cumulative sum is
+    computed. Then, the number of photons in each burst is the difference
+    of the cumulative sum at `istop + 1` and `istart`. The execution time
+    is proportional to the total number of photons plus the number of
+    bursts and does not depend on the burst sizes (overlapping or very
+    long bursts do not increase the cost).
+
+    Arguments:
+        Mburst (list Bursts objects): a list of bursts collections, one per ch.
+        Mask (list of 1D boolean arrays): a list of photon masks (one per ch),
+            For each channel, the boolean mask must be of the same size of the
+            timestamp array used for burst search.
+
+    Returns:
+        A list of 1D array, each containing the number of photons
+        in each burst counting only photons in the selection mask.
+    """
+    Mask = [np.asarray(mask) for mask in Mask]
+    offsets = np.cumsum([0] + [mask.size for mask in Mask])
+    cumsum = np.zeros(offsets[-1] + 1, dtype='int64')
+    np.cumsum(np.concatenate(Mask), out=cumsum[1:])
+    istart = np.concatenate([bursts.istart + offset
+                             for bursts, offset in zip(Mburst, offsets)])
+    istop = np.concatenate([bursts.istop + offset
+                            for bursts, offset in zip(Mburst, offsets)])
+    num_ph = (cumsum[istop + 1] - cumsum[istart]).astype(float)
+    num_bursts = np.cumsum([bursts.num_bursts for bursts in Mburst])
+    return np.split(num_ph, num_bursts[:-1])
+
+
 ##
 #  Try to import the optimized Cython functions
 #
@@ -196,16 +501,22 @@ try:
     bsearch = bsearch_c
     print(" - Optimized (cython) burst search loaded.")
 except ImportError:
-    bsearch = bsearch_py
-    print(" - Fallback to pure python burst search.")
+    bsearch = bsearch_np
+    print(" - Fallback to vectorized (numpy) burst search.")
+
+try:
+    from burstsearch_c import bsearch_periods_c
+    bsearch_periods = bsearch_periods_c
+except ImportError:
+    bsearch_periods = bsearch_periods_np
 
 try:
     from burstsearch_c import mch_count_ph_in_bursts_c
     mch_count_ph_in_bursts = mch_count_ph_in_bursts_c
     print(" - Optimized (cython) photon counting loaded.")
 except ImportError:
-    mch_count_ph_in_bursts = mch_count_ph_in_bursts_py
-    print(" - Fallback to pure python photon counting.")
+    mch_count_ph_in_bursts = mch_count_ph_in_bursts_cs
+    print(" - Fallback to vectorized (numpy) photon counting.")
 
 
 class Burst(namedtuple('Burst', ['istart', 'istop', 'start', 'stop'])):
@@ -474,7 +785,7 @@ class Bursts(object):
         out.stop = times[self.istop]
         return out
 
-    def recompute_index_expand(self, mask, out=None):
+    def recompute_index_expand(self, mask, out=None, index=None):
         """Recompute istart and istop from selection `mask` to full timestamps.
 
         This method returns a new Bursts object with recomputed istart and
@@ -487,20 +798,26 @@ class Bursts(object):
         timestamps array.
 
         Arguments:
-            mask (bool array): boolean mask defining the timestamps selection
-                on which the old istart and istop were computed.
+            mask (bool array or None): boolean mask defining the timestamps
+                selection on which the old istart and istop were computed.
+                Can be None when passing `index`.
             out (None or Bursts): if None (default), do computations on a copy
                 of the current object. Otherwise, modify the `Bursts` object
                 passed (can be used for in-place operations).
+            index (None or int64 array): the index of the selected
+                timestamps in the "full" array, i.e. `np.flatnonzero(mask)`.
+                If None, it is computed from `mask`. Pass it to reuse the
+                same selection index in different calls.
 
         Returns:
             `Bursts` object with recomputed istart/istop.
         """
         if out is None:
             out = self.copy()
-        index = np.arange(mask.size, dtype=np.int32)
-        out.istart = index[mask][self.istart]
-        out.istop = index[mask][self.istop]
+        if index is None:
+            index = np.flatnonzero(mask)
+        out.istart = index[self.istart]
+        out.istop = index[self.istop]
         return out
 
 #    def recompute_index_reduce2(self, times_reduced, out=None):
@@ -532,6 +849,8 @@ class Bursts(object):
 
         Note: it is required that all the start and stop times are
         also contained in the reduced timestamps selection.
+        In case of repeated timestamps, istart points to the first and
+        istop to the last of the repeats.
 
         This method is the inverse of :meth:`recompute_index_expand`.
 
@@ -548,27 +867,9 @@ class Bursts(object):
         """
         if out is None:
             out = self.copy()
-
-        # Go through the timestamps searching for start
-        # and stop of each burst in order
-        it = 0
-        for ib, burst in enumerate(self):
-            while times_reduced[it] != burst.start:
-                it += 1
-            out[ib].istart = it
-            it_saved = it + 1
-
-            while times_reduced[it] != burst.stop:
-                it += 1
-            # in case of repeated timestamps, istop needs to point
-            # to the last of the repeats
-            while it < times_reduced.size and times_reduced[it] == burst.stop:
-                it += 1
-            out[ib].istop = it - 1
-
-            # Done with current burst, before starting a new burst,
-            # reset `it` to `istart+1`
-            it = it_saved
+        out.istart = np.searchsorted(times_reduced, self.start, side='left')
+        out.istop = np.searchsorted(times_reduced, self.stop,
+                                    side='right') - 1
         return out
 
     def and_gate(self, bursts2):
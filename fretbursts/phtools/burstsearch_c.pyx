@@ -22,10 +22,64 @@ cdef pprint(s):
     sys.stdout.write(s)
     sys.stdout.flush()
 
-def bsearch_c(np.int64_t[:] times, np.int16_t L, np.int16_t m,
+cdef np.int64_t _bsearch_kernel(const np.int64_t[:] times, np.int64_t L,
+                                np.int64_t m, np.float64_t T,
+                                np.int64_t islice1, np.int64_t islice2,
+                                np.int64_t[:, ::1] bursts,
+                                np.int64_t *i_resume) nogil:
+    """Burst search kernel writing bursts in the preallocated `bursts` buffer.
+
+    Searches bursts in `times[islice1:islice2]` and writes one row
+    (istart, istop, start, stop) per burst in `bursts`. When the buffer
+    is full, the search stops and `i_resume` is set to the index from
+    which the search needs to be restarted (the start of the first burst
+    not saved). Otherwise `i_resume` is set to -1.
+
+    Returns:
+        The number of bursts written in `bursts`.
+    """
+    cdef np.int64_t i, i_start = 0, i_stop, num_bursts = 0
+    cdef np.int64_t max_bursts = bursts.shape[0]
+    cdef np.uint8_t in_burst = 0
+
+    i_resume[0] = -1
+    i = islice1
+    for i in range(islice1, islice2 - m + 1):
+        if (times[i+m-1] - times[i]) <= T:
+            if not in_burst:
+                in_burst = 1
+                i_start = i
+        elif in_burst:
+            in_burst = 0
+            i_stop = i + m - 2
+            if i_stop - i_start + 1 >= L:
+                if num_bursts == max_bursts:
+                    i_resume[0] = i_start
+                    return num_bursts
+                bursts[num_bursts, 0] = i_start
+                bursts[num_bursts, 1] = i_stop
+                bursts[num_bursts, 2] = times[i_start]
+                bursts[num_bursts, 3] = times[i_stop]
+                num_bursts += 1
+
+    if in_burst:
+        i_stop = i + m - 1
+        if i_stop - i_start + 1 >= L:
+            if num_bursts == max_bursts:
+                i_resume[0] = i_start
+                return num_bursts
+            bursts[num_bursts, 0] = i_start
+            bursts[num_bursts, 1] = i_stop
+            bursts[num_bursts, 2] = times[i_start]
+            bursts[num_bursts, 3] = times[i_stop]
+            num_bursts += 1
+    return num_bursts
+
+
+def bsearch_c(const np.int64_t[:] times, np.int16_t L, np.int16_t m,
               np.float64_t T, slice_=None,
               label='Burst search', verbose=True):
-    """Sliding window burst search. Pure python implementation.
+    """Sliding window burst search. Optimized Cython implementation.
 
     Finds bursts in the array `times` (int64). A burst starts when the photon rate
     is above a minimum threshold, and ends when the rate falls below the same
@@ -33,6 +87,9 @@ def bsearch_c(np.int64_t[:] times, np.int16_t L, np.int16_t m,
     in a time interval `T`). A burst is discarded if it has less than `L`
     photons.
 
+    The search loop runs without holding the GIL, so that different
+    channels can be searched in parallel by multiple threads.
+
     Arguments:
         times (array, int64): array of timestamps on which to perform the search
         L (int): minimum number of photons in a bursts. Bursts with size
@@ -46,8 +103,8 @@ def bsearch_c(np.int64_t[:] times, np.int16_t L, np.int16_t m,
     Returns:
         Array of burst data Nx4, type int64.
     """
-    cdef np.int64_t islice1, islice2, i, i_start, i_stop
-    cdef np.uint8_t in_burst
+    cdef np.int64_t islice1, islice2, num_bursts, num_new, i_resume
+    cdef np.int64_t[:, ::1] buffer_view
 
     if verbose:
         pprint('Python search (v): %s\n' % label)
@@ -58,32 +115,206 @@ def bsearch_c(np.int64_t[:] times, np.int16_t L, np.int16_t m,
         islice1 = 0
         islice2 = times.size
 
-    bursts = []
-    in_burst = 0
-    for i in range(islice1, islice2 - m + 1):
-        if (times[i+m-1] - times[i]) <= T:
-            if not in_burst:
-                in_burst = 1
-                i_start = i
-        elif in_burst:
+    # Initial buffer size assumes at least ~100 photons per burst,
+    # the buffer is enlarged when needed.
+    bursts = np.zeros((max((islice2 - islice1) // 100, 16), 4), dtype='int64')
+    num_bursts = 0
+    i_resume = islice1
+    while i_resume >= 0:
+        buffer_view = bursts[num_bursts:]
+        with nogil:
+            num_new = _bsearch_kernel(times, L, m, T, i_resume, islice2,
+                                      buffer_view, &i_resume)
+        num_bursts += num_new
+        if i_resume >= 0:
+            bursts = np.concatenate([bursts, np.zeros_like(bursts)])
+    return bursts[:num_bursts]
+
+
+cdef inline void _count_codes(const np.uint8_t[:] codes, np.int64_t i_start,
+                              np.int64_t i_stop, np.int64_t[:, ::1] counts,
+                              np.int64_t ib) noexcept nogil:
+    """Count photons of each stream code in `codes[i_start:i_stop+1]`.
+
+    Counts are added to row `ib` of `counts`. Codes >= `counts.shape[1]`
+    are not counted.
+    """
+    cdef np.int64_t ii
+    cdef np.uint8_t code
+    for ii in range(i_start, i_stop + 1):
+        code = codes[ii]
+        if code < counts.shape[1]:
+            counts[ib, code] += 1
+
+
+cdef np.int64_t _bsearch_periods_kernel(
+        const np.int64_t[:] times, np.int64_t L, np.int64_t m,
+        const np.float64_t[:] TT, const np.int64_t[:] lim_start,
+        const np.int64_t[:] lim_stop, np.uint8_t split,
+        np.int64_t[:, ::1] bursts, np.int64_t *i_resume,
+        np.int64_t *ip_resume, const np.uint8_t[:] codes,
+        np.int64_t[:, ::1] counts) nogil:
+    """Burst search kernel with a different threshold in each period.
+
+    Performs a single linear scan starting from index `i_resume[0]` in
+    period `ip_resume[0]`, switching the threshold `TT[ip]` when crossing
+    a period boundary. When `split` is True, windows crossing a
+    period boundary are considered below threshold, so bursts are
+    interrupted at the period boundaries.
+
+    Bursts are written in the preallocated `bursts` buffer. When the buffer
+    is full, the search stops and `i_resume`, `ip_resume` are set to the
+    index and period from which the search needs to be restarted.
+    Otherwise `i_resume` is set to -1.
+
+    When `counts` has at least one column, the photons of each stream
+    code in `codes` are counted for each burst as soon as the burst is
+    found (while its photons are still in cache) and written in the
+    corresponding row of `counts`.
+
+    Returns:
+        The number of bursts written in `bursts`.
+    """
+    cdef np.int64_t i, i_start = 0, ip_start = 0, i_stop, num_bursts = 0
+    cdef np.int64_t max_bursts = bursts.shape[0], i_last
+    cdef np.int64_t ip, nperiods = TT.shape[0]
+    cdef np.int64_t i_end = min(lim_stop[nperiods - 1] + 1, times.shape[0])
+    cdef np.float64_t T
+    cdef np.uint8_t in_burst = 0
+
+    i = i_resume[0]
+    i_resume[0] = -1
+    for ip in range(ip_resume[0], nperiods):
+        T = TT[ip]
+        # Index of the last window using the threshold of current period
+        i_last = lim_stop[ip] + 1 - m if split else lim_stop[ip]
+        i_last = min(i_last, i_end - m)
+        i = max(i, lim_start[ip])
+        while i <= i_last:
+            if (times[i+m-1] - times[i]) <= T:
+                if not in_burst:
+                    in_burst = 1
+                    i_start = i
+                    ip_start = ip
+            elif in_burst:
+                in_burst = 0
+                i_stop = i + m - 2
+                if i_stop - i_start + 1 >= L:
+                    if num_bursts == max_bursts:
+                        i_resume[0] = i_start
+                        ip_resume[0] = ip_start
+                        return num_bursts
+                    bursts[num_bursts, 0] = i_start
+                    bursts[num_bursts, 1] = i_stop
+                    bursts[num_bursts, 2] = times[i_start]
+                    bursts[num_bursts, 3] = times[i_stop]
+                    if counts.shape[1] > 0:
+                        _count_codes(codes, i_start, i_stop, counts,
+                                     num_bursts)
+                    num_bursts += 1
+            i += 1
+
+        if in_burst and (split or ip == nperiods - 1):
+            # Burst interrupted by the period boundary or by the end of
+            # the array: the last photon of the period is the burst stop
             in_burst = 0
-            i_stop = i + m - 2
+            i_stop = min(lim_stop[ip], i_end - 1)
             if i_stop - i_start + 1 >= L:
-                bursts.append((i_start, i_stop,
-                               times[i_start], times[i_stop]))
+                if num_bursts == max_bursts:
+                    i_resume[0] = i_start
+                    ip_resume[0] = ip_start
+                    return num_bursts
+                bursts[num_bursts, 0] = i_start
+                bursts[num_bursts, 1] = i_stop
+                bursts[num_bursts, 2] = times[i_start]
+                bursts[num_bursts, 3] = times[i_stop]
+                if counts.shape[1] > 0:
+                    _count_codes(codes, i_start, i_stop, counts, num_bursts)
+                num_bursts += 1
+    return num_bursts
 
-    if in_burst:
-        i_stop = i + m - 1
-        if i_stop - i_start + 1 >= L:
-            bursts.append((i_start, i_stop, times[i_start], times[i_stop]))
 
-    return np.array(bursts, dtype='int64')
+def bsearch_periods_c(const np.int64_t[:] times, np.int16_t L, np.int16_t m,
+                      TT, lim, split=True, codes=None, num_codes=4,
+                      label='Burst search', verbose=True):
+    """Sliding window burst search with a different threshold in each period.
+
+    Single-pass version of calling the burst search on each background
+    period, using for each period the corresponding threshold `TT[ip]`.
+    The threshold of an m-photons window is the one of the period
+    containing the first photon of the window.
+    Optimized Cython implementation, the search loop runs without
+    holding the GIL.
+
+    Arguments:
+        times (array, int64): array of timestamps on which to perform the search
+        L (int): minimum number of photons in a bursts. Bursts with size
+            (or counts) < L are discarded.
+        m (int): number of consecutive photons used to compute the rate.
+        TT (array of floats): max time separation of `m` photons to be
+            inside a burst, one value per period (in timestamps units).
+        lim (list of tuples): index of first and last timestamp in each
+            period (same format as `Data.Lim[ich]`).
+        split (bool): if True, bursts are interrupted at the period
+            boundaries (the result is identical to a separate search in
+            each period). If False, bursts can span different periods.
+        codes (array of uint8 or None): if not None, a per-photon stream
+            code (same size as `times`). The photons of each code are
+            counted in each burst during the search (see
+            :func:`count_codes_in_bursts`).
+        num_codes (int): number of stream codes to be counted. Photons with
+            `codes >= num_codes` are not counted.
+        label (string): a label printed when the function is called
+        verbose (bool): if False, the function does not print anything.
+
+    Returns:
+        Array of burst data Nx4, type int64. If `codes` is not None,
+        returns a tuple with the burst data and an array of shape
+        (N, num_codes) (int64) with the photon counts for each code.
+    """
+    cdef np.int64_t num_bursts, num_new, i_resume, ip_resume
+    cdef np.int64_t[:, ::1] buffer_view, counts_view
+    cdef const np.uint8_t[:] codes_
+    cdef np.uint8_t split_ = split
+    cdef np.float64_t[:] TT_ = np.ascontiguousarray(TT, dtype=np.float64)
+
+    if verbose:
+        pprint('Python search (v): %s\n' % label)
+    lim_arr = np.asarray(lim, dtype='int64').reshape(-1, 2)
+    cdef np.int64_t[:] lim_start = np.ascontiguousarray(lim_arr[:, 0])
+    cdef np.int64_t[:] lim_stop = np.ascontiguousarray(lim_arr[:, 1])
+
+    bursts = np.zeros((max(times.size // 100, 16), 4), dtype='int64')
+    if codes is None:
+        codes_ = np.zeros(0, dtype=np.uint8)
+        num_codes = 0
+    else:
+        codes_ = codes
+        assert codes_.shape[0] == times.shape[0]
+    counts = np.zeros((bursts.shape[0], num_codes), dtype='int64')
+    num_bursts = 0
+    i_resume, ip_resume = lim_start[0], 0
+    while i_resume >= 0:
+        buffer_view = bursts[num_bursts:]
+        counts_view = counts[num_bursts:]
+        with nogil:
+            num_new = _bsearch_periods_kernel(
+                times, L, m, TT_, lim_start, lim_stop, split_,
+                buffer_view, &i_resume, &ip_resume, codes_, counts_view)
+        num_bursts += num_new
+        if i_resume >= 0:
+            bursts = np.concatenate([bursts, np.zeros_like(bursts)])
+            counts = np.concatenate([counts, np.zeros_like(counts)])
+    if codes is None:
+        return bursts[:num_bursts]
+    return bursts[:num_bursts], counts[:num_bursts]
 
 
 ## - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 #  Functions to count D and A ph in bursts
 #
-def count_ph_in_bursts_c(np.int64_t[:,:] burstdata, np.uint8_t[:] mask):
+def count_ph_in_bursts_c(const np.int64_t[:, :] burstdata,
+                         const np.uint8_t[:] mask):
     """Counts number of photons in each burst counting only photons in `Mask`.
 
     This multi-channel function takes a list of burst-arrays and a list of
@@ -109,6 +340,38 @@ def count_ph_in_bursts_c(np.int64_t[:,:] burstdata, np.uint8_t[:] mask):
             num_ph[i] += mask[ii]
     return num_ph
 
+def count_ph_in_bursts_cs_c(const np.int64_t[:, :] burstdata,
+                            const np.uint8_t[:] mask):
+    """Counts number of photons in each burst counting only photons in `mask`.
+
+    Prefix-sum version of :func:`count_ph_in_bursts_c`: the cumulative sum
+    of `mask` is computed once, then the number of photons in each burst
+    is the difference of the cumulative sum at `istop + 1` and `istart`.
+    The execution time is proportional to the mask size plus the number
+    of bursts, independently of the burst sizes.
+
+    Arguments:
+        burstdata (2D array, int64): the burst data (Nx4).
+        mask (1D uint8 array): the photon mask, same size of the timestamp
+            array used for burst search.
+
+    Returns:
+        A 1D array containing the number of photons in each burst
+        counting only photons in the selection mask.
+    """
+    cdef np.int64_t i
+    cdef np.int32_t[:] num_ph
+    cdef np.int64_t[:] cumsum
+
+    cumsum = np.zeros(mask.shape[0] + 1, dtype=np.int64)
+    num_ph = np.zeros(burstdata.shape[0], dtype=np.int32)
+    with nogil:
+        for i in range(mask.shape[0]):
+            cumsum[i + 1] = cumsum[i] + mask[i]
+        for i in range(burstdata.shape[0]):
+            num_ph[i] = cumsum[burstdata[i, 1] + 1] - cumsum[burstdata[i, 0]]
+    return num_ph
+
 def mch_count_ph_in_bursts_c(mburst, masks):
     """Counts number of photons in each burst counting only photons in `Mask`.
 
@@ -122,12 +385,20 @@ def mch_count_ph_in_bursts_c(mburst, masks):
             For each channel, the boolean mask must be of the same size of the
             timestamp array used for burst search.
 
+    For each channel, when the total number of photons in the bursts
+    is larger than the mask size (e.g. long or overlapping bursts),
+    the counts are computed with the prefix-sum version
+    :func:`count_ph_in_bursts_cs_c`.
+
     Returns:
         A list of 1D arrays, each containing the number of photons in the
         photon selection mask.
     """
     num_ph_list = []
     for bursts, mask in zip(mburst, masks):
+        count_func = count_ph_in_bursts_c
+        if bursts.num_bursts > 0 and bursts.counts.sum() > mask.size:
+            count_func = count_ph_in_bursts_cs_c
         num_ph_list.append(
-            np.asfarray(count_ph_in_bursts_c(bursts.data, mask.view(np.uint8))))
+            np.asfarray(count_func(bursts.data, mask.view(np.uint8))))
     return num_ph_list
@@ -0,0 +1,218 @@
+#
+# FRETBursts - A single-molecule FRET burst analysis toolkit.
+#
+# Copyright (C) 2014 Antonino Ingargiola <tritemio@gmail.com>
+#
+"""
+Lazy access to on-disk photon-data arrays.
+
+This module provides :class:`LazyArray`, a read-only 1-D array backed by an
+on-disk array (e.g. a PyTables array) which is read in chunks. The decoded
+chunks are stored in a :class:`fretbursts.utils.misc.LRUCache` with a memory
+budget, usually shared by all the arrays (channels and fields) of a `Data`
+object. Reading a single element (for example the first or last timestamp)
+reads only that element from disk.
+
+`LazyArray` objects are returned by :func:`fretbursts.loader.photon_hdf5`
+with `ondisk=True`, for the per-photon arrays (`ph_times_m`, `nanotimes`,
+`detectors`, ...). Indexing with a slice or with an index/boolean array
+returns an in-memory array, so a `LazyArray` can be used in place of a numpy
+array in most of the code that only reads the data.
+"""
+
+from __future__ import division
+from builtins import range
+
+import itertools
+import numpy as np
+
+from fretbursts.utils.misc import LRUCache
+
+
+# Default memory budget (bytes) of the cache of decoded chunks
+CHUNK_CACHE_MAX_BYTES = 512 * 2**20
+
+# Default number of elements in each chunk
+default_chunksize = 2**22
+
+# Unique id of each on-disk array in the chunk caches
+_array_ids = itertools.count()
+
+
+def new_chunk_cache(max_bytes=CHUNK_CACHE_MAX_BYTES):
+    """Return a new LRU cache for the chunks of :class:`LazyArray` objects."""
+    return LRUCache(max_bytes=max_bytes)
+
+
+class LazyArray(object):
+    """Read-only 1-D array reading an on-disk array in chunks.
+
+    Arguments:
+        node (array-like): the on-disk 1-D array (e.g. a PyTables array).
+            It needs to support `.shape`, `.dtype` and slicing.
+        cache (LRUCache or None): cache of the decoded chunks. If None,
+            a new cache with a `CHUNK_CACHE_MAX_BYTES` budget is created.
+        chunksize (int or None): number of elements in each chunk. If None,
+            use `default_chunksize` rounded to a multiple of the
+            on-disk chunk shape (when available).
+
+    A `LazyArray` can be a view of a range of the on-disk array (see
+    :meth:`lazy_slice`), with an optional constant `shift` added to the
+    values (used by :meth:`fretbursts.burstlib.Data.slice_ph`).
+    """
+    def __init__(self, node, cache=None, chunksize=None):
+        if cache is None:
+            cache = new_chunk_cache()
+        if chunksize is None:
+            chunksize = default_chunksize
+            node_chunk = getattr(node, 'chunkshape', None)
+            if node_chunk:
+                chunksize = max(1, chunksize // node_chunk[0]) * node_chunk[0]
+        self.node = node
+        self.cache = cache
+        self.chunksize = chunksize
+        self.dtype = node.dtype
+        self._id = next(_array_ids)
+        self._start, self._stop = 0, node.shape[0]
+        self._shift = 0
+
+    def lazy_slice(self, start, stop, shift=0):
+        """Return a `LazyArray` view of `self[start:stop] + shift`.
+
+        No data is read. The view shares the chunk cache with `self`.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        new = LazyArray.__new__(LazyArray)
+        new.__dict__.update(self.__dict__)
+        new._start = self._start + start
+        new._stop = self._start + max(start, stop)
+        new._shift = self._shift + shift
+        return new
+
+    @property
+    def shape(self):
+        return (self._stop - self._start,)
+
+    @property
+    def size(self):
+        return self._stop - self._start
+
+    @property
+    def ndim(self):
+        return 1
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __repr__(self):
+        return '<LazyArray size=%d dtype=%s>' % (self.size, self.dtype)
+
+    def _get_chunk(self, ichunk):
+        """Return the decoded chunk `ichunk` of the on-disk array."""
+        key = (self._id, ichunk)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            start = ichunk * self.chunksize
+            chunk = np.asarray(self.node[start:start + self.chunksize])
+            chunk.flags.writeable = False
+            self.cache.put(key, chunk)
+        return chunk
+
+    def _apply_shift(self, values):
+        if self._shift != 0:
+            values = values + self._shift
+        return values
+
+    def read(self, start=0, stop=None):
+        """Return the elements in [`start`, `stop`) as an in-memory array.
+
+        Ranges larger than the chunk cache are read directly from disk
+        without caching.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        start, stop = start + self._start, stop + self._start
+        if (stop - start) * self.dtype.itemsize > self.cache.max_bytes:
+            values = np.asarray(self.node[start:stop])
+            return self._apply_shift(values)
+        ichunk1 = start // self.chunksize
+        ichunk2 = max(ichunk1, (stop - 1) // self.chunksize)
+        chunks = [self._get_chunk(i) for i in range(ichunk1, ichunk2 + 1)]
+        offset = ichunk1 * self.chunksize
+        if len(chunks) == 1:
+            values = chunks[0][start - offset:stop - offset].copy()
+        else:
+            values = np.concatenate(chunks)[start - offset:stop - offset]
+        return self._apply_shift(values)
+
+    def iter_chunks(self):
+        """Iterate over the array in chunks, yielding `(start, values)`."""
+        chunksize = self.chunksize
+        for start in range(0, self.size, chunksize):
+            yield start, self.read(start, start + chunksize)
+
+    def searchsorted(self, value, side='left'):
+        """Like `np.searchsorted` (array needs to be sorted).
+
+        `value` can be a scalar or an array. Only one element per chunk
+        and the chunks containing the insertion points are read.
+        """
+        value = np.asarray(value)
+        chunk_starts = np.arange(0, self.size, self.chunksize)
+        firsts = np.array([self[i] for i in chunk_starts])
+        ichunks = np.searchsorted(firsts, value, side=side) - 1
+        index = np.zeros(value.shape, dtype=np.int64)
+        for ichunk in np.unique(ichunks[ichunks >= 0]):
+            sel = ichunks == ichunk
+            start = chunk_starts[ichunk]
+            chunk = self.read(start, start + self.chunksize)
+            index[sel] = start + np.searchsorted(chunk, value[sel], side=side)
+        return index[()]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indexes = range(*index.indices(len(self)))
+            if len(indexes) == 0:
+                return np.array([], dtype=self.dtype)
+            # Read the range of the selected elements and apply the step
+            i0 = min(indexes[0], indexes[-1])
+            values = self.read(i0, max(indexes[0], indexes[-1]) + 1)
+            if indexes.step == 1:
+                return values
+            return values[indexes[0] - i0::indexes.step][:len(indexes)]
+        if np.isscalar(index) or (isinstance(index, np.ndarray) and
+                                  index.ndim == 0):
+            i = int(index)
+            if i < 0:
+                i += len(self)
+            if not 0 <= i < len(self):
+                raise IndexError('Index %d out of bounds.' % int(index))
+            # Single elements are read directly from disk
+            return self._apply_shift(self.node[self._start + i])
+        index = np.asarray(index)
+        if index.dtype == bool:
+            if index.size != len(self):
+                raise IndexError('Boolean index size does not match.')
+            index = np.flatnonzero(index)
+        if index.size == 0:
+            return np.array([], dtype=self.dtype)
+        index = np.where(index < 0, index + len(self), index)
+        if (np.diff(index) < 0).any():
+            # Unsorted index: read the range containing the elements
+            i0, i1 = index.min(), index.max() + 1
+            return self.read(i0, i1)[index - i0]
+        # Sorted index: select the elements one chunk at a time
+        values = np.zeros(index.size, dtype=self.dtype)
+        bounds = np.searchsorted(index, np.arange(0, self.size + 1,
+                                                  self.chunksize))
+        bounds = np.append(bounds, index.size)
+        for k in np.flatnonzero(np.diff(bounds) > 0):
+            start = k * self.chunksize
+            sel = slice(bounds[k], bounds[k + 1])
+            chunk = self.read(start, start + self.chunksize)
+            values[sel] = chunk[index[sel] - start]
+        return values
+
+    def __array__(self, dtype=None):
+        values = self.read()
+        return values if dtype is None else values.astype(dtype)
@@ -11,7 +11,8 @@ from libc.math cimport exp, fabs
 ctypedef np.int64_t DTYPE_t
 
 
-cdef _kde_gaussian_cy(DTYPE_t[:] timestamps, DTYPE_t tau, DTYPE_t[:] time_axis):
+cdef _kde_gaussian_cy(const DTYPE_t[:] timestamps, DTYPE_t tau,
+                      const DTYPE_t[:] time_axis):
     """Computes Gaussian KDE for `timestamps` evaluated at `time_axis`.
     """
     cdef np.int64_t timestamps_size, ipos, ineg, it, itx
@@ -36,7 +37,8 @@ cdef _kde_gaussian_cy(DTYPE_t[:] timestamps, DTYPE_t tau, DTYPE_t[:] time_axis):
             rates[it] += exp(-((timestamps[itx] - t)**2)/tau2)
     return rates
 
-cdef _kde_laplace_cy(DTYPE_t[:] timestamps, DTYPE_t tau, DTYPE_t[:] time_axis):
+cdef _kde_laplace_cy(const DTYPE_t[:] timestamps, DTYPE_t tau,
+                     const DTYPE_t[:] time_axis):
     """Computes exponential KDE for `timestamps` evaluated at `time_axis`.
     """
     cdef np.int64_t timestamps_size, ipos, ineg, it, itx
@@ -60,7 +62,8 @@ cdef _kde_laplace_cy(DTYPE_t[:] timestamps, DTYPE_t tau, DTYPE_t[:] time_axis):
     return rates
 
 
-cdef _kde_rect_cy(DTYPE_t[:] timestamps, DTYPE_t tau, DTYPE_t[:] time_axis):
+cdef _kde_rect_cy(const DTYPE_t[:] timestamps, DTYPE_t tau,
+                  const DTYPE_t[:] time_axis):
     """Computes rectangular KDE for `timestamps` evaluated at `time_axis`.
     """
     cdef np.int64_t timestamps_size, ipos, ineg, it
@@ -21,22 +21,44 @@ from __future__ import print_function
 from builtins import range, zip
 
 import numpy as np
-from scipy.stats import poisson, chi2, erlang
+from scipy.stats import chi2
+from scipy.special import pdtrc
+
+# Memo table of the Erlang quantiles with unit rate (see `_erlang_ppf`)
+_erlang_ppf_cache = {}
+
+
+def _erlang_ppf(m, P):
+    """Return the quantile `P` of the Erlang(m) distribution with unit rate.
+
+    The quantile for a rate `bg_rate` is obtained dividing by `bg_rate`.
+    Values are memoized for each (m, P).
+    """
+    key = (int(m), float(P))
+    if key not in _erlang_ppf_cache:
+        _erlang_ppf_cache[key] = 0.5 * chi2(2 * key[0]).ppf(key[1])
+    return _erlang_ppf_cache[key]
+
 
 def find_optimal_T_bga(bg_array, m, P):
     """Return T so that m-ph delay from pure BG will be < T with prob. < P.
 
-    This calls find_optimal_T() for each value in `bg_array`.
+    This is find_optimal_T() computed for all the values in `bg_array`
+    at once.
     """
-    TT = np.array([find_optimal_T(bg_i, m, P) for bg_i in bg_array])
+    bg_array = np.asarray(bg_array, dtype=float)
+    with np.errstate(divide='ignore'):
+        TT = _erlang_ppf(m, P) / bg_array
     return TT
 
 def find_optimal_T(bg_rate, m, P):
     """Return T so that m-ph delay from pure BG will be < T with prob. < P.
 
     This is equivalent to find_optimal_T_chi2 but conceptually simpler.
+    The Erlang quantile `erlang.ppf(P, m, scale=1./bg_rate)` is computed
+    by scaling the (memoized) quantile with unit rate.
     """
-    T = erlang.ppf(P, m, scale=1./bg_rate)
+    T = find_optimal_T_bga(bg_rate, m, P)
     return T
 
 def find_optimal_T_chi2(bg_rate, m, P):
@@ -45,7 +67,7 @@ def find_optimal_T_chi2(bg_rate, m, P):
     This is equivalent but much faster than find_optimal_T_iter().
     Note: This is based on the confidence intervall of multiple exponential
     """
-    T = 0.5*chi2(2*m).ppf(P)/bg_rate
+    T = _erlang_ppf(m, P)/np.asarray(bg_rate, dtype=float)
     return T
 
 def find_optimal_threshold(m, P):
@@ -53,15 +75,16 @@ def find_optimal_threshold(m, P):
 
     Same formula as find_optimal_T() (must be multiplied by bg to have the rate.
     """
-    return m/(0.5*chi2(2*m).ppf(P))
+    return m/_erlang_ppf(m, P)
 
 def prob_noise_above_th(rate, T, m):
     """Returns the probability that noise is above the burst search threshold.
 
     Basically is the probability that a poisson process with rate "rate" had
-    "m" or more events in a time window "T".
+    "m" or more events in a time window "T". The arguments can be arrays
+    (e.g. grids of rates and T) and are broadcasted together.
     """
-    return poisson(rate*T).sf(m-1)
+    return pdtrc(np.asarray(m) - 1, np.asarray(rate) * np.asarray(T))
 _p = prob_noise_above_th
 
 def prob_noise_above_th_test_version(rate, T, m):
@@ -111,17 +134,11 @@ def find_optimal_T_iter(bg_rate, m, P_user, max_iter=int(1e6), debug=False):
     if not converged: raise StopIteration
     if debug: print("T_min = %.3f ms, T_max = %.3f ms" % (T*1e3, 2*T*1e3))
 
+    # Scan [T, 2T] with steps of T/1000 evaluating all the values at once
     step = T/1000.
-    T = 2*T
-    converged = False
-    for i in range(max_iter):
-        prob = prob_noise_above_th(bg_rate,T,m)
-        if prob > P_user:
-            T -= step
-        else:
-            converged = True
-            break
-    if not converged: raise StopIteration
+    T_grid = 2*T - step*np.arange(1001)
+    below = prob_noise_above_th(bg_rate, T_grid, m) <= P_user
+    T = T_grid[np.argmax(below)]
     if debug: print(" >T_min = %.3f ms, T_max = %.3f ms" % (T*1e3, (T+step)*1e3))
     return T
 
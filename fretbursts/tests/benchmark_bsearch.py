@@ -0,0 +1,96 @@
+#
+# FRETBursts - A single-molecule FRET burst analysis toolkit.
+#
+# Copyright (C) 2014-2016 The Regents of the University of California,
+#               Antonino Ingargiola <tritemio@gmail.com>
+#
+"""
+Benchmark of the low-level burst search functions.
+
+Compares the vectorized numpy burst search (`bsearch_np`) with the
+Cython version (`bsearch_c`, when compiled) and, optionally, with the
+loop-based pure python version (`bsearch_py`) on simulated timestamps.
+
+USAGE
+-----
+
+    python fretbursts/tests/benchmark_bsearch.py --num-photons 1e8
+
+"""
+
+from __future__ import division, print_function
+
+import time
+import numpy as np
+
+from fretbursts.phtools import burstsearch as bs
+
+
+def simulate_timestamps(num_photons, bg_rate=5e3, burst_rate=300e3,
+                        burst_fraction=0.1, clk_p=12.5e-9, seed=1):
+    """Return an int64 array of timestamps with bursts on top of background.
+
+    Inter-photon delays are exponentially distributed with rate `bg_rate`
+    except for a fraction `burst_fraction` of photons, simulated with
+    rate `burst_rate`, grouped in bursts of about 50 photons.
+    """
+    rs = np.random.RandomState(seed)
+    rates = np.full(num_photons, bg_rate)
+    burst_size = 50
+    num_bursts = int(num_photons * burst_fraction / burst_size)
+    starts = rs.randint(0, num_photons - burst_size, size=num_bursts)
+    for i in range(burst_size):
+        rates[starts + i] = burst_rate
+    delays = rs.exponential(1 / (rates * clk_p))
+    return np.cumsum(delays).astype('int64')
+
+
+def timeit(func, *args, **kwargs):
+    """Return the result and the execution time (in seconds) of `func`."""
+    t0 = time.time()
+    res = func(*args, **kwargs)
+    return res, time.time() - t0
+
+
+def benchmark(num_photons, L=10, m=10, F=6, bg_rate=5e3, clk_p=12.5e-9,
+              python=False):
+    """Run the burst search benchmark and print the execution times."""
+    print('Simulating %d timestamps ... ' % num_photons, end='', flush=True)
+    times = simulate_timestamps(num_photons, bg_rate=bg_rate, clk_p=clk_p)
+    print('[DONE]')
+    T = (m - 1) / (F * bg_rate) / clk_p
+
+    funcs = [('bsearch_np', bs.bsearch_np)]
+    if hasattr(bs, 'bsearch_c'):
+        funcs.append(('bsearch_c', bs.bsearch_c))
+    else:
+        print('WARNING: Cython burst search not available.')
+    if python:
+        funcs.append(('bsearch_py', bs.bsearch_py))
+
+    results = {}
+    for name, func in funcs:
+        bursts, elapsed = timeit(func, times, L, m, T, verbose=False)
+        results[name] = bursts
+        print('%12s: %8.3f s  (%d bursts)' % (name, elapsed, bursts.shape[0]))
+
+    ref = results['bsearch_np']
+    for name, bursts in results.items():
+        assert bursts.shape[0] == ref.shape[0]
+        assert (bursts.reshape(-1, 4) == ref).all(), name
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    descr = """\
+        Benchmark the burst search functions on simulated timestamps.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('--num-photons', type=float, default=1e8,
+                        help='Number of simulated timestamps.')
+    parser.add_argument('--python', action='store_true',
+                        help='Include the (slow) loop-based python version.')
+    args = parser.parse_args()
+    benchmark(int(args.num_photons), python=args.python)
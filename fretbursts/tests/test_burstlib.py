@@ -13,6 +13,8 @@ from __future__ import division
 from builtins import range, zip
 
 from collections import namedtuple
+import copy
+import pickle
 import pytest
 import numpy as np
 
@@ -35,6 +37,7 @@ else:
 import fretbursts.background as bg
 import fretbursts.burstlib as bl
 import fretbursts.burstlib_ext as bext
+from fretbursts import bg_cache
 from fretbursts import loader
 from fretbursts import select_bursts
 from fretbursts.ph_sel import Ph_sel
@@ -309,6 +312,251 @@ def test_bg_calc(data):
     assert list_array_equal(data.bg[Ph_sel('all')], bg_t)
 
 
+def test_bg_calc_batch(data):
+    """Test batch exp_fit background vs the period-by-period fit."""
+    def exp_fit_loop(ph, **kwargs):
+        return bg.exp_fit(ph, **kwargs)
+
+    d = data
+    for tail_min_us in (300, 'auto'):
+        d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=tail_min_us)
+        bg_batch, th_batch = d.bg, d.bg_th_us
+        Lim_batch, Ph_p_batch = d.Lim, d.Ph_p
+        d.calc_bg(exp_fit_loop, time_s=20, tail_min_us=tail_min_us)
+        for sel in d.ph_streams:
+            for ich in range(d.nch):
+                assert np.allclose(bg_batch[sel][ich], d.bg[sel][ich])
+                assert np.allclose(th_batch[sel][ich], d.bg_th_us[sel][ich])
+        assert np.array_equal(Lim_batch, d.Lim)
+        assert np.array_equal(Ph_p_batch, d.Ph_p)
+
+
+def test_exp_fit_periods_empty_last():
+    """Test batch exp_fit with empty periods at the end."""
+    rng = np.random.RandomState(3)
+    ph = np.cumsum(rng.randint(1, 20000, size=500))
+    starts = np.array([0, 200, 500, 500])
+    stops = np.array([200, 500, 500, 500])
+    rates, num_tail = bg.exp_fit_periods(ph, starts, stops, tail_min_us=50)
+    for ip in range(2):
+        ph_p = ph[starts[ip]:stops[ip]]
+        delays = np.diff(ph_p)
+        assert num_tail[ip] == (delays >= 50e-6 / 12.5e-9).sum()
+        assert np.allclose(rates[ip], bg.exp_fit(ph_p, tail_min_us=50)[0])
+    assert (rates[2:] == 0).all() and (num_tail[2:] == 0).all()
+
+
+def test_bg_calc_empty_last_period(data):
+    """Test calc_bg with a stream empty in the last background period."""
+    d = data.copy(mute=True)
+    d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=300)
+    # Remove the acceptor photons in the last period (but the last photon)
+    keep = []
+    for ich in range(d.nch):
+        index = np.arange(d.ph_data_sizes[ich])
+        last_period = (index >= d.Lim[ich][-1][0]) * (index < index.size - 1)
+        keep.append(~(np.asarray(d.A_em[ich]) * last_period))
+    fields = {name: [np.asarray(d[name][ich])[keep[ich]]
+                     for ich in range(d.nch)]
+              for name in d.ph_fields if name in d}
+    d.add(**fields)
+
+    d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=300, fit_allph=False)
+    streams = [sel for sel in d.ph_streams if sel != Ph_sel('all')]
+    for ich in range(d.nch):
+        # With fit_allph=False the total rate is the sum of the streams
+        assert np.allclose(d.bg[Ph_sel('all')][ich],
+                           sum(d.bg[sel][ich] for sel in streams))
+    for sel in (Ph_sel(Dex='Aem'), Ph_sel(Aex='Aem')):
+        if sel in streams:
+            for ich in range(d.nch):
+                assert d.bg[sel][ich][-1] == 0
+    for sel in streams:
+        for ich in range(d.nch):
+            ph = d.get_ph_times(ich, ph_sel=sel)
+            for ip, (t0, t1) in enumerate(d.Ph_p[ich][:-1]):
+                ph_p = ph[(ph >= t0) * (ph <= t1)]
+                if ph_p.size <= 10:
+                    continue  # not fitted by calc_bg
+                rate, _ = bg.exp_fit(ph_p, tail_min_us=300, clk_p=d.clk_p)
+                assert np.allclose(d.bg[sel][ich][ip], rate)
+
+
+def test_bg_calc_auto_num_iter(data):
+    """Test iterated 'auto' thresholds vs the period-by-period fit."""
+    def exp_fit_loop(ph, **kwargs):
+        return bg.exp_fit(ph, **kwargs)
+
+    d = data
+    d.calc_bg(bg.exp_fit, time_s=20, tail_min_us='auto', auto_num_iter=3)
+    bg_batch, th_batch = d.bg, d.bg_th_us
+    assert d.bg_auto_num_iter == 3
+    d.calc_bg(exp_fit_loop, time_s=20, tail_min_us='auto', auto_num_iter=3)
+    for sel in d.ph_streams:
+        assert list_array_allclose(bg_batch[sel], d.bg[sel])
+        assert list_array_allclose(th_batch[sel], d.bg_th_us[sel])
+
+    ph = d.get_ph_times(0)
+    rate, _ = bg.exp_fit(ph, tail_min_us=250, clk_p=d.clk_p)
+    for num_iter in (1, 2, 5):
+        th = 1e6 * 2 / rate
+        rate_i, _ = bg.exp_fit(ph, tail_min_us=th, clk_p=d.clk_p)
+        rates, _, th_auto = bg.exp_fit_periods_auto(
+            ph, [0], [ph.size], 250, 2, clk_p=d.clk_p, num_iter=num_iter)
+        for i in range(num_iter - 1):
+            th = 1e6 * 2 / rate_i
+            rate_i, _ = bg.exp_fit(ph, tail_min_us=th, clk_p=d.clk_p)
+        assert np.allclose(th_auto[0], th)
+        assert np.allclose(rates[0], rate_i)
+    with pytest.raises(ValueError):
+        d.calc_bg(bg.exp_fit, tail_min_us='auto', auto_num_iter=0)
+    d.calc_bg(bg.exp_fit, time_s=30, tail_min_us=300)
+    assert 'bg_auto_num_iter' not in d
+
+
+def test_bg_calc_n_jobs(data):
+    """Test that parallel background fitting gives the serial results."""
+    d = data
+    for tail_min_us in (300, 'auto'):
+        d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=tail_min_us)
+        bg_serial, th_serial = d.bg, d.bg_th_us
+        d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=tail_min_us, n_jobs=2)
+        for sel in d.ph_streams:
+            assert list_array_equal(bg_serial[sel], d.bg[sel])
+            assert list_array_equal(th_serial[sel], d.bg_th_us[sel])
+
+    args = (d, [200, 500, 1000])
+    bg1, bg_err1 = bg.fit_varying_min_delta_ph(*args, error_metrics='KS')
+    bg2, bg_err2 = bg.fit_varying_min_delta_ph(*args, error_metrics='KS',
+                                               n_jobs=2)
+    assert np.array_equal(bg1, bg2, equal_nan=True)
+    assert np.array_equal(bg_err1, bg_err2, equal_nan=True)
+
+
+def test_bg_fit_varying_min_delta_ph_scan(data):
+    """Test the sort-once threshold scan vs calling exp_fit in a loop."""
+    def exp_fit_loop(ph, **kwargs):
+        return bg.exp_fit(ph, **kwargs)
+
+    d = data
+    d.calc_bg(bg.exp_fit, time_s=30, tail_min_us=300)
+    th_list = np.arange(100, 8500, 500)
+    for error_metrics in (None, 'KS', 'CM'):
+        bg1, err1 = bg.fit_varying_min_delta_ph(d, th_list,
+                                                error_metrics=error_metrics)
+        bg2, err2 = bg.fit_varying_min_delta_ph(d, th_list,
+                                                bg_fit_fun=exp_fit_loop,
+                                                error_metrics=error_metrics)
+        assert np.allclose(bg1, bg2, equal_nan=True)
+        assert np.allclose(err1, err2, equal_nan=True)
+
+
+def test_bg_calc_rolling(data):
+    """Test rolling background vs background fitted in periods."""
+    d = data
+    d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=300)
+    bg_periods = d.bg
+    # With window_s == time_s windows and periods are the same
+    # (except for the last period, which can be longer than time_s)
+    d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=300, mode='rolling',
+              window_s=20)
+    for sel in d.ph_streams:
+        for bg_p, bg_r in zip(bg_periods[sel], d.bg[sel]):
+            assert np.allclose(bg_p[:-1], bg_r[:-1])
+    assert d.bg_window_s == 20
+
+    d.calc_bg(bg.exp_fit, time_s=5, tail_min_us='auto', mode='rolling',
+              window_s=30)
+    assert d.nperiods > len(bg_periods[Ph_sel('all')][0])
+    d.burst_search()
+    d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=300)
+    assert 'bg_window_s' not in d
+    with pytest.raises(ValueError):
+        d.calc_bg(bg.exp_cdf_fit, mode='rolling', window_s=30)
+
+
+def test_bg_cache(data, tmp_path, monkeypatch):
+    """Test that cached background fits match the computed ones."""
+    monkeypatch.setattr(bg_cache, 'default_cache_file',
+                        str(tmp_path / 'bg_cache.hdf5'))
+    d = data
+    fields = ['bg', 'bg_err', 'bg_th_us']
+    for kwargs in (dict(fun=bg.exp_fit, tail_min_us='auto'),
+                   dict(fun=bg.exp_cdf_fit, tail_min_us=300,
+                        error_metrics='KS')):
+        d.calc_bg_cache(time_s=30, **kwargs)
+        computed = {field: d[field] for field in fields}
+        d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=500)
+        d.calc_bg_cache(time_s=30, **kwargs)
+        for field in fields:
+            for sel in d.ph_streams:
+                assert np.allclose(computed[field][sel], d[field][sel],
+                                   equal_nan=True)
+        assert d.bg_fun is kwargs['fun']
+        assert d.bg_time_s == 30
+        assert ('bg_auto_th_us0' in d) == (kwargs['tail_min_us'] == 'auto')
+    assert d.ph_times_hash() == d.ph_times_hash(hexdigest=False).hexdigest()
+
+
+def test_burst_search_cache(data, tmp_path, monkeypatch):
+    """Test that cached bursts and counts match a new burst search."""
+    monkeypatch.setattr(bg_cache, 'default_cache_file',
+                        str(tmp_path / 'bs_cache.hdf5'))
+    d = data
+    d.calc_bg(bg.exp_fit, time_s=30, tail_min_us=300)
+    fields = ['nd', 'na', 'nt', 'E'] + (['naa', 'nda', 'S']
+                                        if d.alternated else [])
+    for kwargs in (dict(F=7), dict(min_rate_cps=50e3)):
+        d.burst_search(L=10, m=10, **kwargs)
+        ref = {field: d[field] for field in fields + ['mburst', 'bp', 'T']}
+        d.burst_search_cache(L=10, m=10, computefret=False, **kwargs)
+        d.burst_search_cache(L=10, m=10, **kwargs)    # add counts
+        d.burst_search_cache(L=10, m=10, **kwargs)    # load bursts and counts
+        assert d.mburst == ref['mburst']
+        assert list_array_equal(d.bp, ref['bp'])
+        assert np.allclose(d.T, ref['T'])
+        for field in fields:
+            for v, v_ref in zip(d[field], ref[field]):
+                assert np.allclose(v, v_ref, equal_nan=True)
+
+
+def test_poisson_threshold():
+    """Test vectorized Poisson thresholds vs the scipy distributions."""
+    from scipy.stats import erlang, poisson
+    from fretbursts import poisson_threshold as pt
+    bg_rates = np.array([100., 1e3, 2e3, 5e3])
+    for m in (3, 10, 50):
+        for P in (0.1, 0.01, 0.001):
+            T_ref = [erlang.ppf(P, m, scale=1/bg) for bg in bg_rates]
+            assert np.allclose(pt.find_optimal_T_bga(bg_rates, m, P), T_ref)
+            assert np.allclose(pt.find_optimal_T(bg_rates[0], m, P),
+                               T_ref[0])
+            T_iter = pt.find_optimal_T_iter(bg_rates[0], m, P)
+            assert np.allclose(T_iter, T_ref[0], rtol=2e-3)
+    T = np.array([1e-3, 5e-3, 1e-2])
+    prob = pt.prob_noise_above_th(bg_rates[:, np.newaxis], T, 10)
+    prob_ref = [[poisson(bg * t).sf(9) for t in T] for bg in bg_rates]
+    assert np.allclose(prob, prob_ref)
+
+
+def test_burst_period(data):
+    """Test the burst period vs a loop over the periods."""
+    d = data
+    for b, lim, bp in zip(d.mburst, d.Lim, d.bp):
+        bp_ref = np.zeros(b.num_bursts, dtype=np.int32)
+        for i, (l0, l1) in enumerate(lim):
+            bp_ref[(b.istart >= l0) * (b.istart <= l1)] = i
+        assert bp.dtype == np.int32
+        assert np.array_equal(bp, bp_ref)
+
+    # More periods than the int16 range, with empty periods
+    lim = np.repeat(np.arange(40000) * 10, 2).reshape(-1, 2)
+    lim[:, 1] += 9
+    lim[1::3, 1] = lim[1::3, 0] - 1
+    istart = np.array([0, 15, 399985, 399999])
+    assert list(bl._burst_period(istart, lim)) == [0, 0, 39998, 39999]
+
+
 def test_ph_streams(data):
     sel = [Ph_sel('all'), Ph_sel(Dex='Dem'), Ph_sel(Dex='Aem')]
     if data.alternated:
@@ -401,6 +649,122 @@ def test_iter_ph_times(data):
                                 d.iter_ph_times(Ph_sel(Dex='DAem')))
 
 
+def test_stream_codes(data):
+    """Test the per-photon stream codes built by the loader."""
+    d = data
+    assert 'stream_codes' in d and len(d.stream_codes) == d.nch
+    for ich, codes in enumerate(d.stream_codes):
+        assert codes.dtype == np.uint8
+        assert codes.size == d.ph_times_m[ich].size
+        if d.alternated:
+            assert isinstance(d.A_em, bl.StreamMaskList)
+            assert (codes == d.A_em[ich] + 2 * d.A_ex[ich]).all()
+            assert not (d.D_em[ich] * d.A_em[ich]).any()
+            assert not (d.D_ex[ich] * d.A_ex[ich]).any()
+        else:
+            # Without alternation, the codes are a view of A_em
+            assert np.shares_memory(codes, d.A_em[ich])
+    for ph_sel, code in bl.STREAM_CODES.items():
+        if not d.alternated and ph_sel.Aex is not None:
+            continue
+        for ich, mask in enumerate(d.iter_ph_masks(ph_sel)):
+            assert (mask == (d.stream_codes[ich] == code)).all()
+    ds = d.slice_ph(time_s1=5, time_s2=d.time_max - 5)
+    for codes, ph in zip(ds.stream_codes, ds.iter_ph_times()):
+        assert codes.size == ph.size
+
+
+def test_usalex_apply_period():
+    """Test the single-pass alternation vs a mask-based selection."""
+    d = load_dataset_1ch(process=False)
+    ph_t, det_t = d.ph_times_t[0].copy(), d.det_t[0].copy()
+    donor, accept = d._det_donor_accept_multich[0]
+    ph_t -= d.offset if 'offset' in d else 0
+    d_ex = loader._select_range(ph_t, d.alex_period, d._D_ON_multich[0])
+    a_ex = loader._select_range(ph_t, d.alex_period, d._A_ON_multich[0])
+    d_em, a_em = (det_t == donor[0]), (det_t == accept[0])
+    valid = (d_ex + a_ex) * (d_em + a_em)
+
+    loader.usalex_apply_period(d, check=True, delete_ph_t=False)
+    assert np.array_equal(d.ph_times_m[0], ph_t[valid])
+    assert np.array_equal(d.A_em[0], a_em[valid])
+    assert np.array_equal(d.D_em[0], d_em[valid])
+    assert np.array_equal(d.A_ex[0], a_ex[valid])
+    assert np.array_equal(d.D_ex[0], d_ex[valid])
+
+    # Chunked processing gives the same result
+    d2 = load_dataset_1ch(process=False)
+    loader._usalex_apply_period_1ch(d2, chunksize=1000, remove_d_em_a_ex=True)
+    mask = ~(a_ex * d_em)[valid]
+    assert np.array_equal(d2.ph_times_m[0], d.ph_times_m[0][mask])
+    assert np.array_equal(d2.stream_codes[0], d.stream_codes[0][mask])
+
+
+def test_nsalex_apply_period():
+    """Test nsALEX alternation on synthetic multi-spot data."""
+    rng = np.random.RandomState(1)
+    nch, size, num_bins = 2, 5000, 4096
+    ph_t = [np.cumsum(rng.randint(1, 100, size=size)) for _ in range(nch)]
+    det_t = [rng.randint(0, 3, size=size).astype('uint8') for _ in range(nch)]
+    nanot_t = [rng.randint(0, num_bins, size=size).astype('uint16')
+               for _ in range(nch)]
+    D_ON, A_ON = (10, 1500), (2000, 3500)
+    # Per-channel list, single dict (legacy loader), no `tcspc_num_bins`
+    # and nanotimes out of the range of `tcspc_num_bins` (discarded)
+    for nanotimes_params in ([{'tcspc_num_bins': num_bins}] * nch,
+                             {'tcspc_num_bins': num_bins}, {},
+                             {'tcspc_num_bins': 3600}):
+        d = bl.Data(clk_p=50e-9, nch=nch, ALEX=True, lifetime=True,
+                    alternated=True, polarization=False, D_ON=D_ON, A_ON=A_ON,
+                    nanotimes_params=nanotimes_params,
+                    ph_times_t=ph_t, det_t=det_t, nanotimes_t=nanot_t,
+                    det_donor_accept=np.array([[0, 1]] * nch))
+        loader.nsalex_apply_period(d, chunksize=1000)
+        for ich in range(nch):
+            nanot, det = nanot_t[ich], det_t[ich]
+            d_ex = (nanot > D_ON[0]) * (nanot < D_ON[1])
+            a_ex = (nanot > A_ON[0]) * (nanot < A_ON[1])
+            valid = (d_ex + a_ex) * (det < 2)
+            assert np.array_equal(d.ph_times_m[ich], ph_t[ich][valid])
+            assert np.array_equal(d.nanotimes[ich], nanot[valid])
+            assert np.array_equal(d.A_em[ich], (det == 1)[valid])
+            assert np.array_equal(d.A_ex[ich], a_ex[valid])
+            assert np.array_equal(d.D_ex[ich], d_ex[valid])
+        assert 'nanotimes_t' not in d
+
+
+def test_ph_cache(data):
+    """Test the cache of photon masks and selected timestamps."""
+    d = data.copy(mute=True)
+    ph_sel = Ph_sel(Dex='Aem')
+    ph = d.get_ph_times(0, ph_sel=ph_sel)
+    info = d.ph_cache_info()
+    ph2 = d.get_ph_times(0, ph_sel=ph_sel)
+    assert ph2 is ph and not ph.flags.writeable
+    assert d.ph_cache_info()['hits'] > info['hits']
+    mask = d.get_ph_mask(0, ph_sel=ph_sel)
+    assert (ph == d.ph_times_m[0][mask]).all()
+    assert not mask.flags.writeable
+
+    # Data objects with a cache can be pickled and copied
+    if 'data_file' in d:
+        d.delete('data_file')  # the PyTables file cannot be pickled
+    for d2 in (pickle.loads(pickle.dumps(d)), copy.deepcopy(d)):
+        assert d2.ph_cache_info()['num_items'] == 0
+        assert (d2.get_ph_times(0, ph_sel=ph_sel) == ph).all()
+
+    # Changing per-photon fields clears the cache
+    d.add(ph_times_m=[p.copy() for p in d.ph_times_m])
+    assert d.ph_cache_info()['num_items'] == 0
+    assert d.get_ph_times(0, ph_sel=ph_sel) is not ph
+
+    # The memory budget is respected
+    d.set_ph_cache_size(ph.nbytes // 2)
+    assert d.ph_cache_info()['nbytes'] <= ph.nbytes // 2
+    d.get_ph_times(0, ph_sel=ph_sel)
+    assert d.ph_cache_info()['nbytes'] <= ph.nbytes // 2
+
+
 def test_get_ph_times_period(data):
     for ich in range(data.nch):
         data.get_ph_times_period(0, ich=ich)
@@ -441,6 +805,201 @@ def test_burst_search_py_cy(data):
     assert mburst1 == data.mburst
 
 
+def test_burst_search_numpy(data):
+    """Test vectorized (numpy) burst search against the other engines."""
+    bsearch_py = bl._get_bsearch_func(engine='python')
+    bsearch_np = bl._get_bsearch_func(engine='numpy')
+    bsearch_cy = bl._get_bsearch_func()
+    for ph in data.iter_ph_times():
+        for L, m, T in [(10, 10, 3e-3 / data.clk_p), (30, 5, 1e-3 / data.clk_p)]:
+            bursts_np = bsearch_np(ph, L, m, T, verbose=False)
+            bursts_cy = bsearch_cy(ph, L, m, T, verbose=False)
+            assert bursts_np.shape == (bursts_cy.shape[0], 4)
+            assert (bursts_np == bursts_cy).all()
+            slice_ = (ph.size // 3, ph.size // 2)
+            bursts_np = bsearch_np(ph, L, m, T, slice_=slice_, verbose=False)
+            bursts_cy = bsearch_cy(ph, L, m, T, slice_=slice_, verbose=False)
+            assert bursts_np.shape == (bursts_cy.shape[0], 4)
+            assert (bursts_np == bursts_cy).all()
+        bursts_py = bsearch_py(ph, 10, 10, 3e-3 / data.clk_p, verbose=False)
+        bursts_np = bsearch_np(ph, 10, 10, 3e-3 / data.clk_p, verbose=False)
+        assert (bursts_np == bursts_py).all()
+
+
+def test_burst_search_n_jobs(data):
+    """Test that multi-threaded burst search gives the serial result."""
+    data.burst_search(L=10, m=10, F=7)
+    mburst1 = [b.copy() for b in data.mburst]
+    data.burst_search(L=10, m=10, F=7, n_jobs=4)
+    assert mburst1 == data.mburst
+    data.burst_search(min_rate_cps=50e3)
+    mburst1 = [b.copy() for b in data.mburst]
+    data.burst_search(min_rate_cps=50e3, n_jobs=-1)
+    assert mburst1 == data.mburst
+    data.burst_search(L=10, m=10, F=7)
+
+
+def test_burst_search_periods(data):
+    """Test single-pass burst search against a search in each bg period."""
+    bsearch = bl._get_bsearch_func()
+    data.burst_search(L=10, m=10, F=7, index_allph=False)
+    for ich, ph in enumerate(data.iter_ph_times()):
+        Tck = data.TT[ich] / data.clk_p
+        burst_list = [bsearch(ph, 10, 10, Tck[ip], slice_=(l0, l1 + 1),
+                              verbose=False)
+                      for ip, (l0, l1) in enumerate(data.Lim[ich])]
+        bursts = np.vstack([b for b in burst_list if b.size > 1])
+        assert (bursts == data.mburst[ich].data).all()
+        for split in (True, False):
+            b1 = bl.bslib.bsearch_periods_np(ph, 10, 10, Tck, data.Lim[ich],
+                                             split=split, verbose=False)
+            b2 = bl.bslib.bsearch_periods(ph, 10, 10, Tck, data.Lim[ich],
+                                          split=split, verbose=False)
+            assert (b1 == b2).all()
+
+    data.burst_search(L=10, m=10, F=7, split_periods=False)
+    for bursts in data.mburst:
+        assert (bursts.counts >= 10).all()
+        assert (np.diff(bursts.istart) > 0).all()
+    data.burst_search(L=10, m=10, F=7)
+
+
+def test_burst_search_fused_count(data):
+    """Test counting photons in each stream during burst search."""
+    fields = [f for f in ('nd', 'na', 'naa', 'nda', 'nt') if f in data]
+    ref = {f: [x.copy() for x in data[f]] for f in fields}
+    for pure_python in (False, True):
+        data.burst_search(L=10, m=10, F=7, fused_count=True,
+                          pure_python=pure_python)
+        for f in fields:
+            assert list_array_equal(data[f], ref[f])
+    data.burst_search(L=10, m=10, F=7)
+
+
+def test_count_codes_in_bursts(data):
+    """Test the vectorized count of stream codes in bursts."""
+    for ich, bursts in enumerate(data.mburst):
+        codes = data._get_ph_stream_codes(ich)
+        burstarray = bursts.data
+        ref = np.zeros((bursts.num_bursts, 4), dtype='int64')
+        for i, (istart, istop) in enumerate(burstarray[:, :2]):
+            ref[i] = np.bincount(codes[istart:istop + 1], minlength=256)[:4]
+        for chunksize in (None, 1000):
+            counts = bl.bslib.count_codes_in_bursts(burstarray, codes,
+                                                    chunksize=chunksize)
+            assert np.array_equal(counts, ref)
+
+
+def test_burst_search_ondisk(data_8ch, monkeypatch):
+    """Test burst search streaming the timestamps from disk in chunks."""
+    monkeypatch.setattr(bl.bslib, 'default_chunksize', 10**5)
+    fname = DATASETS_DIR + "12d_New_30p_320mW_steer_3.hdf5"
+    d = loader.photon_hdf5(fname, ondisk=True)
+    assert d._is_ph_times_ondisk()
+    d.calc_bg(bg.exp_fit, time_s=30, tail_min_us=300)
+    d.burst_search(L=10, m=10, F=7)
+    for bursts, bursts_ref in zip(d.mburst, data_8ch.mburst):
+        assert bursts == bursts_ref
+    d.burst_search(L=10, m=10, min_rate_cps=50e3)
+    data_8ch.burst_search(L=10, m=10, min_rate_cps=50e3)
+    for bursts, bursts_ref in zip(d.mburst, data_8ch.mburst):
+        assert bursts == bursts_ref
+    data_8ch.burst_search(L=10, m=10, F=7)
+
+
+def test_bg_calc_ondisk(data_8ch, monkeypatch):
+    """Test background fit reading the timestamps from disk in chunks."""
+    monkeypatch.setattr(bl.bslib, 'default_chunksize', 10**5)
+    fname = DATASETS_DIR + "12d_New_30p_320mW_steer_3.hdf5"
+    d = loader.photon_hdf5(fname, ondisk=True)
+    for tail_min_us in (300, 'auto'):
+        d.calc_bg(bg.exp_fit, time_s=20, tail_min_us=tail_min_us)
+        data_8ch.calc_bg(bg.exp_fit, time_s=20, tail_min_us=tail_min_us)
+        for sel in d.ph_streams:
+            assert list_array_allclose(d.bg[sel], data_8ch.bg[sel])
+            assert list_array_allclose(d.bg_th_us[sel],
+                                       data_8ch.bg_th_us[sel])
+        assert np.array_equal(d.Lim, data_8ch.Lim)
+        assert np.array_equal(d.Ph_p, data_8ch.Ph_p)
+    data_8ch.calc_bg(bg.exp_fit, time_s=30, tail_min_us=300)
+
+
+def test_lazy_array():
+    """Test LazyArray indexing vs the in-memory array."""
+    from fretbursts.phtools.ondisk import LazyArray, new_chunk_cache
+    x = np.cumsum(np.random.RandomState(1).randint(1, 100, size=10**4))
+    a = LazyArray(x, cache=new_chunk_cache(10**4), chunksize=999)
+    assert a.shape == x.shape and len(a) == x.size
+    assert a[0] == x[0] and a[-1] == x[-1]
+    assert np.array_equal(a[123:5432], x[123:5432])
+    assert np.array_equal(a[:], x)
+    for sl in (slice(None, None, -1), slice(100, 10, -3), slice(5, 9000, 7),
+               slice(10, 100, -1)):
+        assert np.array_equal(a[sl], x[sl])
+    mask = x % 3 == 0
+    assert np.array_equal(a[mask], x[mask])
+    index = np.array([5000, 3, 9999, 2])
+    assert np.array_equal(a[index], x[index])
+    for t in (0, x[2000], x[2000] + 1, x[-1] + 1):
+        assert a.searchsorted(t) == np.searchsorted(x, t)
+    t = np.array([x[-1] + 1, 0, x[2000], x[5], x[2000] + 1])
+    for side in ('left', 'right'):
+        assert np.array_equal(a.searchsorted(t, side=side),
+                              np.searchsorted(x, t, side=side))
+    v = a.lazy_slice(1000, 8000, shift=-x[1000])
+    assert np.array_equal(v[:], x[1000:8000] - x[1000])
+    assert np.array_equal(np.concatenate([c for _, c in v.iter_chunks()]),
+                          v[:])
+    assert v.searchsorted(500) == np.searchsorted(x[1000:8000] - x[1000], 500)
+    assert a.cache.info()['nbytes'] <= 10**4
+
+
+def test_lazy_ondisk_data(data_8ch):
+    """Test on-disk Data with lazy arrays vs the in-memory Data."""
+    fname = DATASETS_DIR + "12d_New_30p_320mW_steer_3.hdf5"
+    d = loader.photon_hdf5(fname, ondisk=True)
+    d.set_chunk_cache_size(2**20)
+    assert d.time_max == data_8ch.time_max
+    assert np.array_equal(d.ph_data_sizes, data_8ch.ph_data_sizes)
+    for ich in range(d.nch):
+        assert np.array_equal(d.get_ph_times(ich), data_8ch.get_ph_times(ich))
+        assert np.array_equal(d.A_em[ich], data_8ch.A_em[ich])
+    ds = d.slice_ph(time_s1=5, time_s2=30)
+    ds_ref = data_8ch.slice_ph(time_s1=5, time_s2=30)
+    assert ds._is_ph_times_ondisk()
+    for ich in range(d.nch):
+        assert np.array_equal(ds.get_ph_times(ich),
+                              ds_ref.get_ph_times(ich))
+        assert np.array_equal(ds.A_em[ich], ds_ref.A_em[ich])
+    assert d.chunk_cache_info()['nbytes'] <= 2**20
+
+
+def test_load_time_window(data_8ch):
+    """Test loading a time window vs slicing the in-memory Data."""
+    fname = DATASETS_DIR + "12d_New_30p_320mW_steer_3.hdf5"
+    ds_ref = data_8ch.slice_ph(time_s1=5, time_s2=30)
+    t1_clk = int(5 / data_8ch.clk_p)
+    for ondisk in (False, True):
+        d = loader.photon_hdf5(fname, ondisk=ondisk, time_s=(5, 30))
+        for ich in range(d.nch):
+            assert np.array_equal(d.get_ph_times(ich) - t1_clk,
+                                  ds_ref.get_ph_times(ich))
+            assert np.array_equal(d.A_em[ich], ds_ref.A_em[ich])
+    d = loader.photon_hdf5(fname, time_s=(None, None))
+    assert np.array_equal(d.ph_data_sizes, data_8ch.ph_data_sizes)
+
+
+def test_load_multich_n_jobs(data_8ch):
+    """Test that loading multi-spot files in parallel gives the same data."""
+    fname = DATASETS_DIR + "12d_New_30p_320mW_steer_3.hdf5"
+    d = loader.photon_hdf5(fname, n_jobs=2)
+    assert d.nch == data_8ch.nch
+    for ich in range(d.nch):
+        assert np.array_equal(d.get_ph_times(ich), data_8ch.get_ph_times(ich))
+        assert np.array_equal(d.A_em[ich], data_8ch.A_em[ich])
+        assert np.array_equal(d.detectors[ich], data_8ch.detectors[ich])
+
+
 def test_burst_search_constant_rates(data):
     """Test python and cython burst search with constant threshold."""
     data.burst_search(min_rate_cps=50e3, pure_python=True)
@@ -543,6 +1102,35 @@ def test_mch_count_ph_num_py_c(data):
     na_c = bl.bslib.mch_count_ph_in_bursts_c(data.mburst, data.A_em)
     assert list_array_equal(na_py, na_c)
     assert na_py[0].dtype == np.float64
+    na_cs = bl.bslib.mch_count_ph_in_bursts_cs(data.mburst, data.A_em)
+    assert list_array_equal(na_py, na_cs)
+    assert na_cs[0].dtype == np.float64
+
+
+def test_burst_search_alex_cython(data_1ch):
+    """Test ALEX burst search and counting with the Cython engine."""
+    d = data_1ch.copy(mute=True)
+    d.burst_search(L=10, m=10, F=7, pure_python=False)
+    # Cached masks are read-only and must be accepted by the Cython code
+    masks = list(d.iter_ph_masks(Ph_sel(Dex='Aem')))
+    assert not masks[0].flags.writeable
+    na_c = bl.bslib.mch_count_ph_in_bursts_c(d.mburst, masks)
+    na_py = bl.bslib.mch_count_ph_in_bursts_py(d.mburst, masks)
+    assert list_array_equal(na_c, na_py)
+
+
+def test_mch_count_ph_num_overlapping_bursts(data):
+    """Test photon counting on long overlapping bursts (prefix-sum path)."""
+    mburst = []
+    for bursts, ph in zip(data.mburst, data.iter_ph_times()):
+        burstarray = bursts.data.copy()
+        burstarray[:, 1] = np.minimum(burstarray[:, 0] + 10**5, ph.size - 1)
+        mburst.append(bl.bslib.Bursts(burstarray))
+    na_py = bl.bslib.mch_count_ph_in_bursts_py(mburst, data.A_em)
+    na_c = bl.bslib.mch_count_ph_in_bursts_c(mburst, data.A_em)
+    na_cs = bl.bslib.mch_count_ph_in_bursts_cs(mburst, data.A_em)
+    assert list_array_equal(na_py, na_c)
+    assert list_array_equal(na_py, na_cs)
 
 
 def test_burst_sizes(data):
@@ -730,6 +1318,16 @@ def test_burst_recompute_index(data):
         assert (times_allph[bursts_allph3.istart] == bursts_allph3.start).all()
         assert (times_allph[bursts_allph3.istop] == bursts_allph3.stop).all()
 
+    # Test reusing the cached selection index
+    for ich, (mask_sel, bursts_sel, bursts_allph) in enumerate(zip(
+            d.iter_ph_masks(ph_sel=ph_sel), d_sel.mburst, d.mburst)):
+        index = d.get_ph_index(ich, ph_sel=ph_sel)
+        assert index.dtype == np.int64
+        assert (index == np.flatnonzero(mask_sel)).all()
+        assert index is d.get_ph_index(ich, ph_sel=ph_sel)
+        bursts_allph4 = bursts_sel.recompute_index_expand(None, index=index)
+        assert bursts_allph4 == bursts_allph
+
 ## This test is only used to develop alternative implementations of
 ## Bursts.recompute_index_reduce() and is normally disabled as it is very slow.
 #def test_burst_recompute_index_reduce(data):
@@ -863,13 +1461,15 @@ def test_ph_in_bursts_ich(data):
 
 
 def test_burst_fuse(data):
-    """Test 2 independent implementations of fuse_bursts for consistency.
+    """Test 3 independent implementations of fuse_bursts for consistency.
     """
     d = data
     for bursts in d.mburst:
         new_mbursti = bl.fuse_bursts_iter(bursts, ms=1)
         new_mburstd = bl.fuse_bursts_direct(bursts, ms=1)
+        new_mburst = bl.fuse_bursts(bursts, ms=1)
         assert new_mbursti == new_mburstd
+        assert new_mburst == new_mburstd
 
 
 def test_burst_fuse_0ms(data):
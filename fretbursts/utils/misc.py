@@ -10,6 +10,8 @@ Misc utility functions
 from __future__ import division, print_function
 import os
 import sys
+import threading
+from collections import OrderedDict
 import numpy as np
 
 
@@ -70,6 +72,171 @@ class HistData(object):
         return self._pdf
 
 
+class LRUCache(object):
+    """Thread-safe least-recently-used cache of arrays with a memory budget.
+
+    When adding an item exceeds `max_bytes` (total size of the cached
+    arrays), the least recently used items are discarded. Items larger than
+    `max_bytes` are not cached. Hits and misses are counted and reported by
+    :meth:`info`.
+
+    Arguments:
+        max_bytes (int): memory budget in bytes. Use 0 to disable caching.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        self._items = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # The lock cannot be pickled and the cached items are not needed
+        state = self.__dict__.copy()
+        del state['_lock']
+        state.update(_items=OrderedDict(), _nbytes=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the item for `key` (or None if not cached)."""
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Add `value` (an array) to the cache, discarding the LRU items."""
+        nbytes = value.nbytes
+        with self._lock:
+            if key in self._items:
+                self._nbytes -= self._items.pop(key).nbytes
+            if nbytes > self.max_bytes:
+                return
+            while self._nbytes + nbytes > self.max_bytes:
+                _, old_value = self._items.popitem(last=False)
+                self._nbytes -= old_value.nbytes
+            self._items[key] = value
+            self._nbytes += nbytes
+
+    def set_max_bytes(self, max_bytes):
+        """Change the memory budget, discarding the LRU items if needed."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self._nbytes > self.max_bytes:
+                _, old_value = self._items.popitem(last=False)
+                self._nbytes -= old_value.nbytes
+
+    def clear(self):
+        """Remove all the items (statistics are not reset)."""
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    def info(self):
+        """Return a dict with cache statistics and memory usage."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        num_items=len(self._items), nbytes=self._nbytes,
+                        max_bytes=self.max_bytes)
+
+
+class _SharedArray(object):
+    """Picklable reference to an array stored in a shared memory block."""
+    def __init__(self, name, shape, dtype):
+        self.name, self.shape, self.dtype = name, shape, dtype
+
+
+def _to_shared(obj, blocks):
+    """Copy the arrays in `obj` (also in a dict or list) to shared memory.
+    """
+    from multiprocessing import shared_memory
+    if isinstance(obj, dict):
+        return {k: _to_shared(v, blocks) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_to_shared(v, blocks) for v in obj]
+    if not isinstance(obj, np.ndarray) or obj.nbytes == 0:
+        return obj
+    shm = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+    blocks.append(shm)
+    shared = np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)
+    shared[:] = obj
+    return _SharedArray(shm.name, obj.shape, obj.dtype.str)
+
+
+def _from_shared(obj, blocks):
+    """Return `obj` with shared arrays references replaced by (read-only)
+    arrays attached to the shared memory blocks.
+    """
+    from multiprocessing import shared_memory
+    if isinstance(obj, dict):
+        return {k: _from_shared(v, blocks) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_from_shared(v, blocks) for v in obj]
+    if not isinstance(obj, _SharedArray):
+        return obj
+    # The block is owned (and unlinked) by the parent process
+    shm = shared_memory.SharedMemory(name=obj.name)
+    blocks.append(shm)
+    array = np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)
+    array.setflags(write=False)
+    return array
+
+
+def _call_shared(func, args, kwargs):
+    """Call `func(*args, **kwargs)` attaching the shared arrays in `args`."""
+    blocks = []
+    try:
+        return func(*_from_shared(list(args), blocks), **kwargs)
+    finally:
+        for shm in blocks:
+            shm.close()
+
+
+def map_processes(func, args_list, n_jobs=1, **kwargs):
+    """Return the list `[func(*args, **kwargs) for args in args_list]`.
+
+    `args_list` is an iterable (e.g. a generator) of argument tuples.
+    When `n_jobs` is not 1, the calls are executed by a pool of `n_jobs`
+    processes (if `n_jobs` is None or < 1 use one process per CPU).
+    The arrays in `args` (also inside a dict or a list) are passed to the
+    workers through shared memory instead of being pickled. In the workers
+    these arrays are read-only and `func` must not return views of them.
+    `func` and the other arguments need to be picklable.
+    The output order is always the order of `args_list` and the results
+    are the same as for the serial computation.
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1:
+        return [func(*args, **kwargs) for args in args_list]
+    args_list = list(args_list)
+    if len(args_list) <= 1:
+        return [func(*args, **kwargs) for args in args_list]
+
+    from concurrent.futures import ProcessPoolExecutor
+    blocks = []
+    try:
+        shared_args_list = [_to_shared(list(args), blocks)
+                            for args in args_list]
+        max_workers = min(n_jobs, len(args_list))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_call_shared, func, args, kwargs)
+                       for args in shared_args_list]
+            return [future.result() for future in futures]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
 def clk_to_s(t_ck, clk_p=12.5*1e-9):
     """Convert clock cycles to seconds."""
     return t_ck*clk_p